@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Default location of the cache, can be overridden with the VIDEO_REPAIR_CACHE environment variable
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.expanduser("~"), ".cache", "video-repair-tool", "analysis")
+
+# Number of reference analyses kept before the least recently used ones are evicted
+MAX_CACHE_ENTRIES = 32
+
+# Size of each of the samples read from the reference file to compute its hash
+HASH_SAMPLE_SIZE = 1024 * 1024
+
+# Files written by 'recover_mp4 --analyze' that the recovery step needs
+HEADER_FILES = ("audio.hdr", "video.hdr")
+
+ANALYSIS_FILE = "analysis.json"
+
+
+def fast_file_hash(path, sample_size=HASH_SAMPLE_SIZE):
+    # Hash the size of the file and samples from its start, middle and end instead of the
+    # whole file, which is enough to tell reference clips apart at a fraction of the I/O
+    size = os.path.getsize(path)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(size.to_bytes(8, byteorder='big'))
+
+    with open(path, 'rb') as f:
+        if size <= 3 * sample_size:
+            digest.update(f.read())
+        else:
+            for offset in (0, (size - sample_size) // 2, size - sample_size):
+                f.seek(offset)
+                digest.update(f.read(sample_size))
+
+    return digest.hexdigest()
+
+
+class AnalysisCache:
+    # Persistent cache of reference file analyses: one directory per reference hash holding
+    # the parsed analysis and the .hdr files, evicted least recently used first
+    def __init__(self, directory=None, max_entries=MAX_CACHE_ENTRIES):
+        if directory is None:
+            directory = os.environ.get("VIDEO_REPAIR_CACHE", DEFAULT_CACHE_DIRECTORY)
+        self.directory = directory
+        self.max_entries = max_entries
+
+    def entry_directory(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        # Return the cached analysis with the directory holding its .hdr files, or None
+        entry_directory = self.entry_directory(key)
+        analysis_path = os.path.join(entry_directory, ANALYSIS_FILE)
+        try:
+            with open(analysis_path, 'r') as f:
+                analysis = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not all(os.path.exists(os.path.join(entry_directory, name)) for name in HEADER_FILES):
+            return None
+
+        # Mark the entry as recently used
+        os.utime(analysis_path)
+
+        analysis['directory'] = entry_directory
+        analysis['reference_hash'] = key
+        return analysis
+
+    def put(self, key, analysis, header_directory):
+        # Store the analysis and copy the .hdr files from header_directory. The entry is built
+        # in a temporary directory and moved in place so concurrent jobs never see half of it
+        os.makedirs(self.directory, exist_ok=True)
+        staging_directory = tempfile.mkdtemp(prefix=f".{key}-", dir=self.directory)
+        try:
+            for name in HEADER_FILES:
+                shutil.copyfile(os.path.join(header_directory, name), os.path.join(staging_directory, name))
+            with open(os.path.join(staging_directory, ANALYSIS_FILE), 'w') as f:
+                json.dump(analysis, f)
+            os.replace(staging_directory, self.entry_directory(key))
+        except OSError:
+            # Another job stored the same reference first
+            shutil.rmtree(staging_directory, ignore_errors=True)
+
+        self.evict()
+        return self.get(key)
+
+    def evict(self):
+        # Remove the least recently used entries above max_entries
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_dir() and not entry.name.startswith('.'):
+                try:
+                    last_used = os.path.getmtime(os.path.join(entry.path, ANALYSIS_FILE))
+                except OSError:
+                    last_used = 0
+                entries.append((last_used, entry.path))
+
+        entries.sort(reverse=True)
+        for _, path in entries[self.max_entries:]:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
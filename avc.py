@@ -0,0 +1,187 @@
+import struct
+
+# NAL unit types (ITU-T H.264 table 7-1)
+NAL_SLICE = 1
+NAL_IDR_SLICE = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+NAL_END_OF_SEQUENCE = 10
+NAL_END_OF_STREAM = 11
+NAL_FILLER = 12
+
+# Slices carrying picture data
+VCL_NAL_TYPES = {NAL_SLICE, 2, 3, 4, NAL_IDR_SLICE}
+
+# NAL unit types found in camera recordings; anything else means we are not looking at video
+KNOWN_NAL_TYPES = VCL_NAL_TYPES | {NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD, NAL_END_OF_SEQUENCE, NAL_END_OF_STREAM, NAL_FILLER, 13, 14, 15, 19, 20}
+
+# NAL units that start a new access unit when they follow a slice
+ACCESS_UNIT_START_TYPES = {NAL_SEI, NAL_SPS, NAL_PPS, NAL_AUD, 14, 15}
+
+ANNEX_B_START_CODE = b'\x00\x00\x00\x01'
+
+
+def is_valid_nal_header(header_byte):
+    # forbidden_zero_bit must be clear and the type must be one a camera writes
+    return not header_byte & 0x80 and (header_byte & 0x1F) in KNOWN_NAL_TYPES
+
+
+def starts_access_unit(header_byte, first_payload_byte, previous_had_slice):
+    # Whether a NAL unit begins a new access unit (sample), given whether the current
+    # access unit already holds a slice (ITU-T H.264 7.4.1.2.3)
+    nal_type = header_byte & 0x1F
+    if nal_type == NAL_AUD:
+        return True
+    if not previous_had_slice:
+        return False
+    if nal_type in ACCESS_UNIT_START_TYPES:
+        return True
+    # A slice with first_mb_in_slice == 0 (ue(v) coded as a single 1 bit) starts a new picture
+    return nal_type in VCL_NAL_TYPES and bool(first_payload_byte & 0x80)
+
+
+def parse_avcc(avcc):
+    # Return (nal_length_size, [sps], [pps]) from an AVCDecoderConfigurationRecord
+    if len(avcc) < 7:
+        raise ValueError("Truncated avcC box.")
+    nal_length_size = (avcc[4] & 0x03) + 1
+    offset = 5
+    sps_list = []
+    for _ in range(avcc[offset] & 0x1F):
+        length = struct.unpack_from('>H', avcc, offset + 1)[0]
+        sps_list.append(bytes(avcc[offset + 3:offset + 3 + length]))
+        offset += 2 + length
+    offset += 1
+    pps_list = []
+    for _ in range(avcc[offset]):
+        length = struct.unpack_from('>H', avcc, offset + 1)[0]
+        pps_list.append(bytes(avcc[offset + 3:offset + 3 + length]))
+        offset += 2 + length
+    return nal_length_size, sps_list, pps_list
+
+
+def remove_emulation_prevention(data):
+    # Drop the 0x03 bytes inserted after two zero bytes to get the raw bitstream
+    return data.replace(b'\x00\x00\x03', b'\x00\x00')
+
+
+class BitReader:
+    # Reads bits and Exp-Golomb codes from a raw byte sequence payload
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def bit(self):
+        byte = self.data[self.position >> 3]
+        value = (byte >> (7 - (self.position & 7))) & 1
+        self.position += 1
+        return value
+
+    def bits(self, count):
+        value = 0
+        for _ in range(count):
+            value = (value << 1) | self.bit()
+        return value
+
+    def ue(self):
+        leading_zeros = 0
+        while not self.bit():
+            leading_zeros += 1
+            if leading_zeros > 31:
+                raise ValueError("Invalid Exp-Golomb code.")
+        return (1 << leading_zeros) - 1 + self.bits(leading_zeros)
+
+    def se(self):
+        value = self.ue()
+        return (value + 1) // 2 if value & 1 else -(value // 2)
+
+
+class SequenceParameters:
+    # The fields of a sequence parameter set needed to read picture order counts
+    def __init__(self, sps):
+        reader = BitReader(remove_emulation_prevention(sps[1:]))
+        profile_idc = reader.bits(8)
+        reader.bits(16)  # constraint flags and level_idc
+        reader.ue()  # seq_parameter_set_id
+
+        self.separate_colour_plane = 0
+        if profile_idc in (100, 110, 122, 244, 44, 83, 86, 118, 128, 138, 139, 134, 135):
+            chroma_format_idc = reader.ue()
+            if chroma_format_idc == 3:
+                self.separate_colour_plane = reader.bit()
+            reader.ue()  # bit_depth_luma_minus8
+            reader.ue()  # bit_depth_chroma_minus8
+            reader.bit()  # qpprime_y_zero_transform_bypass_flag
+            if reader.bit():  # seq_scaling_matrix_present_flag
+                for index in range(8 if chroma_format_idc != 3 else 12):
+                    if reader.bit():
+                        self._skip_scaling_list(reader, 16 if index < 6 else 64)
+
+        self.log2_max_frame_num = reader.ue() + 4
+        self.pic_order_cnt_type = reader.ue()
+        self.log2_max_pic_order_cnt_lsb = 0
+        if self.pic_order_cnt_type == 0:
+            self.log2_max_pic_order_cnt_lsb = reader.ue() + 4
+        elif self.pic_order_cnt_type == 1:
+            reader.bit()  # delta_pic_order_always_zero_flag
+            reader.se()  # offset_for_non_ref_pic
+            reader.se()  # offset_for_top_to_bottom_field
+            for _ in range(reader.ue()):
+                reader.se()  # offset_for_ref_frame
+        reader.ue()  # max_num_ref_frames
+        reader.bit()  # gaps_in_frame_num_value_allowed_flag
+        self.width = (reader.ue() + 1) * 16
+        map_units_height = reader.ue() + 1
+        self.frame_mbs_only = reader.bit()
+        self.height = map_units_height * 16 * (2 - self.frame_mbs_only)
+
+    @staticmethod
+    def _skip_scaling_list(reader, size):
+        last_scale = next_scale = 8
+        for _ in range(size):
+            if next_scale:
+                next_scale = (last_scale + reader.se() + 256) % 256
+            last_scale = next_scale or last_scale
+
+
+def slice_pic_order_cnt_lsb(nal, sps):
+    # Return pic_order_cnt_lsb from the header of a slice NAL unit, or None when the stream
+    # does not signal it (pic_order_cnt_type other than 0)
+    if sps.pic_order_cnt_type != 0:
+        return None
+    reader = BitReader(remove_emulation_prevention(nal[1:48]))
+    reader.ue()  # first_mb_in_slice
+    reader.ue()  # slice_type
+    reader.ue()  # pic_parameter_set_id
+    if sps.separate_colour_plane:
+        reader.bits(2)  # colour_plane_id
+    reader.bits(sps.log2_max_frame_num)  # frame_num
+    if not sps.frame_mbs_only and reader.bit():  # field_pic_flag
+        reader.bit()  # bottom_field_flag
+    if nal[0] & 0x1F == NAL_IDR_SLICE:
+        reader.ue()  # idr_pic_id
+    return reader.bits(sps.log2_max_pic_order_cnt_lsb)
+
+
+class PictureOrderCounter:
+    # Turns the pic_order_cnt_lsb of successive pictures into full picture order counts
+    # (ITU-T H.264 8.2.1.1)
+    def __init__(self, sps):
+        self.max_lsb = 1 << sps.log2_max_pic_order_cnt_lsb
+        self.previous_msb = 0
+        self.previous_lsb = 0
+
+    def next(self, lsb, is_idr, is_reference):
+        if is_idr:
+            self.previous_msb = self.previous_lsb = 0
+        if lsb < self.previous_lsb and self.previous_lsb - lsb >= self.max_lsb // 2:
+            msb = self.previous_msb + self.max_lsb
+        elif lsb > self.previous_lsb and lsb - self.previous_lsb > self.max_lsb // 2:
+            msb = self.previous_msb - self.max_lsb
+        else:
+            msb = self.previous_msb
+        if is_reference:
+            self.previous_msb, self.previous_lsb = msb, lsb
+        return msb + lsb
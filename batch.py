@@ -0,0 +1,292 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from metrics import disable_metrics, enable_metrics, measure_stage, metrics_recorder
+
+
+class ConsoleLog:
+    # Stand-in for a Qt log signal that prints the messages
+    def emit(self, message):
+        print(message)
+
+
+class LogCollector:
+    # Stand-in for a Qt log signal inside worker processes: keeps the messages so the
+    # parent process can emit them once the job is done
+    def __init__(self):
+        self.messages = []
+
+    def emit(self, message):
+        self.messages.append(message)
+
+
+class LogBuffer:
+    # Stand-in for a Qt log signal that the GUI drains on a timer instead of receiving one
+    # queued event per message. Keeps the last max_lines messages and counts those it dropped,
+    # so a worker logging faster than the window redraws costs bounded memory
+    def __init__(self, max_lines):
+        self.lock = threading.Lock()
+        self.messages = deque(maxlen=max_lines)
+        self.dropped = 0
+
+    def emit(self, message):
+        with self.lock:
+            if len(self.messages) == self.messages.maxlen:
+                self.dropped += 1
+            self.messages.append(message)
+
+    def drain(self):
+        # Return the messages logged since the last call and how many were dropped
+        with self.lock:
+            messages = list(self.messages)
+            dropped = self.dropped
+            self.messages.clear()
+            self.dropped = 0
+        return messages, dropped
+
+
+class FileSkipped(Exception):
+    # The error of a file left out of a batch on purpose, with the reason, for example a
+    # healthy file or one repaired by a previous run. It is reported but is not a failure
+    pass
+
+
+def default_worker_count():
+    return os.cpu_count() or 1
+
+
+def order_largest_first(paths):
+    # Sort the paths so the largest files are started first and the batch does not end
+    # with a single long file running on its own
+    def file_size(path):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return 0
+
+    return sorted(paths, key=file_size, reverse=True)
+
+
+def mirrored_folder(path, root, folder):
+    # Return the folder under `folder` that mirrors the directory of path under root, creating
+    # it, so files of the same name in different subfolders of root do not overwrite each other.
+    # Files outside root go straight to `folder`
+    relative = os.path.relpath(os.path.dirname(os.path.abspath(path)), os.path.abspath(root))
+    if relative == os.curdir or relative == os.pardir or relative.startswith(os.pardir + os.sep):
+        return folder
+    mirrored = os.path.join(folder, relative)
+    os.makedirs(mirrored, exist_ok=True)
+    return mirrored
+
+
+class QueueProgress:
+    # Progress callback handed to worker processes: forwards the byte counts through a
+    # manager queue to the parent process, which feeds them to the real progress callback
+    def __init__(self, progress_queue):
+        self.progress_queue = progress_queue
+
+    def __call__(self, byte_count):
+        self.progress_queue.put(byte_count)
+
+
+def _call_job(func, job, log_signal, progress, stage=None):
+    with measure_stage(stage, job):
+        if progress is None:
+            return func(job, log_signal)
+        return func(job, log_signal, progress)
+
+
+def _run_collecting_log(func, job, progress, stage=None):
+    # The measurements of the job go back to the parent process with its log
+    log = LogCollector()
+    if stage is None:
+        return _call_job(func, job, log, progress), log.messages, []
+    recorder = enable_metrics()
+    try:
+        result = _call_job(func, job, log, progress, stage)
+    finally:
+        disable_metrics()
+    return result, log.messages, recorder.records
+
+
+def _forward_progress(progress_queue, progress):
+    while True:
+        byte_count = progress_queue.get()
+        if byte_count is None:
+            break
+        progress(byte_count)
+
+
+def run_batch(func, jobs, log_signal, workers=None, use_processes=False, on_result=None, progress=None, stage=None):
+    # Run func(job, log_signal) for every job with a pool of workers, in the order of jobs.
+    # A failing job is logged and the others keep running. Threads are enough when the work
+    # happens in subprocesses; use processes when func does the work in Python.
+    # on_result(job, result, error) is called in the calling thread as each job completes.
+    # When progress is given, func is called as func(job, log_signal, progress) and reports
+    # the bytes it processed with progress(byte_count), also from worker processes.
+    # When metrics are enabled, each job in this process is measured as a run of stage.
+    # Returns a list of (job, result, error) in completion order.
+    if workers is None:
+        workers = default_worker_count()
+
+    results = []
+
+    def add_result(job, result, error):
+        results.append((job, result, error))
+        if on_result is not None:
+            on_result(job, result, error)
+
+    if workers <= 1:
+        for job in jobs:
+            try:
+                add_result(job, _call_job(func, job, log_signal, progress, stage), None)
+            except Exception as e:
+                log_signal.emit(f"Error: {str(e)}")
+                add_result(job, None, e)
+        return results
+
+    manager = None
+    worker_progress = progress
+    if use_processes and progress is not None:
+        manager = multiprocessing.Manager()
+        progress_queue = manager.Queue()
+        worker_progress = QueueProgress(progress_queue)
+        forwarder = threading.Thread(target=_forward_progress, args=(progress_queue, progress), daemon=True)
+        forwarder.start()
+
+    executor_class = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+    try:
+        with executor_class(max_workers=workers) as executor:
+            if use_processes:
+                recorder = metrics_recorder()
+                worker_stage = stage if recorder is not None else None
+                futures = {executor.submit(_run_collecting_log, func, job, worker_progress, worker_stage): job for job in jobs}
+            else:
+                futures = {executor.submit(_call_job, func, job, log_signal, worker_progress, stage): job for job in jobs}
+
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    result = future.result()
+                    if use_processes:
+                        result, messages, records = result
+                        for message in messages:
+                            log_signal.emit(message)
+                        for record in records:
+                            recorder.add(record)
+                    add_result(job, result, None)
+                except Exception as e:
+                    log_signal.emit(f"Error: {str(e)}")
+                    add_result(job, None, e)
+    finally:
+        if manager is not None:
+            progress_queue.put(None)
+            forwarder.join()
+            manager.shutdown()
+
+    return results
+
+
+class StageTimer:
+    # Accumulates, for each stage of a pipeline, the time spent working, waiting for input
+    # and blocked on a full queue towards the next stage
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, busy=0.0, idle=0.0, blocked=0.0, count=0):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {'busy': 0.0, 'idle': 0.0, 'blocked': 0.0, 'count': 0})
+            totals['busy'] += busy
+            totals['idle'] += idle
+            totals['blocked'] += blocked
+            totals['count'] += count
+
+    def report(self):
+        lines = []
+        for stage, totals in self.stages.items():
+            average = totals['busy'] / totals['count'] if totals['count'] else 0.0
+            lines.append(
+                f"Stage '{stage}': {totals['count']} files, {totals['busy']:.1f}s busy ({average:.1f}s per file), "
+                f"{totals['idle']:.1f}s waiting for input, {totals['blocked']:.1f}s blocked on the next stage"
+            )
+        return lines
+
+
+_END_OF_JOBS = object()
+
+
+def run_pipeline(stages, jobs, log_signal, workers=None, queue_size=None):
+    # Run every job through stages, a list of (name, func) where func(item, log_signal)
+    # returns the item passed to the next stage. Each stage has its own workers and the
+    # stages are linked by bounded queues, so job N+1 goes through a stage while job N is in
+    # the next one. Each stage of each job is measured when metrics are enabled. A failing job
+    # is logged and dropped, the others keep running.
+    # Returns a list of (job, result, error) in completion order and the StageTimer.
+    if workers is None:
+        workers = default_worker_count()
+    workers = max(workers, 1)
+    if queue_size is None:
+        queue_size = workers
+
+    timer = StageTimer()
+    results = []
+    results_lock = threading.Lock()
+
+    queues = [queue.Queue()] + [queue.Queue(maxsize=queue_size) for _ in stages[1:]]
+    for job in jobs:
+        queues[0].put((job, job))
+
+    def stage_worker(index, name, func):
+        inbox = queues[index]
+        outbox = queues[index + 1] if index + 1 < len(stages) else None
+        while True:
+            wait_start = time.perf_counter()
+            entry = inbox.get()
+            timer.add(name, idle=time.perf_counter() - wait_start)
+            if entry is _END_OF_JOBS:
+                break
+
+            job, item = entry
+            work_start = time.perf_counter()
+            try:
+                with measure_stage(name, job):
+                    item = func(item, log_signal)
+            except Exception as e:
+                log_signal.emit(f"Error: {str(e)}")
+                with results_lock:
+                    results.append((job, None, e))
+                continue
+            finally:
+                timer.add(name, busy=time.perf_counter() - work_start, count=1)
+
+            if outbox is None:
+                with results_lock:
+                    results.append((job, item, None))
+            else:
+                put_start = time.perf_counter()
+                outbox.put((job, item))
+                timer.add(name, blocked=time.perf_counter() - put_start)
+
+    threads = []
+    for index, (name, func) in enumerate(stages):
+        stage_threads = [threading.Thread(target=stage_worker, args=(index, name, func), daemon=True) for _ in range(workers)]
+        for thread in stage_threads:
+            thread.start()
+        threads.append(stage_threads)
+
+    # Close each stage once the one before it has drained
+    for _ in range(workers):
+        queues[0].put(_END_OF_JOBS)
+    for index, stage_threads in enumerate(threads):
+        for thread in stage_threads:
+            thread.join()
+        if index + 1 < len(queues):
+            for _ in range(workers):
+                queues[index + 1].put(_END_OF_JOBS)
+
+    return results, timer
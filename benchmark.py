@@ -0,0 +1,293 @@
+import argparse
+import contextlib
+import json
+import mmap
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from batch import LogCollector
+from corpus import (DAMAGE_MISSING_MOOV, DAMAGE_TRUNCATED, DAMAGE_ZEROED_HEADER, generate_corpus,
+                    parse_size, size_label)
+from videorepair import journal_path, undo_in_place_repair
+
+# Benchmark of the repair paths on a generated corpus of damaged recordings. Each path runs
+# in its own process so its peak memory and system calls are measured apart from the others:
+#
+#   python benchmark.py --sizes 64M,1G --json results.jsonl
+#   python benchmark.py --sizes 64M,1G --baseline results.jsonl
+#
+# exits with status 1 when a path got slower or bigger than the baseline by more than the tolerance
+
+DEFAULT_SIZES = "64M,1G"
+
+# Relative change from the baseline that counts as a regression
+DEFAULT_TOLERANCE = 0.2
+
+# The fields of /proc/self/io: system calls that read and write, and the bytes they moved
+PROC_IO_FIELDS = ('syscr', 'syscw', 'rchar', 'wchar')
+
+
+def bench_locate_moov(corrupt, reference, workdir, tools):
+    from videorepair import find_last_moov_offset
+    with open(corrupt, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            if find_last_moov_offset(data) is None:
+                raise Exception("No 'moov' found.")
+
+
+def bench_triage(corrupt, reference, workdir, tools):
+    from triage import triage_file
+    triage_file(corrupt)
+
+
+def bench_header(in_place):
+    def bench(corrupt, reference, workdir, tools):
+        from batch import ConsoleLog
+        from videorepair import repair_single_video
+        if repair_single_video((corrupt, reference, workdir, in_place), ConsoleLog()) is None:
+            raise Exception("The header repair failed.")
+    return bench
+
+
+def bench_scan(corrupt, reference, workdir, tools):
+    from isobmff import find_media_data_start
+    from mdat_scanner import scan_media_data
+    from reference_profile import read_reference_profile
+    profile = read_reference_profile(reference)
+    with open(corrupt, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            scan = scan_media_data(data, find_media_data_start(data, len(data)), len(data), profile)
+            if not scan.sample_count:
+                raise Exception("The scan found no frames.")
+
+
+def bench_recover(extractor, muxer):
+    def bench(corrupt, reference, workdir, tools):
+        from recover_mp4 import process_files
+        # process_files works on folders: give it one holding only the corrupt file
+        folder = os.path.join(workdir, "corrupted")
+        os.makedirs(folder)
+        os.symlink(corrupt, os.path.join(folder, os.path.basename(corrupt)))
+        process_files(folder, os.path.join(workdir, "repaired"), os.path.join(workdir, "temp"), reference,
+                      tools['recover_mp4'] or "recover_mp4.exe", tools['ffmpeg'] or "ffmpeg", workers=1, patterns=("*",),
+                      extractor=extractor, muxer=muxer, triage=False)
+        if not os.listdir(os.path.join(workdir, "repaired")):
+            raise Exception("No file was repaired.")
+    return bench
+
+
+# The repair paths: the damage each one is run on, what it does and the tools it needs
+BENCHMARKS = {
+    'locate-moov': (DAMAGE_ZEROED_HEADER, bench_locate_moov, ()),
+    'triage': (DAMAGE_TRUNCATED, bench_triage, ()),
+    'header-copy': (DAMAGE_ZEROED_HEADER, bench_header(False), ()),
+    'header-in-place': (DAMAGE_ZEROED_HEADER, bench_header(True), ()),
+    'scan': (DAMAGE_TRUNCATED, bench_scan, ()),
+    'native-copy': (DAMAGE_MISSING_MOOV, bench_recover("native", "copy"), ()),
+    'native-sidecar': (DAMAGE_MISSING_MOOV, bench_recover("native", "sidecar"), ()),
+    'native-ffmpeg': (DAMAGE_MISSING_MOOV, bench_recover("native", "ffmpeg"), ('ffmpeg',)),
+    'recover_mp4': (DAMAGE_MISSING_MOOV, bench_recover("recover_mp4", "ffmpeg"), ('recover_mp4', 'ffmpeg')),
+}
+
+
+def read_proc_io():
+    # The I/O counters of this process, or None where /proc is not available
+    try:
+        with open("/proc/self/io", 'r') as f:
+            counters = dict(line.split(':') for line in f)
+        return {field: int(counters[field]) for field in PROC_IO_FIELDS}
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def drop_page_cache(path):
+    # Ask the kernel to forget the cached pages of the file so every run reads from disk
+    try:
+        with open(path, 'rb') as f:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    except (OSError, AttributeError):
+        pass
+
+
+def run_child(name, corrupt, reference, workdir, tools):
+    # Run one path in this process and print its measurements as a JSON line. The repairs
+    # print as they go, which must not mix with the result
+    _, bench, _ = BENCHMARKS[name]
+    io_before = read_proc_io()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):
+        bench(corrupt, reference, workdir, tools)
+    seconds = time.perf_counter() - start
+    io_after = read_proc_io()
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result = {
+        'seconds': seconds,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss': max(own.ru_maxrss, children.ru_maxrss) * 1024,
+        'minor_faults': own.ru_minflt + children.ru_minflt,
+        'major_faults': own.ru_majflt + children.ru_majflt,
+    }
+    if io_before is not None and io_after is not None:
+        result.update({field: io_after[field] - io_before[field] for field in PROC_IO_FIELDS})
+    print(json.dumps(result))
+
+
+def parse_strace_summary(path):
+    # Total number of system calls from the summary written by strace -c
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if fields and fields[-1] == "total":
+                return int(fields[3])
+    return None
+
+
+def run_benchmark(name, corrupt, reference, workdir, tools, strace=None):
+    # Run one path in a child process and return its measurements
+    os.makedirs(workdir)
+    drop_page_cache(corrupt)
+    drop_page_cache(reference)
+
+    args = [sys.executable, os.path.abspath(__file__), "--child", name, corrupt, reference, workdir]
+    for tool in ('ffmpeg', 'recover_mp4'):
+        if tools[tool]:
+            args += [f"--{tool.replace('_', '-')}", tools[tool]]
+    strace_output = os.path.join(workdir, "strace.txt")
+    if strace is not None:
+        args = [strace, "-f", "-c", "-o", strace_output] + args
+
+    completed = subprocess.run(args, capture_output=True, text=True)
+    if completed.returncode != 0:
+        raise Exception(f"{name} failed on {os.path.basename(corrupt)}:\n{completed.stderr.strip()}")
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    if strace is not None:
+        result['syscalls'] = parse_strace_summary(strace_output)
+    elif 'syscr' in result:
+        result['syscalls'] = result['syscr'] + result['syscw']
+    return result
+
+
+def compare_with_baseline(results, baseline_path, tolerance):
+    # Return a message for each path that is slower, or needs more memory, than in the baseline
+    baseline = {}
+    with open(baseline_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                baseline[entry['path'], entry['size']] = entry
+
+    regressions = []
+    for result in results:
+        previous = baseline.get((result['path'], result['size']))
+        if previous is None:
+            continue
+        if result['throughput'] < previous['throughput'] * (1 - tolerance):
+            regressions.append(f"{result['path']} ({size_label(result['size'])}): {result['throughput'] / 1e6:.1f} MB/s, was {previous['throughput'] / 1e6:.1f} MB/s")
+        if result['peak_rss'] > previous['peak_rss'] * (1 + tolerance):
+            regressions.append(f"{result['path']} ({size_label(result['size'])}): peak RSS {result['peak_rss'] / 1e6:.1f} MB, was {previous['peak_rss'] / 1e6:.1f} MB")
+    return regressions
+
+
+def format_row(result):
+    syscalls = result.get('syscalls')
+    return (f"{result['path']:<16} {size_label(result['size']):>6} {result['seconds']:>9.3f} "
+            f"{result['throughput'] / 1e6:>10.1f} {result['peak_rss'] / 1e6:>9.1f} "
+            f"{syscalls if syscalls is not None else '-':>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the repair paths on generated damaged recordings.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Comma separated sizes of the recordings, such as 64M,1G,20G (default: %(default)s)")
+    parser.add_argument("--paths", help=f"Comma separated repair paths to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--workdir", help="Directory for the corpus and the outputs (default: a temporary directory)")
+    parser.add_argument("--keep", action="store_true", help="Keep the work directory")
+    parser.add_argument("--json", help="Write the results to this file, one JSON object per line")
+    parser.add_argument("--baseline", help="Results of an earlier run to compare with")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE, help="Relative slowdown or memory growth that counts as a regression (default: %(default)s)")
+    parser.add_argument("--ffmpeg", help="Path to ffmpeg, enables the paths that remux with it")
+    parser.add_argument("--recover-mp4", help="Path to recover_mp4, enables the recover_mp4 path")
+    parser.add_argument("--repeat", type=int, default=3, help="Run each path this many times and keep the fastest run (default: %(default)s)")
+    parser.add_argument("--strace", action="store_true", help="Count every system call with strace instead of the reads and writes of /proc/self/io")
+    parser.add_argument("--child", nargs=4, metavar=("PATH", "CORRUPT", "REFERENCE", "WORKDIR"), help=argparse.SUPPRESS)
+    arguments = parser.parse_args()
+    tools = {'ffmpeg': arguments.ffmpeg, 'recover_mp4': arguments.recover_mp4}
+
+    if arguments.child:
+        run_child(*arguments.child, tools)
+        return
+
+    names = arguments.paths.split(",") if arguments.paths else list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown path {name!r}")
+    names = [name for name in names if all(tools[tool] for tool in BENCHMARKS[name][2])]
+
+    strace = None
+    if arguments.strace:
+        strace = shutil.which("strace")
+        if strace is None:
+            parser.error("strace was not found")
+
+    workdir = os.path.abspath(arguments.workdir or tempfile.mkdtemp(prefix="video-repair-benchmark-"))
+    results = []
+    failed = False
+    try:
+        print(f"{'path':<16} {'size':>6} {'seconds':>9} {'MB/s':>10} {'RSS MB':>9} {'syscalls':>9}")
+        for size in (parse_size(text) for text in arguments.sizes.split(",")):
+            corpus_directory = os.path.join(workdir, f"corpus-{size_label(size)}")
+            reference, recordings = generate_corpus(corpus_directory, size, (DAMAGE_ZEROED_HEADER, DAMAGE_TRUNCATED, DAMAGE_MISSING_MOOV))
+            for name in names:
+                damage = BENCHMARKS[name][0]
+                recording = recordings[damage]
+                # Keep the fastest of the runs, the others paid for noise
+                result = None
+                for repeat in range(arguments.repeat):
+                    run_directory = os.path.join(workdir, f"run-{name}-{size_label(size)}-{repeat + 1}")
+                    try:
+                        run = run_benchmark(name, recording['path'], reference, run_directory, tools, strace)
+                    except Exception as e:
+                        print(f"Error: {e}", file=sys.stderr)
+                        result = None
+                        break
+                    finally:
+                        if name == 'header-in-place' and os.path.exists(journal_path(recording['path'])):
+                            undo_in_place_repair(recording['path'], LogCollector())
+                        if not arguments.keep:
+                            shutil.rmtree(run_directory, ignore_errors=True)
+                    if result is None or run['seconds'] < result['seconds']:
+                        result = run
+                if result is None:
+                    failed = True
+                    continue
+
+                # Results are keyed by the requested size, the damage changes the actual one
+                result.update(path=name, size=size, bytes=recording['size'], damage=damage)
+                result['throughput'] = recording['size'] / result['seconds'] if result['seconds'] > 0 else 0.0
+                results.append(result)
+                print(format_row(result), flush=True)
+    finally:
+        if not arguments.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if arguments.json:
+        with open(arguments.json, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+    if arguments.baseline:
+        regressions = compare_with_baseline(results, arguments.baseline, arguments.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        failed = failed or bool(regressions)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
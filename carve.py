@@ -0,0 +1,460 @@
+import bisect
+import mmap
+import os
+import re
+import struct
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from avc import parse_avcc
+from batch import ConsoleLog, default_worker_count, run_batch
+from integrity import verify_results
+from isobmff import Box, child_boxes, find_child, find_children, index_boxes, is_valid_box_type, is_valid_container, read_box_header, read_box_payload
+from mdat_scanner import scan_media_data
+from metrics import add_bytes, measure_stage
+from mp4_writer import write_repaired_copy
+from reference_profile import AVC_CODECS, expand_samples_per_chunk, most_common, read_full_box_entries, read_reference_profile
+from videorepair import copy_file_range_to
+
+# Clips are carved from a disk or card image, or a block device, without extracting them
+# first: the image is mapped, searched for the types of the 'ftyp' and 'moov' boxes in chunks
+# by several processes, and each clip is written from its byte range of the image by the
+# kernel. The 'mdat' headers are found by walking the boxes of each clip
+
+# Bytes of the image searched by a worker at a time; a multiple of the page size, so each
+# chunk can be advised on its own
+CARVE_CHUNK_SIZE = 256 * 1024 * 1024
+
+# Box types searched in the image, all of them in one pass over each chunk
+CARVE_SIGNATURES = (b'ftyp', b'moov')
+SIGNATURE_PATTERN = re.compile(b'|'.join(re.escape(signature) for signature in CARVE_SIGNATURES))
+
+# Largest 'ftyp' accepted, its brands take a few dozen bytes
+MAX_FTYP_SIZE = 4096
+
+# Bytes a camera may leave between the end of the media data and the 'moov' written after it
+MOOV_PADDING = 64 * 1024
+
+# How each clip is repaired: copied as it is, copied with the size of its 'mdat' rebuilt, or
+# rebuilt from a scan of its media data with the 'moov' of a reference file
+CARVE_INTACT = "intact"
+CARVE_HEADER = "header"
+CARVE_SCAN = "scan"
+
+
+class CarvedClip(namedtuple('CarvedClip', ['start', 'end', 'strategy', 'mdat', 'moov', 'media_end'])):
+    # A clip found in the image: its byte range, how it is repaired, its 'mdat' box as found
+    # (whose size may be wrong), its 'moov' box or None, and where its media data ends
+
+    @property
+    def size(self):
+        return self.end - self.start
+
+
+def image_size(f):
+    # The size of an image file or of a block device, whose stat size is 0
+    return f.seek(0, os.SEEK_END)
+
+
+def find_signatures(args):
+    # Find the boxes whose type starts in image[start + 4:end + 4], so every box starting in
+    # the chunk is found once. Runs in a worker process, which maps the image itself.
+    # Returns the plausible 'ftyp' and valid 'moov' boxes by offset
+    image_path, start, end = args
+    boxes = []
+    with open(image_path, 'rb') as f:
+        size = image_size(f)
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+            if hasattr(data, 'madvise'):
+                data.madvise(mmap.MADV_SEQUENTIAL, start, min(end, size) - start)
+            # A match must end by end + 7 for its type to start before end + 4
+            search_end = min(end + 7, size)
+            for match in SIGNATURE_PATTERN.finditer(data, start + 4, search_end):
+                box = read_signature(data, match.start() - 4, size)
+                if box is not None:
+                    boxes.append(box)
+    return boxes
+
+
+def read_signature(data, offset, size):
+    # The box at offset when its header is plausible for its type, else None. An 'mdat'
+    # header is kept whatever its size says, the size is what a damaged clip lost
+    box_type = data[offset + 4:offset + 8]
+    if box_type == b'mdat':
+        declared_size = struct.unpack_from('>I', data, offset)[0]
+        return Box(b'mdat', offset, declared_size, 16 if declared_size == 1 else 8)
+    try:
+        box = read_box_header(data, offset, size)
+    except ValueError:
+        return None
+    if box_type == b'ftyp':
+        # The major brand, a version and compatible brands of four characters each
+        if box.size < 16 or box.size > MAX_FTYP_SIZE or box.size % 4 or not is_valid_box_type(data[offset + 8:offset + 12]):
+            return None
+        return box
+    return box if is_valid_container(data, box) else None
+
+
+def search_image(image_path, log_signal, workers=None):
+    # Search the whole image once, a chunk per worker, and return the boxes found by offset
+    with open(image_path, 'rb') as f:
+        size = image_size(f)
+    chunks = [(image_path, start, min(start + CARVE_CHUNK_SIZE, size)) for start in range(0, size, CARVE_CHUNK_SIZE)]
+    log_signal.emit(f"Searching {size / 1e9:.1f} GB of {os.path.basename(image_path)} for MOV/MP4 boxes")
+
+    boxes = []
+    with measure_stage("search", image_path):
+        if workers is None:
+            workers = default_worker_count()
+        if workers <= 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                boxes.extend(find_signatures(chunk))
+        else:
+            # The chunks come back in the order of the image
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for chunk_boxes in executor.map(find_signatures, chunks):
+                    boxes.extend(chunk_boxes)
+        # Pages read through the maps are not counted by the system calls
+        add_bytes(read=size)
+    return boxes, size
+
+
+def mdat_is_damaged(data, mdat, size):
+    # The size of an 'mdat' cannot be trusted when it is 0, which leaves the box open to the
+    # end of the image, or when it does not fit in the image
+    declared_size = mdat.size
+    if declared_size == 1:
+        declared_size = struct.unpack_from('>Q', data, mdat.offset + 8)[0] if mdat.offset + 16 <= size else 0
+    return declared_size < mdat.header_size or mdat.offset + declared_size > size
+
+
+def first_after(offsets, offset, limit):
+    # The first of the sorted offsets at or after offset and before limit, or None
+    index = bisect.bisect_left(offsets, offset)
+    return offsets[index] if index < len(offsets) and offsets[index] < limit else None
+
+
+def read_chunk_offsets(data, stbl):
+    # The chunk offsets of a sample table, or None when it has none
+    chunk_offsets = find_child(data, stbl, b'stco') or find_child(data, stbl, b'co64')
+    if chunk_offsets is None:
+        return None
+    return read_full_box_entries(read_box_payload(data, chunk_offsets), 'I' if chunk_offsets.type == b'stco' else 'Q')
+
+
+def moov_fits(data, moov, clip_start, media_start, media_end):
+    # Whether the 'moov' indexes the media data before it, the chunk offsets counting from the
+    # start of the clip: every chunk lies in the media data and the last one ends about where
+    # the media data does, no further from it than the largest distance between two chunks.
+    # A 'moov' left by another clip fails one of these
+    offsets = []
+    for trak in find_children(data, moov, b'trak'):
+        stbl = find_child(data, trak, b'mdia', b'minf', b'stbl')
+        chunk_offsets = stbl and read_chunk_offsets(data, stbl)
+        if not chunk_offsets:
+            return False
+        offsets.extend(chunk_offsets)
+    if not offsets:
+        return False
+    offsets.sort()
+    media_start -= clip_start
+    media_end -= clip_start
+    if offsets[0] < media_start or offsets[-1] >= media_end:
+        return False
+    largest_chunk = max((following - offset for offset, following in zip(offsets, offsets[1:])), default=offsets[0] - media_start)
+    return media_end - offsets[-1] <= largest_chunk + MOOV_PADDING
+
+
+def nal_length_size(data, stbl):
+    # The NAL unit length size of the H.264 samples of a sample table, or 0 for other samples
+    stsd = find_child(data, stbl, b'stsd')
+    entries = child_boxes(data, stsd, skip=8) if stsd is not None else []
+    if not entries or entries[0].type not in AVC_CODECS:
+        return 0
+    # The avcC box follows the 78 bytes of the VisualSampleEntry fields
+    avcc = next((box for box in index_boxes(data, entries[0].offset + 8 + 78, entries[0].end) if box.type == b'avcC'), None)
+    try:
+        return parse_avcc(read_box_payload(data, avcc))[0] if avcc is not None else 0
+    except (ValueError, struct.error):
+        return 0
+
+
+def read_sample_tables(data, moov):
+    # The chunk offsets, samples per chunk, 'stsz' sample size, sample sizes (None when they
+    # are all the same) and NAL unit length size of each track of the 'moov', or None when its
+    # sample tables are incomplete
+    tables = []
+    for trak in find_children(data, moov, b'trak'):
+        stbl = find_child(data, trak, b'mdia', b'minf', b'stbl')
+        if stbl is None:
+            return None
+        chunk_offsets = read_chunk_offsets(data, stbl)
+        stsc = find_child(data, stbl, b'stsc')
+        stsz = find_child(data, stbl, b'stsz')
+        if not chunk_offsets or stsc is None or stsz is None:
+            return None
+        samples_per_chunk = expand_samples_per_chunk(read_full_box_entries(read_box_payload(data, stsc), 'I', fields=3), len(chunk_offsets))
+        stsz = read_box_payload(data, stsz)
+        sample_size = struct.unpack_from('>I', stsz, 4)[0]
+        sizes = None if sample_size else read_full_box_entries(stsz, 'I', count_offset=8)
+        if len(samples_per_chunk) != len(chunk_offsets) or sizes is not None and len(sizes) != sum(samples_per_chunk):
+            return None
+        tables.append((chunk_offsets, samples_per_chunk, sample_size, sizes, nal_length_size(data, stbl)))
+    return tables or None
+
+
+def last_chunk_end(tables):
+    # Where the last chunk of the sample tables ends, counting from the start of the clip
+    chunks = sorted(
+        (offset, index, chunk_index)
+        for index, (chunk_offsets, _, _, _, _) in enumerate(tables) for chunk_index, offset in enumerate(chunk_offsets)
+    )
+    offset, index, chunk_index = chunks[-1]
+    _, samples_per_chunk, sample_size, sizes, _ = tables[index]
+    count = samples_per_chunk[chunk_index]
+    if sizes is not None:
+        first_sample = sum(samples_per_chunk[:chunk_index])
+        return offset + sum(sizes[first_sample:first_sample + count])
+
+    # A constant size sample may take more bytes than 'stsz' says (QuickTime PCM): learn how
+    # many from the other chunks of the track, which run up to the next chunk of any track
+    ratios = [
+        (following[0] - current[0]) // samples_per_chunk[current[2]] for current, following in zip(chunks, chunks[1:])
+        if current[1] == index and samples_per_chunk[current[2]] and (following[0] - current[0]) % samples_per_chunk[current[2]] == 0
+    ]
+    return offset + count * most_common(ratios, sample_size)
+
+
+def is_nal_sample(data, offset, size, length_size):
+    # Whether the sample at offset is made of whole NAL units
+    end = offset + size
+    while offset + length_size <= end:
+        offset += length_size + int.from_bytes(data[offset:offset + length_size], 'big')
+    return offset == end
+
+
+def samples_fit(data, tables, start):
+    # Whether the first and last H.264 samples of each track are made of whole NAL units when
+    # the clip starts at start. Media data of another clip fails this
+    for chunk_offsets, samples_per_chunk, _, sizes, length_size in tables:
+        if not length_size or sizes is None or not len(sizes):
+            continue
+        last_offset = chunk_offsets[-1] + sum(sizes[len(sizes) - samples_per_chunk[-1]:-1])
+        if not is_nal_sample(data, start + chunk_offsets[0], sizes[0], length_size) \
+                or not is_nal_sample(data, start + last_offset, sizes[-1], length_size):
+            return False
+    return True
+
+
+def orphan_clip(data, moov):
+    # The clip of a 'moov' whose 'ftyp' and 'mdat' header were wiped, or None. Its media data
+    # ends where the 'moov' starts, so the end of its last chunk gives the start of the clip,
+    # which gets a new 'mdat' header in place of the 'ftyp' and the old header, as the header
+    # repair writes them
+    tables = read_sample_tables(data, moov)
+    if tables is None:
+        return None
+    start = moov.offset - last_chunk_end(tables)
+    if start < 0 or min(chunk_offsets[0] for chunk_offsets, _, _, _, _ in tables) < 16 or not samples_fit(data, tables, start):
+        return None
+    return CarvedClip(start, moov.end, CARVE_HEADER, Box(b'mdat', start, 16, 16), moov, moov.offset)
+
+
+def pair_clip(data, size, ftyp, ftyp_offsets, moov_offsets, moovs):
+    # Walk the top level boxes of the clip starting at ftyp and return it as a CarvedClip, or
+    # None when no media data follows. The walk trusts the box sizes, so 'ftyp' bytes inside
+    # media data do not cut a clip, and stops at the next clip or at an 'mdat' whose size was
+    # lost. ftyp_offsets and moov_offsets are the sorted offsets of the boxes found, moovs the
+    # 'moov' boxes by offset
+    offset = ftyp.offset
+    mdat = moov = None
+    damaged = False
+    while size - offset >= 8 and (mdat is None or moov is None):
+        if offset != ftyp.offset and first_after(ftyp_offsets, offset, offset + 1) is not None:
+            break
+        if data[offset + 4:offset + 8] == b'mdat':
+            header = read_signature(data, offset, size)
+            if mdat_is_damaged(data, header, size):
+                if mdat is None:
+                    mdat, damaged = header, True
+                break
+        try:
+            box = read_box_header(data, offset, size)
+        except ValueError:
+            break
+        if box.type == b'mdat' and mdat is None:
+            mdat = box
+        elif box.type == b'moov' and moov is None and is_valid_container(data, box):
+            moov = box
+        offset = box.end
+
+    if mdat is None:
+        return None
+    if not damaged:
+        if moov is not None:
+            return CarvedClip(ftyp.offset, max(mdat.end, moov.end), CARVE_INTACT, mdat, moov, mdat.end)
+        # Intact media data whose 'moov' is lost
+        return CarvedClip(ftyp.offset, mdat.end, CARVE_SCAN, mdat, None, mdat.end)
+
+    # The next clip, or the end of the image, bounds the media data of a damaged 'mdat'
+    limit = first_after(ftyp_offsets, mdat.offset, size) or size
+    media_start = mdat.offset + mdat.header_size
+    if moov is not None:
+        # The 'moov' comes first: the media data ends with its last chunk, or at the next clip
+        # when that one overwrote its tail. A 'moov' whose chunks do not fit the media data is
+        # not trusted and the clip is handled as one whose 'moov' is lost
+        tables = read_sample_tables(data, moov)
+        media_end = ftyp.offset + last_chunk_end(tables) if tables is not None else None
+        if media_end is not None and moov_fits(data, moov, ftyp.offset, media_start, media_end):
+            media_end = min(limit, media_end)
+            return CarvedClip(ftyp.offset, media_end, CARVE_HEADER, mdat, moov, media_end)
+
+    # The camera writes the 'moov' after the media data when it stops recording: the first
+    # one before the next clip whose chunks lie in the media data before it ends the media data
+    index = bisect.bisect_left(moov_offsets, media_start)
+    while index < len(moov_offsets) and moov_offsets[index] < limit:
+        moov = moovs[moov_offsets[index]]
+        if moov_fits(data, moov, ftyp.offset, media_start, moov.offset):
+            return CarvedClip(ftyp.offset, moov.end, CARVE_HEADER, mdat, moov, moov.offset)
+        index += 1
+    return CarvedClip(ftyp.offset, limit, CARVE_SCAN, mdat, None, limit)
+
+
+def place_orphan_clips(data, clips, moov_offsets, moovs):
+    # A 'moov' outside the clips whose extent is known lost its 'ftyp' and 'mdat' header: place
+    # its clip from its chunk offsets. A clip whose media data was only bounded by the next
+    # 'ftyp' or the end of the image ends where such a clip starts. Returns the clips by offset
+    # and the number of 'moov' boxes that could not be placed
+    known = [clip for clip in clips if clip.strategy != CARVE_SCAN]
+    open_ended = [clip for clip in clips if clip not in known]
+    orphans = 0
+    for offset in moov_offsets:
+        if any(clip.start <= offset < clip.end for clip in known):
+            continue
+        clip = orphan_clip(data, moovs[offset])
+        overlaps = clip is not None and (
+            any(other.start < clip.end and clip.start < other.end for other in known)
+            or any(clip.start <= other.start < clip.end for other in open_ended)
+        )
+        if clip is None or overlaps:
+            orphans += 1
+            continue
+        open_ended = [
+            other._replace(end=clip.start, media_end=clip.start) if other.start < clip.start < other.end else other
+            for other in open_ended
+        ]
+        known.append(clip)
+    return sorted(known + open_ended, key=lambda clip: clip.start), orphans
+
+
+def find_clips(image_path, log_signal, workers=None):
+    # Find every clip of the image in one pass over it: the boxes are searched in parallel,
+    # then each 'ftyp' is paired with the media data and the 'moov' that follow it, and each
+    # 'moov' left without one is placed from its chunk offsets
+    boxes, size = search_image(image_path, log_signal, workers)
+    ftyp_offsets = [box.offset for box in boxes if box.type == b'ftyp']
+    moovs = {box.offset: box for box in boxes if box.type == b'moov'}
+    moov_offsets = list(moovs)
+
+    clips = []
+    orphans = 0
+    if moov_offsets or ftyp_offsets:
+        with open(image_path, 'rb') as f:
+            with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as data:
+                for offset in ftyp_offsets:
+                    if clips and offset < clips[-1].end:
+                        # Inside the media data of the previous clip
+                        continue
+                    clip = pair_clip(data, size, read_box_header(data, offset, size), ftyp_offsets, moov_offsets, moovs)
+                    if clip is not None:
+                        clips.append(clip)
+
+                clips, orphans = place_orphan_clips(data, clips, moov_offsets, moovs)
+
+    log_signal.emit(f"Found {len(clips)} clips in {os.path.basename(image_path)}")
+    if orphans:
+        log_signal.emit(f"Skipped {orphans} 'moov' boxes whose clip could not be placed")
+    return clips
+
+
+def carved_file_name(image_path, clip, brand):
+    # Named after the image and the offset of the clip, with the extension of its brand
+    extension = "MOV" if brand == b'qt  ' else "MP4"
+    return f"{os.path.splitext(os.path.basename(image_path))[0]}-{clip.start}.{extension}"
+
+
+def write_header_repair(image, output, clip):
+    # Copy the clip with the size of its 'mdat' rebuilt. The header keeps its length so the
+    # chunk offsets of the 'moov' stay right
+    mdat = clip.mdat
+    media_size = clip.media_end - mdat.offset
+    if mdat.header_size == 16:
+        header = struct.pack('>I4sQ', 1, b'mdat', media_size)
+    elif media_size <= 0xFFFFFFFF:
+        header = struct.pack('>I4s', media_size, b'mdat')
+    elif clip.media_end == clip.end:
+        # The 'mdat' ends the file, a size of 0 says so
+        header = struct.pack('>I4s', 0, b'mdat')
+    else:
+        raise ValueError(f"The 'mdat' at offset {mdat.offset} holds {media_size} bytes, more than its 32-bit size can say.")
+
+    copy_file_range_to(image, output, clip.start, mdat.offset - clip.start)
+    output.write(header)
+    payload_offset = mdat.offset + len(header)
+    copied = copy_file_range_to(image, output, payload_offset, clip.end - payload_offset)
+    if copied != clip.end - payload_offset:
+        raise Exception(f"Copied {copied} of {clip.end - payload_offset} bytes of the clip at offset {clip.start}")
+
+
+def carve_clip(args, log_signal):
+    # Write one clip of the image to the output folder, reading it from the image through
+    # its byte range: nothing is extracted to a temp file first
+    image_path, clip, output_directory, profile = args
+    with open(image_path, 'rb') as image:
+        image.seek(clip.start + 8)
+        output_path = os.path.join(output_directory, carved_file_name(image_path, clip, image.read(4)))
+
+        if clip.strategy == CARVE_SCAN:
+            if profile is None:
+                raise Exception(f"The clip at offset {clip.start} lost its 'moov', a reference file is needed to rebuild it.")
+            media_start = clip.mdat.offset + clip.mdat.header_size
+            with mmap.mmap(image.fileno(), image_size(image), access=mmap.ACCESS_READ) as data:
+                scan = scan_media_data(data, media_start, clip.media_end, profile)
+            add_bytes(read=clip.media_end - media_start)
+            if not scan.sample_count:
+                raise Exception(f"No H.264 video matching the reference file was found in the clip at offset {clip.start}")
+            write_repaired_copy(profile, scan, image_path, output_path)
+            log_signal.emit(f"Rebuilt the clip at offset {clip.start} from {scan.sample_count} video frames: {output_path}")
+            return output_path
+
+        with open(output_path, 'wb') as output:
+            if clip.strategy == CARVE_HEADER:
+                write_header_repair(image, output, clip)
+            elif copy_file_range_to(image, output, clip.start, clip.size) != clip.size:
+                raise Exception(f"The clip at offset {clip.start} runs past the end of the image.")
+    log_signal.emit(f"Carved the clip at offset {clip.start} ({clip.strategy}): {output_path}")
+    return output_path
+
+
+def carve_image(image_path, output_directory, log_signal=None, reference_file=None, workers=None, verify=True):
+    # Find the clips of a disk or card image and repair each of them into the output folder.
+    # Returns a list of (clip, output path, error) by offset, or None when the reference file
+    # cannot be read
+    if log_signal is None:
+        log_signal = ConsoleLog()
+
+    profile = None
+    if reference_file:
+        try:
+            profile = read_reference_profile(reference_file)
+        except (OSError, ValueError, IndexError, struct.error) as e:
+            log_signal.emit(f"Error: Could not read the reference file {reference_file}: {e}")
+            return None
+
+    clips = find_clips(image_path, log_signal, workers)
+    os.makedirs(output_directory, exist_ok=True)
+    jobs = [(image_path, clip, output_directory, profile) for clip in clips]
+    # The clips are copied by the kernel, threads are enough
+    results = run_batch(carve_clip, jobs, log_signal, workers, stage="carve")
+    if verify:
+        results = verify_results(results, log_signal, workers)
+    return sorted(((job[1], output, error) for job, output, error in results), key=lambda result: result[0].start)
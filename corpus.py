@@ -0,0 +1,294 @@
+import os
+import struct
+from array import array
+from isobmff import make_box, make_full_box
+from mp4_writer import TrackTable, chunk_runs
+
+# Synthetic camera recordings for benchmarks, written without any external tool: H.264 video
+# with an SPS/PPS before every keyframe and interleaved PCM audio, like the files the repairs
+# are built for. Only the NAL lengths and headers are written; slice data and audio samples
+# are left as holes, so a recording of tens of gigabytes takes a few megabytes of disk
+
+# Video timing: 29.97 fps
+CORPUS_TIMESCALE = 30000
+CORPUS_SAMPLE_DURATION = 1001
+CORPUS_MOVIE_TIMESCALE = 1000
+
+# Average size of a coded picture; keyframes are twice as large
+CORPUS_FRAME_SIZE = 256 * 1024
+CORPUS_GOP_SIZE = 15
+
+# Video frames per chunk, each chunk followed by the audio of the same period
+CORPUS_FRAMES_PER_CHUNK = 15
+
+# 48 kHz 16-bit stereo big-endian PCM ('twos')
+CORPUS_SAMPLE_RATE = 48000
+CORPUS_CHANNELS = 2
+CORPUS_BITS = 16
+
+# Major brands of the two flavours of files
+BRAND_MOV = b'qt  '
+BRAND_MP4 = b'isom'
+
+# Ways the recordings are damaged, as seen on real cards
+DAMAGE_NONE = "none"  # Healthy file
+DAMAGE_ZEROED_HEADER = "zeroed-header"  # The 'ftyp' and 'mdat' headers are overwritten with zeros
+DAMAGE_TRUNCATED = "truncated"  # Cut in the middle of the media data, the 'moov' is lost
+DAMAGE_MISSING_MOOV = "missing-moov"  # The media data is complete but the 'moov' was never written
+DAMAGE_MODES = (DAMAGE_NONE, DAMAGE_ZEROED_HEADER, DAMAGE_TRUNCATED, DAMAGE_MISSING_MOOV)
+
+# Part of the media data kept by DAMAGE_TRUNCATED
+TRUNCATED_FRACTION = 0.9
+
+# Picture size of the coded frames (1920x1088 in 16x16 macroblocks)
+CORPUS_WIDTH_MBS = 120
+CORPUS_HEIGHT_MBS = 68
+
+
+# Multipliers of the size suffixes accepted by parse_size
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(text):
+    # Parse a size such as '512M' or '20G'
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def size_label(size):
+    # The shortest exact label of a size, for file names
+    for unit in ('T', 'G', 'M', 'K'):
+        if size % SIZE_UNITS[unit] == 0:
+            return f"{size // SIZE_UNITS[unit]}{unit}"
+    return str(size)
+
+
+class BitWriter:
+    # Writes bits and Exp-Golomb codes, the reverse of avc.BitReader
+    def __init__(self):
+        self.value = 0
+        self.length = 0
+
+    def bits(self, count, value):
+        self.value = (self.value << count) | (value & ((1 << count) - 1))
+        self.length += count
+
+    def ue(self, value):
+        value += 1
+        self.bits(2 * value.bit_length() - 1, value)
+
+    def to_bytes(self, stop_bit=True):
+        # Byte align, with the rbsp_stop_one_bit when the structure ends here
+        value, length = self.value, self.length
+        if stop_bit:
+            value, length = (value << 1) | 1, length + 1
+        padding = -length % 8
+        return (value << padding).to_bytes((length + padding) // 8, 'big')
+
+
+def sequence_parameter_set():
+    # Main profile, level 4.0, 4 bit frame_num and 6 bit pic_order_cnt_lsb
+    writer = BitWriter()
+    writer.bits(8, 77)  # profile_idc
+    writer.bits(8, 0)  # constraint flags
+    writer.bits(8, 40)  # level_idc
+    writer.ue(0)  # seq_parameter_set_id
+    writer.ue(0)  # log2_max_frame_num_minus4
+    writer.ue(0)  # pic_order_cnt_type
+    writer.ue(2)  # log2_max_pic_order_cnt_lsb_minus4
+    writer.ue(1)  # max_num_ref_frames
+    writer.bits(1, 0)  # gaps_in_frame_num_value_allowed_flag
+    writer.ue(CORPUS_WIDTH_MBS - 1)
+    writer.ue(CORPUS_HEIGHT_MBS - 1)
+    writer.bits(1, 1)  # frame_mbs_only_flag
+    writer.bits(1, 1)  # direct_8x8_inference_flag
+    writer.bits(1, 0)  # frame_cropping_flag
+    writer.bits(1, 0)  # vui_parameters_present_flag
+    return b'\x67' + writer.to_bytes()
+
+
+def picture_parameter_set():
+    writer = BitWriter()
+    writer.ue(0)  # pic_parameter_set_id
+    writer.ue(0)  # seq_parameter_set_id
+    writer.bits(1, 0)  # entropy_coding_mode_flag
+    writer.bits(1, 0)  # bottom_field_pic_order_in_frame_present_flag
+    writer.ue(0)  # num_slice_groups_minus1
+    writer.ue(0)  # num_ref_idx_l0_default_active_minus1
+    writer.ue(0)  # num_ref_idx_l1_default_active_minus1
+    writer.bits(1, 0)  # weighted_pred_flag
+    writer.bits(2, 0)  # weighted_bipred_idc
+    writer.ue(0)  # pic_init_qp_minus26 (se, 0)
+    writer.ue(0)  # pic_init_qs_minus26 (se, 0)
+    writer.ue(0)  # chroma_qp_index_offset (se, 0)
+    writer.bits(1, 0)  # deblocking_filter_control_present_flag
+    writer.bits(1, 0)  # constrained_intra_pred_flag
+    writer.bits(1, 0)  # redundant_pic_cnt_present_flag
+    return b'\x68' + writer.to_bytes()
+
+
+def slice_header(is_idr, frame_num, pic_order_cnt_lsb):
+    # The start of a slice NAL unit, up to pic_order_cnt_lsb; the slice data that follows is a hole
+    writer = BitWriter()
+    writer.ue(0)  # first_mb_in_slice
+    writer.ue(7 if is_idr else 5)  # slice_type: all I or all P
+    writer.ue(0)  # pic_parameter_set_id
+    writer.bits(4, frame_num)
+    if is_idr:
+        writer.ue(0)  # idr_pic_id
+    writer.bits(6, pic_order_cnt_lsb)
+    header = 0x65 if is_idr else 0x41  # nal_ref_idc 3 or 2, IDR or non-IDR slice
+    return bytes([header]) + writer.to_bytes(stop_bit=False)
+
+
+def avc_sample_entry(sps, pps):
+    avcc = bytes([1, sps[1], sps[2], sps[3], 0xFF, 0xE1]) + struct.pack('>H', len(sps)) + sps
+    avcc += b'\x01' + struct.pack('>H', len(pps)) + pps
+    fields = b'\x00' * 6 + struct.pack('>H', 1) + b'\x00' * 16
+    fields += struct.pack('>HHIIIH', CORPUS_WIDTH_MBS * 16, CORPUS_HEIGHT_MBS * 16, 0x480000, 0x480000, 0, 1)
+    fields += b'\x00' * 32 + struct.pack('>Hh', 24, -1)
+    return make_box(b'avc1', fields + make_box(b'avcC', avcc))
+
+
+def pcm_sample_entry():
+    fields = b'\x00' * 6 + struct.pack('>H', 1) + b'\x00' * 8
+    fields += struct.pack('>HHHHI', CORPUS_CHANNELS, CORPUS_BITS, 0, 0, CORPUS_SAMPLE_RATE << 16)
+    return make_box(b'twos', fields)
+
+
+MATRIX = struct.pack('>9I', 0x10000, 0, 0, 0, 0x10000, 0, 0, 0, 0x40000000)
+
+
+def track_box(track_id, handler, sample_entry, table, timescale, movie_duration, media_header, width_height=(0, 0)):
+    volume = 0x100 if handler == b'soun' else 0
+    tkhd = struct.pack('>IIIII', 0, 0, track_id, 0, movie_duration) + b'\x00' * 8
+    tkhd += struct.pack('>hhhH', 0, 0, 0, volume) + MATRIX + struct.pack('>II', width_height[0] << 16, width_height[1] << 16)
+    mdhd = struct.pack('>IIIIHH', 0, 0, timescale, table.duration, 0x55C4, 0)
+    hdlr = b'\x00' * 4 + handler + b'\x00' * 12 + handler.title() + b'\x00'
+    dinf = make_box(b'dinf', make_full_box(b'dref', 0, 0, struct.pack('>I', 1) + make_full_box(b'url ', 0, 1, b'')))
+    stsd = make_full_box(b'stsd', 0, 0, struct.pack('>I', 1) + sample_entry)
+    minf = make_box(b'minf', media_header + dinf + make_box(b'stbl', stsd + table.box()))
+    mdia = make_box(b'mdia', make_full_box(b'mdhd', 0, 0, mdhd) + make_full_box(b'hdlr', 0, 0, hdlr) + minf)
+    return make_box(b'trak', make_full_box(b'tkhd', 0, 3, tkhd) + mdia)
+
+
+def movie_box(video, audio):
+    # The 'moov' of a recording from the tables of its two tracks
+    video_duration = video.duration * CORPUS_MOVIE_TIMESCALE // CORPUS_TIMESCALE
+    audio_duration = audio.duration * CORPUS_MOVIE_TIMESCALE // CORPUS_SAMPLE_RATE
+    mvhd = struct.pack('>IIII', 0, 0, CORPUS_MOVIE_TIMESCALE, max(video_duration, audio_duration))
+    mvhd += struct.pack('>IH', 0x10000, 0x100) + b'\x00' * 10 + MATRIX + b'\x00' * 24 + struct.pack('>I', 3)
+    traks = track_box(
+        1, b'vide', avc_sample_entry(sequence_parameter_set(), picture_parameter_set()), video, CORPUS_TIMESCALE,
+        video_duration, make_full_box(b'vmhd', 0, 1, b'\x00' * 8), (CORPUS_WIDTH_MBS * 16, CORPUS_HEIGHT_MBS * 16),
+    )
+    traks += track_box(2, b'soun', pcm_sample_entry(), audio, CORPUS_SAMPLE_RATE, audio_duration, make_full_box(b'smhd', 0, 0, b'\x00' * 4))
+    return make_box(b'moov', make_full_box(b'mvhd', 0, 0, mvhd) + traks)
+
+
+def generate_recording(path, size, frame_size=CORPUS_FRAME_SIZE, brand=BRAND_MOV):
+    # Write a healthy recording of about size bytes: 'ftyp', 'mdat' with a 64-bit size and a
+    # 'moov' at the end, as cameras write them. Returns where its parts are
+    sps, pps = sequence_parameter_set(), picture_parameter_set()
+    aud = b'\x09\xf0'
+    audio_chunk_size = CORPUS_FRAMES_PER_CHUNK * CORPUS_SAMPLE_DURATION * CORPUS_SAMPLE_RATE // CORPUS_TIMESCALE * CORPUS_CHANNELS * CORPUS_BITS // 8
+    audio_bytes_per_sample = CORPUS_CHANNELS * CORPUS_BITS // 8
+
+    video = TrackTable(None)
+    video.sample_sizes = array('I')
+    video.stss = array('I')
+    video_chunk_counts = []
+    audio = TrackTable(None)
+    audio_chunk_counts = []
+
+    ftyp = make_box(b'ftyp', brand + struct.pack('>I', 0) + brand)
+    media_start = len(ftyp) + 16
+    with open(path, 'wb') as f:
+        f.write(ftyp)
+        f.write(struct.pack('>I4sQ', 1, b'mdat', 0))
+        position = media_start
+        frame = 0
+        while position < size:
+            video.chunk_offsets.append(position)
+            video_chunk_counts.append(CORPUS_FRAMES_PER_CHUNK)
+            for _ in range(CORPUS_FRAMES_PER_CHUNK):
+                index_in_gop = frame % CORPUS_GOP_SIZE
+                is_idr = index_in_gop == 0
+                nals = [aud] + ([sps, pps] if is_idr else [])
+                slice_start = slice_header(is_idr, index_in_gop % 16, (2 * index_in_gop) % 64)
+                slice_size = (2 if is_idr else 1) * frame_size - len(aud) - 4 * len(nals) - 4
+
+                f.seek(position)
+                f.write(b''.join(struct.pack('>I', len(nal)) + nal for nal in nals))
+                f.write(struct.pack('>I', slice_size) + slice_start)
+                sample_size = sum(4 + len(nal) for nal in nals) + 4 + slice_size
+                video.sample_sizes.append(sample_size)
+                if is_idr:
+                    video.stss.append(frame + 1)
+                position += sample_size
+                frame += 1
+
+            # The audio chunk is silence, a hole in the file
+            audio.chunk_offsets.append(position)
+            audio_chunk_counts.append(audio_chunk_size // audio_bytes_per_sample)
+            position += audio_chunk_size
+
+        media_end = position
+        video.sample_count = frame
+        video.stts = array('I', (frame, CORPUS_SAMPLE_DURATION))
+        video.duration = frame * CORPUS_SAMPLE_DURATION
+        video.stsc = chunk_runs(video_chunk_counts)
+        audio.sample_count = sum(audio_chunk_counts)
+        audio.stts = array('I', (audio.sample_count, 1))
+        audio.duration = audio.sample_count
+        audio.stsc = chunk_runs(audio_chunk_counts)
+        audio.sample_size = 1
+
+        f.seek(media_end)
+        f.write(movie_box(video, audio))
+        moov_end = f.tell()
+        f.seek(len(ftyp) + 8)
+        f.write(struct.pack('>Q', media_end - len(ftyp)))
+
+    return {
+        'path': path,
+        'size': moov_end,
+        'frames': frame,
+        'media_start': media_start,
+        'media_end': media_end,
+        'moov_offset': media_end,
+    }
+
+
+def damage_recording(recording, mode):
+    # Damage a recording written by generate_recording in place and return its new description
+    path = recording['path']
+    recording = dict(recording, damage=mode)
+    if mode == DAMAGE_ZEROED_HEADER:
+        with open(path, 'r+b') as f:
+            f.write(b'\x00' * recording['media_start'])
+    elif mode == DAMAGE_TRUNCATED:
+        media_size = recording['media_end'] - recording['media_start']
+        cut = recording['media_start'] + int(media_size * TRUNCATED_FRACTION)
+        os.truncate(path, cut)
+        recording['size'] = cut
+    elif mode == DAMAGE_MISSING_MOOV:
+        os.truncate(path, recording['moov_offset'])
+        recording['size'] = recording['moov_offset']
+    elif mode != DAMAGE_NONE:
+        raise ValueError(f"Unknown damage {mode!r}.")
+    return recording
+
+
+def generate_corpus(directory, size, modes=DAMAGE_MODES, frame_size=CORPUS_FRAME_SIZE, brand=BRAND_MOV):
+    # Write one recording of about size bytes for each damage, plus a small healthy reference
+    # recorded with the same settings. Returns the reference path and the recordings by damage
+    os.makedirs(directory, exist_ok=True)
+    extension = ".MOV" if brand == BRAND_MOV else ".MP4"
+    reference = generate_recording(os.path.join(directory, "reference" + extension), 16 * frame_size * CORPUS_GOP_SIZE, frame_size, brand)
+    recordings = {}
+    for mode in modes:
+        recording = generate_recording(os.path.join(directory, f"{mode}-{size_label(size)}{extension}"), size, frame_size, brand)
+        recordings[mode] = damage_recording(recording, mode)
+    return reference['path'], recordings
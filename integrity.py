@@ -0,0 +1,173 @@
+import hashlib
+import mmap
+import os
+from collections import defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from analysis_cache import fast_file_hash
+from batch import default_worker_count
+from isobmff import find_child, find_children, is_valid_container, read_box_payload, walk_boxes
+from metrics import add_bytes, job_path, measure_stage
+from reference_profile import read_full_box_entries
+
+# Bytes hashed at a time; hashlib releases the GIL on blocks this large
+HASH_BLOCK_SIZE = 8 * 1024 * 1024
+
+
+def hash_data(data, size):
+    # Hash of the content of a mapped file
+    digest = hashlib.blake2b(digest_size=32)
+    with memoryview(data) as view:
+        for offset in range(0, size, HASH_BLOCK_SIZE):
+            digest.update(view[offset:offset + HASH_BLOCK_SIZE])
+    return digest.hexdigest()
+
+
+def full_file_hash(path):
+    # Hash of the whole content of a file, read once through a map
+    size = os.path.getsize(path)
+    if size == 0:
+        return hashlib.blake2b(digest_size=32).hexdigest()
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return hash_data(data, size)
+
+
+def find_duplicates(paths, workers=None):
+    # Find the files holding the same clip. Files are grouped by size, which costs nothing,
+    # then by a hash of a few samples of them, and only the files whose samples match are
+    # hashed in full. Returns the files to repair, one per clip in the order of paths, and a
+    # dict from each duplicate to the file repaired in its place
+    paths = list(paths)
+    by_size = defaultdict(list)
+    for path in paths:
+        by_size[os.path.getsize(path)].append(path)
+    same_size = [path for group in by_size.values() if len(group) > 1 for path in group]
+    if not same_size:
+        return paths, {}
+
+    with ThreadPoolExecutor(max_workers=workers or default_worker_count()) as executor:
+        # The partial hash covers the size as well
+        by_partial_hash = defaultdict(list)
+        for path, partial_hash in zip(same_size, executor.map(fast_file_hash, same_size)):
+            by_partial_hash[partial_hash].append(path)
+        same_samples = [path for group in by_partial_hash.values() if len(group) > 1 for path in group]
+
+        by_hash = defaultdict(list)
+        for path, content_hash in zip(same_samples, executor.map(full_file_hash, same_samples)):
+            by_hash[content_hash].append(path)
+
+    duplicates = {}
+    for group in by_hash.values():
+        # The first name is repaired, whatever order the folder was listed in
+        original = min(group)
+        for path in group:
+            if path != original:
+                duplicates[path] = original
+    return [path for path in paths if path not in duplicates], duplicates
+
+
+def check_movie_structure(data, size):
+    # Raise ValueError unless the file is a list of boxes with one valid 'moov' whose tracks
+    # have consistent sample tables and, when the media data is in the file, chunks inside it
+    boxes = list(walk_boxes(data, 0, size))
+    moovs = [box for box in boxes if box.type == b'moov']
+    if len(moovs) != 1:
+        raise ValueError(f"{len(moovs)} 'moov' boxes instead of one.")
+    moov = moovs[0]
+    if not is_valid_container(data, moov):
+        raise ValueError("The 'moov' box is damaged.")
+    has_media_data = any(box.type == b'mdat' for box in boxes)
+
+    traks = find_children(data, moov, b'trak')
+    if not traks:
+        raise ValueError("The 'moov' box has no tracks.")
+    for index, trak in enumerate(traks):
+        stbl = find_child(data, trak, b'mdia', b'minf', b'stbl')
+        stts = stbl and find_child(data, stbl, b'stts')
+        stsz = stbl and find_child(data, stbl, b'stsz')
+        chunk_offsets = stbl and (find_child(data, stbl, b'stco') or find_child(data, stbl, b'co64'))
+        if not stts or not stsz or not chunk_offsets:
+            raise ValueError(f"Track {index + 1} has no sample tables.")
+
+        durations = read_full_box_entries(read_box_payload(data, stts), 'I', fields=2)
+        sample_count = sum(durations[0::2])
+        # 'stsz' holds a default sample size before its entry count
+        stsz_count = int.from_bytes(read_box_payload(data, stsz)[8:12], 'big')
+        if stsz_count != sample_count:
+            raise ValueError(f"Track {index + 1} has {stsz_count} sample sizes for {sample_count} samples.")
+
+        offsets = read_full_box_entries(read_box_payload(data, chunk_offsets), 'I' if chunk_offsets.type == b'stco' else 'Q')
+        if has_media_data and offsets and max(offsets) >= size:
+            raise ValueError(f"Track {index + 1} has chunks past the end of the file.")
+
+
+class VerificationResult(namedtuple('VerificationResult', ['path', 'hash', 'error'])):
+    # The hash of a repaired file and what is wrong with it, or None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+def verify_output(path):
+    # Hash a repaired file and check its box structure in one read: the hash brings the whole
+    # file in through the map and the structure check reads the same pages again
+    content_hash = None
+    with measure_stage("verify", path):
+        try:
+            size = os.path.getsize(path)
+            if size == 0:
+                return VerificationResult(path, None, "The file is empty.")
+            with open(path, 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    content_hash = hash_data(data, size)
+                    add_bytes(read=size)
+                    check_movie_structure(data, size)
+            return VerificationResult(path, content_hash, None)
+        except (OSError, ValueError, IndexError) as e:
+            return VerificationResult(path, content_hash, str(e) or type(e).__name__)
+
+
+def verify_outputs(paths, workers=None):
+    paths = list(paths)
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=workers or default_worker_count()) as executor:
+        return list(executor.map(verify_output, paths))
+
+
+def verify_results(results, log_signal, workers=None):
+    # Verify the files produced by a batch, a list of (job, output path, error), and turn the
+    # outputs that fail into errors
+    outputs = [output for _, output, error in results if error is None and output is not None]
+    verifications = {result.path: result for result in verify_outputs(outputs, workers)}
+
+    verified = []
+    for job, output, error in results:
+        verification = verifications.get(output) if error is None else None
+        if verification is not None:
+            if verification.ok:
+                log_signal.emit(f"Verified {os.path.basename(output)}, blake2b {verification.hash}")
+            else:
+                log_signal.emit(f"Error: {os.path.basename(output)} failed verification: {verification.error}")
+                output, error = None, Exception(f"The repaired file {output} failed verification: {verification.error}")
+        verified.append((job, output, error))
+    return verified
+
+
+def add_duplicate_results(results, duplicates):
+    # Give each duplicate the result of the file repaired in its place. Jobs are paths or
+    # tuples starting with the path, the duplicates get the same kind
+    results_by_path = {job_path(job): (job, output, error) for job, output, error in results}
+    for duplicate, original in duplicates.items():
+        if original not in results_by_path:
+            continue
+        job, output, error = results_by_path[original]
+        duplicate_job = duplicate if isinstance(job, str) else (duplicate,) + tuple(job[1:])
+        results.append((duplicate_job, output, error))
+    return results
+
+
+def log_duplicates(duplicates, log_signal):
+    for duplicate, original in duplicates.items():
+        log_signal.emit(f"Skipping {os.path.basename(duplicate)}, same content as {os.path.basename(original)}.")
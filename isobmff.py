@@ -0,0 +1,219 @@
+import os
+import struct
+from collections import namedtuple
+
+# Box types whose payload is a list of child boxes
+CONTAINER_BOX_TYPES = {
+    b'moov', b'trak', b'mdia', b'minf', b'stbl', b'edts', b'dinf',
+    b'udta', b'mvex', b'moof', b'traf', b'mfra', b'tref', b'clip', b'matt',
+}
+
+# Size of the windows searched backwards from the end of the data when looking for a box type
+BOX_SEARCH_WINDOW = 4 * 1024 * 1024
+
+
+class Box(namedtuple('Box', ['type', 'offset', 'size', 'header_size'])):
+    # A box found in the file: its four character type, where it starts, its total size
+    # including the header and the size of the header (8, or 16 with a 64-bit largesize)
+
+    @property
+    def payload_offset(self):
+        return self.offset + self.header_size
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+
+def is_valid_box_type(box_type):
+    # Box types are four printable ASCII characters (QuickTime also uses 0xA9 as a prefix)
+    return len(box_type) == 4 and all(32 <= c < 127 or c == 0xA9 for c in box_type)
+
+
+def read_box_header(f, offset, end):
+    # Parse the box header at `offset`; the box must fit before `end`
+    f.seek(offset)
+    header = f.read(8)
+    if len(header) < 8:
+        raise ValueError(f"Truncated box header at offset {offset}.")
+
+    size, box_type = struct.unpack('>I4s', header)
+    header_size = 8
+    if size == 1:
+        # 64-bit largesize follows the type
+        largesize = f.read(8)
+        if len(largesize) < 8:
+            raise ValueError(f"Truncated largesize at offset {offset}.")
+        size = struct.unpack('>Q', largesize)[0]
+        header_size = 16
+    elif size == 0:
+        # The box extends to the end of the enclosing space
+        size = end - offset
+
+    if not is_valid_box_type(box_type):
+        raise ValueError(f"Invalid box type {box_type!r} at offset {offset}.")
+    if size < header_size or offset + size > end:
+        raise ValueError(f"Invalid size {size} for box {box_type!r} at offset {offset}.")
+
+    return Box(box_type, offset, size, header_size)
+
+
+def walk_boxes(f, start=0, end=None):
+    # Yield the boxes laid out back to back between start and end, seeking over payloads
+    if end is None:
+        f.seek(0, os.SEEK_END)
+        end = f.tell()
+
+    offset = start
+    while end - offset >= 8:
+        box = read_box_header(f, offset, end)
+        yield box
+        offset = box.end
+
+    # QuickTime may end a list of boxes with a 32-bit zero terminator
+    if offset != end:
+        f.seek(offset)
+        if f.read(end - offset).strip(b'\x00'):
+            raise ValueError(f"{end - offset} trailing bytes after the last box at offset {offset}.")
+
+
+def index_boxes(f, start=0, end=None):
+    # Return the list of boxes between start and end
+    return list(walk_boxes(f, start, end))
+
+
+def is_valid_container(f, box):
+    # A container box is valid when its children exactly fill its payload
+    try:
+        for child in walk_boxes(f, box.payload_offset, box.end):
+            if child.type in CONTAINER_BOX_TYPES and not is_valid_container(f, child):
+                return False
+    except ValueError:
+        return False
+    return True
+
+
+def find_box_type(data, box_type, end=None, window_size=BOX_SEARCH_WINDOW, start=0):
+    # Yield the offsets of box_type in data[start:end] from the last to the first, searching
+    # backwards one window at a time; the windows overlap so a match across a boundary is not missed
+    if end is None:
+        end = len(data)
+
+    while end > start:
+        window_start = max(end - window_size, start)
+        offset = data.rfind(box_type, window_start, end)
+        if offset != -1:
+            yield offset
+            end = offset + len(box_type) - 1
+        elif window_start == start:
+            break
+        else:
+            end = window_start + len(box_type) - 1
+
+
+def locate_moov(data, end=None, start=0):
+    # Return the last 'moov' box in data whose structure is valid, ignoring matches of the
+    # bytes 'moov' inside media data, or None if there is none. Only 'moov' boxes starting
+    # after start are considered
+    if end is None:
+        end = len(data)
+
+    for type_offset in find_box_type(data, b'moov', end, start=start + 4):
+        # The size field comes before the type (a 'moov' never needs a largesize)
+        if type_offset < 4:
+            break
+        try:
+            box = read_box_header(data, type_offset - 4, end)
+        except ValueError:
+            continue
+        if box.type == b'moov' and is_valid_container(data, box):
+            return box
+
+    return None
+
+
+def index_damaged_file(data, end=None):
+    # Index a file whose leading 'mdat' header is damaged: the media data runs from the start
+    # of the file up to a valid 'moov' box, which may be followed by other top level boxes and
+    # by trailing bytes that are not part of the file (returned as the valid data end)
+    if end is None:
+        end = len(data)
+
+    moov = locate_moov(data, end)
+    if moov is None:
+        raise ValueError("Cannot find a valid 'moov' box in the file.")
+
+    boxes = [Box(b'mdat', 0, moov.offset, 16), moov]
+    offset = moov.end
+    while end - offset >= 8:
+        try:
+            box = read_box_header(data, offset, end)
+        except ValueError:
+            break
+        boxes.append(box)
+        offset = box.end
+
+    return boxes, offset
+
+
+def read_box_payload(f, box):
+    f.seek(box.payload_offset)
+    return f.read(box.size - box.header_size)
+
+
+def child_boxes(f, box, skip=0):
+    # Return the children of a container box; skip is the number of bytes of fields that come
+    # before the children (for example the entry count of 'stsd')
+    return index_boxes(f, box.payload_offset + skip, box.end)
+
+
+def find_child(f, box, *path):
+    # Follow path (a sequence of box types) down from box and return the box found, or None
+    for box_type in path:
+        for child in child_boxes(f, box):
+            if child.type == box_type:
+                box = child
+                break
+        else:
+            return None
+    return box
+
+
+def find_children(f, box, box_type):
+    return [child for child in child_boxes(f, box) if child.type == box_type]
+
+
+def make_box(box_type, payload):
+    # Serialize a box, switching to a 64-bit largesize when it does not fit in 32 bits
+    size = 8 + len(payload)
+    if size > 0xFFFFFFFF:
+        return struct.pack('>I4sQ', 1, box_type, size + 8) + payload
+    return struct.pack('>I4s', size, box_type) + payload
+
+
+def make_full_box(box_type, version, flags, payload):
+    return make_box(box_type, struct.pack('>I', (version << 24) | flags) + payload)
+
+
+def find_media_data_start(f, end):
+    # Return the offset of the media data of the first 'mdat' box, walking the top level boxes
+    # from the start of the file and tolerating an 'mdat' whose size does not fit the file
+    # (a recording that was cut short). Returns None when the boxes cannot be walked.
+    offset = 0
+    while end - offset >= 8:
+        f.seek(offset)
+        header = f.read(16)
+        size, box_type = struct.unpack_from('>I4s', header)
+        if not is_valid_box_type(box_type):
+            return None
+        header_size = 16 if size == 1 else 8
+        if box_type == b'mdat':
+            return offset + header_size
+        if size == 1:
+            if len(header) < 16:
+                return None
+            size = struct.unpack_from('>Q', header, 8)[0]
+        if size < header_size or offset + size > end:
+            return None
+        offset += size
+    return None
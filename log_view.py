@@ -0,0 +1,32 @@
+from PyQt6.QtCore import QTimer
+from PyQt6.QtWidgets import QPlainTextEdit
+from batch import LogBuffer
+
+# Lines kept in the log of the window; the oldest are dropped past this
+LOG_MAX_LINES = 5000
+
+# Milliseconds between two updates of the log with the messages logged meanwhile
+LOG_UPDATE_INTERVAL = 100
+
+
+class LogView(QPlainTextEdit):
+    # Read-only log of a window. Workers log to its buffer from any thread and the view adds
+    # what was logged since the last tick in one update, so the window stays responsive and
+    # its memory bounded however much a batch logs
+    def __init__(self, max_lines=LOG_MAX_LINES, interval=LOG_UPDATE_INTERVAL, parent=None):
+        super().__init__(parent)
+        self.setReadOnly(True)
+        self.setMaximumBlockCount(max_lines)
+        self.buffer = LogBuffer(max_lines)
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.update_log)
+        self.timer.start()
+
+    def update_log(self):
+        messages, dropped = self.buffer.drain()
+        if dropped:
+            messages.insert(0, f"... {dropped} lines were logged too fast to show ...")
+        if messages:
+            self.appendPlainText("\n".join(messages))
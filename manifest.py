@@ -0,0 +1,112 @@
+import json
+import os
+import threading
+from analysis_cache import fast_file_hash
+
+# Name of the manifest written to the output folder: one JSON line per record, appended as
+# the batch goes, the last line of an input winning
+MANIFEST_FILE = "repair-manifest.jsonl"
+
+# Manifest of earlier versions, a single JSON object rewritten on every record
+LEGACY_MANIFEST_FILE = "repair-manifest.json"
+
+# Stages recorded for each input file
+STAGE_ANALYZED = "analyzed"
+STAGE_EXTRACTED = "extracted"
+STAGE_MUXED = "muxed"
+STAGE_REPAIRED = "repaired"
+
+
+class JobManifest:
+    # Record of the stage each input file of a batch reached, kept in the output folder so a
+    # re-run after a crash skips the work already done. Inputs are identified by their size,
+    # mtime and hash, so a file that changed since it was recorded is processed again.
+    # Recording appends a line instead of rewriting the manifest, which is compacted to one
+    # line per input when it is loaded
+    def __init__(self, directory):
+        self.path = os.path.join(directory, MANIFEST_FILE)
+        self.legacy_path = os.path.join(directory, LEGACY_MANIFEST_FILE)
+        self.lock = threading.Lock()
+        self.entries = {}
+        line_count = 0
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    line_count += 1
+                    try:
+                        record = json.loads(line)
+                        self.entries[record.pop('path')] = record
+                    except (ValueError, KeyError, AttributeError):
+                        # A line cut short by a crash while it was appended
+                        continue
+        except OSError:
+            try:
+                with open(self.legacy_path, 'r') as f:
+                    self.entries = json.load(f)
+                line_count = -1
+            except (OSError, ValueError):
+                pass
+        if line_count != len(self.entries):
+            self._compact()
+
+    def _unchanged_entry(self, input_path):
+        # Return the entry of input_path if the file did not change since it was recorded
+        key = os.path.abspath(input_path)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        try:
+            stat = os.stat(input_path)
+        except OSError:
+            return None
+        if stat.st_size != entry['size']:
+            return None
+        if stat.st_mtime_ns != entry['mtime_ns']:
+            # The file was touched, check whether its content changed
+            if fast_file_hash(input_path) != entry['hash']:
+                return None
+            entry['mtime_ns'] = stat.st_mtime_ns
+
+        return entry
+
+    def stage(self, input_path, reference=None):
+        # Return the stage reached by input_path and the outputs recorded for it, or
+        # (None, {}) if it was never processed, changed since, or used another reference
+        with self.lock:
+            entry = self._unchanged_entry(input_path)
+            if entry is None or entry.get('reference') != reference:
+                return None, {}
+            return entry['stage'], dict(entry.get('outputs', {}))
+
+    def record(self, input_path, stage, reference=None, **outputs):
+        # Record that input_path reached stage, with the paths of the files it produced
+        with self.lock:
+            key = os.path.abspath(input_path)
+            entry = self._unchanged_entry(input_path)
+            if entry is None:
+                stat = os.stat(input_path)
+                entry = {
+                    'size': stat.st_size,
+                    'mtime_ns': stat.st_mtime_ns,
+                    'hash': fast_file_hash(input_path),
+                    'outputs': {},
+                }
+                self.entries[key] = entry
+
+            entry['stage'] = stage
+            entry['reference'] = reference
+            entry['outputs'].update(outputs)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(dict(entry, path=key)) + "\n")
+
+    def _compact(self):
+        # Rewrite the manifest with one line per input. Write to a temporary file and move it in
+        # place so a crash never leaves half a manifest
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w') as f:
+            for key, entry in self.entries.items():
+                f.write(json.dumps(dict(entry, path=key)) + "\n")
+        os.replace(temporary_path, self.path)
+        if os.path.exists(self.legacy_path):
+            os.remove(self.legacy_path)
@@ -0,0 +1,353 @@
+import re
+from array import array
+from avc import (
+    NAL_IDR_SLICE, NAL_PPS, NAL_SPS, PictureOrderCounter, VCL_NAL_TYPES, ANNEX_B_START_CODE,
+    is_valid_nal_header, slice_pic_order_cnt_lsb, starts_access_unit,
+)
+
+try:
+    # Optional: searches damaged data a whole window at a time instead of match by match
+    import numpy
+except ImportError:
+    numpy = None
+
+# Bytes scanned between two progress reports
+SCAN_PROGRESS_INTERVAL = 8 * 1024 * 1024
+
+# Bytes searched at a time when looking for the next access unit after damaged data
+RESYNC_FIRST_WINDOW = 64 * 1024
+RESYNC_WINDOW = 4 * 1024 * 1024
+
+# Number of units that must follow a candidate found after damaged data
+RESYNC_DEPTH = 3
+
+# Largest NAL unit accepted, well above the largest coded picture of a 4K camera. Bounding the
+# length makes random bytes much less likely to pass for a length prefix
+MAX_NAL_SIZE = 64 * 1024 * 1024
+
+# NAL unit types an access unit usually starts with: AUD, SPS, SEI, or an IDR slice
+RESYNC_NAL_TYPES = (9, 7, 6, 5)
+
+# Bytes of Annex-B data handed to the writer at a time
+ANNEX_B_BATCH_SIZE = 1024 * 1024
+
+
+class NalCandidateFinder:
+    # Finds the positions where a NAL length prefix followed by the header of a NAL unit that
+    # starts an access unit could begin. Every candidate still has to be checked, this only
+    # narrows gigabytes of damaged data down to a few positions per megabyte
+    def __init__(self, length_size, check_next_nal=True):
+        # check_next_nal also requires a valid NAL header right after the candidate NAL unit,
+        # which only holds when no chunks of other tracks sit between NAL units
+        self.length_size = length_size
+        self.check_next_nal = check_next_nal
+        headers = bytes(ref_idc << 5 | nal_type for nal_type in RESYNC_NAL_TYPES for ref_idc in range(4))
+
+        # Lengths of 4 byte prefixes stay below 16 MiB, so their first byte is zero
+        prefix = rb'\x00' + b'.' * (length_size - 1) if length_size > 2 else b'.' * length_size
+        self.pattern = re.compile(prefix + b'[' + re.escape(headers) + b']', re.DOTALL)
+
+        if numpy is not None:
+            self.start_headers = numpy.zeros(256, dtype=bool)
+            self.start_headers[list(headers)] = True
+            self.valid_headers = numpy.array([is_valid_nal_header(byte) for byte in range(256)])
+
+    def find(self, data, start, end):
+        # Yield the candidate positions in data[start:end], in order. Windows overlap by the
+        # length of a prefix and header so candidates across window edges are not missed
+        # The next access unit is usually close, so the windows start small and grow
+        position = start
+        window_size = RESYNC_FIRST_WINDOW
+        while position < end:
+            window_end = min(position + window_size, end)
+            window_size = min(window_size * 2, RESYNC_WINDOW)
+            if numpy is not None:
+                yield from self._find_numpy(data, position, window_end, end)
+            else:
+                # Matches may overlap, so each search starts one byte after the last match
+                read_end = min(window_end + self.length_size + 1, end)
+                match = self.pattern.search(data, position, read_end)
+                while match is not None and match.start() < window_end:
+                    yield match.start()
+                    match = self.pattern.search(data, match.start() + 1, read_end)
+            position = window_end
+
+    def _find_numpy(self, data, position, window_end, end):
+        length_size = self.length_size
+        # A zero-copy view of the rest of the data, so the NAL following a candidate can be read
+        view = numpy.frombuffer(data, dtype=numpy.uint8, count=end - position, offset=position)
+        count = min(window_end - position, len(view) - length_size)
+        if count <= 0:
+            return
+
+        if length_size > 2:
+            # Test the rare zero byte first, then the header of the few positions left
+            indexes = numpy.flatnonzero(view[:count] == 0)
+            indexes = indexes[self.start_headers.take(view[indexes + length_size])]
+        else:
+            indexes = numpy.flatnonzero(self.start_headers.take(view[length_size:length_size + count]))
+
+        # The length must be set and fit the data
+        lengths = numpy.zeros(len(indexes), dtype=numpy.int64)
+        for byte in range(length_size):
+            lengths = (lengths << 8) | view[indexes + byte]
+        next_positions = indexes + length_size + lengths
+        keep = (lengths > 0) & (lengths <= MAX_NAL_SIZE) & (next_positions <= len(view))
+        indexes, next_positions = indexes[keep], next_positions[keep]
+
+        if self.check_next_nal:
+            # Followed by the end of the data or by another NAL unit with a valid header
+            followed = next_positions == len(view)
+            inside = next_positions + length_size < len(view)
+            next_headers = view[numpy.where(inside, next_positions + length_size, 0)]
+            indexes = indexes[followed | (inside & self.valid_headers[next_headers])]
+
+        for index in indexes.tolist():
+            yield position + index
+
+
+def is_nal_chain(data, position, end, length_size, depth):
+    # Whether depth NAL units with valid headers follow each other from position, or run up
+    # to the end of the data, without knowing anything else about the stream
+    for _ in range(depth):
+        if position == end:
+            return True
+        header_position = position + length_size
+        if header_position >= end:
+            return False
+        length = int.from_bytes(data[position:header_position], 'big')
+        if not 0 < length <= MAX_NAL_SIZE or not is_valid_nal_header(data[header_position]):
+            return False
+        position = header_position + length
+        if position > end:
+            return False
+    return True
+
+
+class TrackChunks:
+    # The chunks of a track with constant size samples (PCM audio, timed metadata)
+    def __init__(self, track):
+        self.track = track
+        self.offsets = array('Q')
+        self.sizes = array('L')
+
+    @property
+    def total_size(self):
+        return sum(self.sizes)
+
+
+class MediaScan:
+    # Where the samples of each track lie in the media data of a file that lost its index
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+
+        # Video samples (access units) in decoding order
+        self.sample_offsets = array('Q')
+        self.sample_sizes = array('L')
+        self.keyframes = array('L')  # 1-based sample numbers, as in 'stss'
+        self.pocs = array('l')  # Picture order counts, empty when the stream does not signal them
+
+        # Runs of contiguous video samples: chunk offsets and number of samples in each chunk
+        self.chunk_offsets = array('Q')
+        self.chunk_sample_counts = array('L')
+
+        self.fixed_chunks = {}  # TrackChunks by track index
+        self.skipped_bytes = 0  # Damaged bytes that were skipped to find the next access unit
+
+    @property
+    def sample_count(self):
+        return len(self.sample_offsets)
+
+
+class MediaScanner:
+    def __init__(self, data, start, end, profile):
+        self.data = data
+        self.start = start
+        self.end = end
+        self.video = profile.video
+        if self.video is None:
+            raise ValueError("The reference file has no H.264 video track.")
+        self.length_size = self.video.nal_length_size
+        self.sequence = self.video.sequence
+
+        # Sizes of the chunks of the constant sample size tracks, most common first
+        self.fixed_sizes = [
+            (track, size) for track in profile.fixed_tracks for size in track.chunk_sizes
+        ]
+
+        self.candidates = NalCandidateFinder(self.length_size, check_next_nal=not self.fixed_sizes)
+
+    def nal_end(self, position):
+        # Return the end of the NAL unit whose length prefix starts at position, or None when
+        # the bytes there cannot be one
+        header_position = position + self.length_size
+        if header_position >= self.end:
+            return None
+        length = int.from_bytes(self.data[position:header_position], 'big')
+        end = header_position + length
+        if not 0 < length <= MAX_NAL_SIZE or end > self.end or not is_valid_nal_header(self.data[header_position]):
+            return None
+        return end
+
+    def is_boundary(self, position, depth=1):
+        # Whether a NAL unit or a constant size chunk can start at position, checking the
+        # next `depth` units as well so random bytes are rarely mistaken for one. A chunk is
+        # only accepted when a NAL unit follows it
+        if position == self.end:
+            return True
+        end = self.nal_end(position)
+        if end is not None and (depth == 0 or self.is_boundary(end, depth - 1)):
+            return True
+        for _, size in self.fixed_sizes:
+            chunk_end = position + size
+            if chunk_end == self.end or (chunk_end < self.end and (
+                self.is_boundary(chunk_end, depth - 1) if depth else self.nal_end(chunk_end) is not None
+            )):
+                return True
+        return False
+
+    def fixed_chunk_at(self, position):
+        # Return (track, size) of the constant size chunk starting at position, if any
+        for track, size in self.fixed_sizes:
+            chunk_end = position + size
+            if chunk_end <= self.end and (chunk_end == self.end or self.is_boundary(chunk_end)):
+                return track, size
+        return None
+
+    def resync(self, position):
+        # Return the next position after damaged data where an access unit starts. Candidates
+        # are checked deeper than NAL units on the normal path, since most of them are random
+        for candidate in self.candidates.find(self.data, position, self.end):
+            end = self.nal_end(candidate)
+            if end is not None and self.is_boundary(end, RESYNC_DEPTH):
+                return candidate
+        return self.end
+
+    def scan(self, progress=None):
+        scan = MediaScan(self.start, self.end)
+        data = self.data
+        length_size = self.length_size
+        counter = PictureOrderCounter(self.sequence) if self.sequence and self.sequence.pic_order_cnt_type == 0 else None
+
+        sample_start = None  # Start of the access unit being read
+        sample_has_slice = False
+        last_sample_end = None
+        reported = position = self.start
+
+        def close_sample(sample_end):
+            nonlocal sample_start, sample_has_slice, last_sample_end
+            if sample_start is not None and sample_has_slice:
+                if sample_start != last_sample_end:
+                    scan.chunk_offsets.append(sample_start)
+                    scan.chunk_sample_counts.append(0)
+                scan.chunk_sample_counts[-1] += 1
+                scan.sample_offsets.append(sample_start)
+                scan.sample_sizes.append(sample_end - sample_start)
+                last_sample_end = sample_end
+            sample_start = None
+            sample_has_slice = False
+
+        while position < self.end:
+            if progress is not None and position - reported >= SCAN_PROGRESS_INTERVAL:
+                progress(position - reported)
+                reported = position
+
+            end = self.nal_end(position)
+            if end is None or not self.is_boundary(end):
+                close_sample(position)
+
+                # Chunks of the other tracks sit between runs of video samples
+                chunk = self.fixed_chunk_at(position) if self.fixed_sizes else None
+                if chunk is not None:
+                    track, size = chunk
+                    chunks = scan.fixed_chunks.setdefault(track.index, TrackChunks(track))
+                    chunks.offsets.append(position)
+                    chunks.sizes.append(size)
+                    position += size
+                    continue
+
+                next_position = self.resync(position + 1)
+                scan.skipped_bytes += next_position - position
+                position = next_position
+                continue
+
+            header = data[position + length_size]
+            first_payload_byte = data[position + length_size + 1] if end > position + length_size + 1 else 0
+            if sample_start is None or starts_access_unit(header, first_payload_byte, sample_has_slice):
+                close_sample(position)
+                sample_start = position
+
+            nal_type = header & 0x1F
+            if nal_type in VCL_NAL_TYPES and not sample_has_slice:
+                sample_has_slice = True
+                if nal_type == NAL_IDR_SLICE:
+                    scan.keyframes.append(len(scan.sample_offsets) + 1)
+                if counter is not None:
+                    nal = data[position + length_size:min(end, position + length_size + 48)]
+                    try:
+                        lsb = slice_pic_order_cnt_lsb(nal, self.sequence)
+                    except (IndexError, ValueError):
+                        lsb = 0
+                    scan.pocs.append(counter.next(lsb, nal_type == NAL_IDR_SLICE, bool(header & 0x60)))
+            position = end
+
+        close_sample(position)
+        if counter is not None and len(scan.pocs) != scan.sample_count:
+            # A slice header could not be read for every sample, so the counts cannot be trusted
+            scan.pocs = array('l')
+        if progress is not None and position > reported:
+            progress(position - reported)
+        return scan
+
+
+def scan_media_data(data, start, end, profile, progress=None):
+    # Find the H.264 access units and the chunks of the constant sample size tracks stored
+    # in data[start:end], using the codec parameters of the reference profile.
+    # progress(byte_count) is called as the scan goes
+    return MediaScanner(data, start, end, profile).scan(progress)
+
+
+def write_annex_b(data, scan, video, write):
+    # Write the video samples as an Annex-B elementary stream, the format ffmpeg's h264
+    # demuxer reads. SPS and PPS from the reference go before every keyframe that lacks them
+    length_size = video.nal_length_size
+    parameter_sets = b''.join(ANNEX_B_START_CODE + nal for nal in video.sps + video.pps)
+    keyframes = set(scan.keyframes)
+    batch = bytearray()
+
+    for number, (offset, size) in enumerate(zip(scan.sample_offsets, scan.sample_sizes), 1):
+        sample_end = offset + size
+        nals = []
+        has_parameter_sets = False
+        position = offset
+        while position + length_size <= sample_end:
+            length = int.from_bytes(data[position:position + length_size], 'big')
+            position += length_size
+            nals.append((position, position + length))
+            if data[position] & 0x1F in (NAL_SPS, NAL_PPS):
+                has_parameter_sets = True
+            position += length
+
+        if number in keyframes and not has_parameter_sets:
+            # Keep an access unit delimiter first
+            if nals and data[nals[0][0]] & 0x1F == 9:
+                batch += ANNEX_B_START_CODE
+                batch += data[nals[0][0]:nals[0][1]]
+                nals = nals[1:]
+            batch += parameter_sets
+        for nal_start, nal_end in nals:
+            batch += ANNEX_B_START_CODE
+            batch += data[nal_start:nal_end]
+
+        if len(batch) >= ANNEX_B_BATCH_SIZE:
+            write(batch)
+            batch = bytearray()
+    if batch:
+        write(batch)
+
+
+def write_track_chunks(data, chunks, write):
+    # Write the chunks of a constant sample size track back to back, e.g. raw PCM audio
+    for offset, size in zip(chunks.offsets, chunks.sizes):
+        write(data[offset:offset + size])
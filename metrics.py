@@ -0,0 +1,225 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# Measurements of each stage of each repaired file: wall time, bytes read and written, by this
+# process and by the commands it ran, and the CPU time of those commands. Nothing is measured
+# until enable_metrics() is called; until then a stage costs a global lookup
+
+# Prefix of the Prometheus metric names
+PROMETHEUS_PREFIX = "video_repair_stage"
+
+# Where Linux counts the bytes each thread read and wrote through system calls
+THREAD_IO_PATH = "/proc/thread-self/io"
+
+_recorder = None
+_current = threading.local()
+
+
+class StageRecord:
+    # What one stage did to one file
+    __slots__ = ('path', 'stage', 'start', 'seconds', 'bytes_read', 'bytes_written', 'subprocess_cpu', 'error')
+
+    def __init__(self, path, stage):
+        self.path = path
+        self.stage = stage
+        self.start = time.time()
+        self.seconds = 0.0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.subprocess_cpu = 0.0
+        self.error = None
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class MetricsRecorder:
+    # Collects the records of the stages from every worker thread
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.records = []
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def totals(self):
+        # Sums of the records by stage
+        totals = {}
+        with self.lock:
+            for record in self.records:
+                stage = totals.setdefault(record.stage, {
+                    'seconds': 0.0, 'bytes_read': 0, 'bytes_written': 0, 'subprocess_cpu': 0.0, 'files': 0, 'errors': 0,
+                })
+                stage['seconds'] += record.seconds
+                stage['bytes_read'] += record.bytes_read
+                stage['bytes_written'] += record.bytes_written
+                stage['subprocess_cpu'] += record.subprocess_cpu
+                stage['files'] += 1
+                stage['errors'] += record.error is not None
+        return totals
+
+    def write_json_lines(self, path):
+        with self.lock:
+            lines = [json.dumps(record.as_dict()) + "\n" for record in self.records]
+        write_atomically(path, "".join(lines))
+
+    def write_prometheus(self, path):
+        # Counters by stage in the text format read by the node exporter textfile collector
+        metrics = [
+            ('seconds_total', 'seconds', "Wall time spent in the stage."),
+            ('bytes_read_total', 'bytes_read', "Bytes read by the stage and the commands it ran."),
+            ('bytes_written_total', 'bytes_written', "Bytes written by the stage and the commands it ran."),
+            ('subprocess_cpu_seconds_total', 'subprocess_cpu', "CPU time of the commands run by the stage."),
+            ('files_total', 'files', "Files that went through the stage."),
+            ('errors_total', 'errors', "Files the stage failed on."),
+        ]
+        totals = self.totals()
+        lines = []
+        for suffix, key, description in metrics:
+            name = f"{PROMETHEUS_PREFIX}_{suffix}"
+            lines.append(f"# HELP {name} {description}\n# TYPE {name} counter\n")
+            for stage, values in sorted(totals.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {values[key]}\n')
+        write_atomically(path, "".join(lines))
+
+    def write(self, path):
+        # The format follows the extension: Prometheus for .prom, JSON lines otherwise
+        if path.endswith(".prom"):
+            self.write_prometheus(path)
+        else:
+            self.write_json_lines(path)
+
+    def report(self):
+        lines = []
+        for stage, values in self.totals().items():
+            lines.append(
+                f"Stage '{stage}': {values['files']} files, {values['seconds']:.1f}s, "
+                f"{values['bytes_read'] / 1e6:.1f} MB read, {values['bytes_written'] / 1e6:.1f} MB written, "
+                f"{values['subprocess_cpu']:.1f}s CPU in commands"
+            )
+        return lines
+
+
+def write_atomically(path, text):
+    # Write to a temporary file and move it in place so a reader never sees half a file
+    temporary_path = path + ".tmp"
+    with open(temporary_path, 'w') as f:
+        f.write(text)
+    os.replace(temporary_path, path)
+
+
+def enable_metrics(recorder=None):
+    # Start measuring the stages into recorder, or a new one, and return it
+    global _recorder
+    _recorder = recorder if recorder is not None else MetricsRecorder()
+    return _recorder
+
+
+def disable_metrics():
+    global _recorder
+    recorder, _recorder = _recorder, None
+    return recorder
+
+
+def metrics_recorder():
+    # The recorder of the measurements, or None when metrics are disabled
+    return _recorder
+
+
+def read_io_counters(path):
+    # rchar and wchar of a thread or process, or None where they are not available
+    try:
+        with open(path, 'r') as f:
+            counters = dict(line.split(':') for line in f)
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def job_path(job):
+    # The file a job of a batch or a pipeline works on
+    return job if isinstance(job, str) else job[0]
+
+
+@contextmanager
+def _measure(recorder, stage, path):
+    record = StageRecord(path, stage)
+    outer = getattr(_current, 'record', None)
+    _current.record = record
+    io_before = read_io_counters(THREAD_IO_PATH)
+    start = time.perf_counter()
+    try:
+        yield record
+    except Exception as e:
+        record.error = str(e)
+        raise
+    finally:
+        record.seconds = time.perf_counter() - start
+        io_after = read_io_counters(THREAD_IO_PATH)
+        if io_before is not None and io_after is not None:
+            record.bytes_read += io_after[0] - io_before[0]
+            record.bytes_written += io_after[1] - io_before[1]
+        _current.record = outer
+        recorder.add(record)
+
+
+def measure_stage(stage, job):
+    # Context manager measuring one stage of the file of job, a no-op when metrics are disabled
+    recorder = _recorder
+    if recorder is None or stage is None:
+        return nullcontext()
+    return _measure(recorder, stage, job_path(job))
+
+
+def add_bytes(read=0, written=0):
+    # Count bytes the system calls do not see, such as those read through a memory map
+    record = getattr(_current, 'record', None)
+    if record is not None:
+        record.bytes_read += read
+        record.bytes_written += written
+
+
+def wants_command_usage():
+    return getattr(_current, 'record', None) is not None
+
+
+def add_command_usage(pid):
+    # Count the CPU time and the bytes read and written by a command that has exited but was
+    # not reaped yet, so its /proc entry is still there. Linux only
+    record = getattr(_current, 'record', None)
+    if record is None:
+        return
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            # utime, stime, cutime and cstime follow the command name, which may hold spaces
+            fields = f.read().rsplit(')', 1)[1].split()
+        record.subprocess_cpu += sum(int(field) for field in fields[11:15]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, IndexError, ValueError):
+        return
+    counters = read_io_counters(f"/proc/{pid}/io")
+    if counters is not None:
+        record.bytes_read += counters[0]
+        record.bytes_written += counters[1]
+
+
+@contextmanager
+def profiled(path=None):
+    # Run the block under cProfile, then save the statistics to path or print the functions
+    # that took the most time
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield profiler
+    finally:
+        profiler.disable()
+        if path:
+            profiler.dump_stats(path)
+        else:
+            pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(30)
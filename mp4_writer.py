@@ -0,0 +1,312 @@
+import io
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+from urllib.parse import quote
+from isobmff import child_boxes, index_boxes, make_box, make_full_box, read_box_payload
+from reference_profile import TRACK_FIXED, TRACK_VIDEO
+from videorepair import copy_file_range_to
+
+# Boxes of the reference 'moov' that describe its own samples or tracks; the rebuilt 'moov'
+# leaves them out and writes fresh sample tables
+DROPPED_TRACK_BOXES = {b'edts', b'tref'}
+DROPPED_MOVIE_BOXES = {b'mvex', b'iods'}
+
+
+def pack_entries(values, entry_format='I'):
+    # Serialize a sequence of integers as big-endian entries of a sample table
+    entries = array(entry_format, values)
+    if sys.byteorder == 'little':
+        entries.byteswap()
+    return entries.tobytes()
+
+
+def table_box(box_type, entries, entry_count, entry_format='I'):
+    # A full box made of an entry count followed by the entries
+    return make_full_box(box_type, 0, 0, struct.pack('>I', entry_count) + pack_entries(entries, entry_format))
+
+
+def run_length_pairs(values):
+    # Return the (count, value) pairs of the runs of equal values, flattened as 'stts' and
+    # 'ctts' store them
+    pairs = array('I')
+    count = 0
+    previous = None
+    for value in values:
+        if value == previous:
+            count += 1
+            continue
+        if count:
+            pairs.append(count)
+            pairs.append(previous)
+        previous = value
+        count = 1
+    if count:
+        pairs.append(count)
+        pairs.append(previous)
+    return pairs
+
+
+def chunk_runs(samples_per_chunk):
+    # Return the 'stsc' entries (first chunk, samples per chunk, sample description index)
+    # of the runs of chunks holding the same number of samples
+    entries = array('I')
+    previous = None
+    for number, count in enumerate(samples_per_chunk, 1):
+        if count != previous:
+            entries.extend((number, count, 1))
+            previous = count
+    return entries
+
+
+class TrackTable:
+    # The sample table rebuilt for one track from the samples found in the media data
+    def __init__(self, track):
+        self.track = track
+        self.sample_count = 0
+        self.stts = array('I')  # (sample count, sample delta) pairs
+        self.ctts = None  # (sample count, composition offset) pairs, None without reordering
+        self.stss = None  # Sync sample numbers, None when every sample is a sync sample
+        self.stsc = array('I')
+        self.sample_size = 0  # Size of every sample, or 0 when sample_sizes lists them
+        self.sample_sizes = None
+        self.chunk_offsets = array('Q')
+        self.duration = 0  # In the media timescale
+        self.media_time = 0  # First presented media time, for the edit list
+
+    def box(self, offset_delta=0):
+        # Serialize the tables as the children of an 'stbl', after its 'stsd'
+        boxes = [table_box(b'stts', self.stts, len(self.stts) // 2)]
+        if self.ctts is not None:
+            boxes.append(table_box(b'ctts', self.ctts, len(self.ctts) // 2))
+        if self.stss is not None:
+            boxes.append(table_box(b'stss', self.stss, len(self.stss)))
+        boxes.append(table_box(b'stsc', self.stsc, len(self.stsc) // 3))
+        stsz = struct.pack('>II', self.sample_size, self.sample_count)
+        if self.sample_sizes is not None:
+            stsz += pack_entries(self.sample_sizes)
+        boxes.append(make_full_box(b'stsz', 0, 0, stsz))
+
+        chunk_offsets = array('Q', (offset + offset_delta for offset in self.chunk_offsets))
+        if chunk_offsets and max(chunk_offsets) > 0xFFFFFFFF:
+            boxes.append(table_box(b'co64', chunk_offsets, len(chunk_offsets), 'Q'))
+        else:
+            boxes.append(table_box(b'stco', chunk_offsets, len(chunk_offsets), 'I'))
+        return b''.join(boxes)
+
+
+def presentation_ranks(pocs, keyframes):
+    # Return the position of each sample in presentation order. Picture order counts restart
+    # at every IDR picture, so samples are only reordered within the run between two of them
+    ranks = array('L', [0]) * len(pocs)
+    boundaries = [number - 1 for number in keyframes if number > 1] + [len(pocs)]
+    start = 0
+    for end in boundaries:
+        order = sorted(range(start, end), key=pocs.__getitem__)
+        for rank, index in enumerate(order, start):
+            ranks[index] = rank
+        start = end
+    return ranks
+
+
+def video_table(track, scan):
+    table = TrackTable(track)
+    count = scan.sample_count
+    duration = track.sample_duration
+    table.sample_count = count
+    table.stts = array('I', (count, duration)) if count else array('I')
+    table.duration = count * duration
+    if len(scan.keyframes) < count:
+        table.stss = scan.keyframes
+    table.stsc = chunk_runs(scan.chunk_sample_counts)
+    table.sample_sizes = scan.sample_sizes
+    table.chunk_offsets = scan.chunk_offsets
+
+    # Composition offsets from the picture order counts, when B-frames reorder the pictures.
+    # Offsets must not be negative, so presentation starts `delay` frames late and an edit
+    # list skips that delay
+    if scan.pocs:
+        ranks = presentation_ranks(scan.pocs, scan.keyframes)
+        delay = max(index - rank for index, rank in enumerate(ranks))
+        if any(index != rank for index, rank in enumerate(ranks)):
+            table.ctts = run_length_pairs((rank - index + delay) * duration for index, rank in enumerate(ranks))
+            table.media_time = delay * duration
+    return table
+
+
+def fixed_table(track, chunks):
+    # Constant size samples: one 'stsz' size for all and the number of samples of each chunk
+    table = TrackTable(track)
+    samples_per_chunk = array('L', (size // track.bytes_per_sample for size in chunks.sizes))
+    table.sample_count = sum(samples_per_chunk)
+    table.stts = array('I', (table.sample_count, track.sample_duration)) if table.sample_count else array('I')
+    table.duration = table.sample_count * track.sample_duration
+    table.stsc = chunk_runs(samples_per_chunk)
+    table.sample_size = track.stsz_sample_size
+    table.chunk_offsets = chunks.offsets
+    return table
+
+
+def build_tables(profile, scan):
+    # Return the rebuilt tables by track index; tracks whose samples were not found are left out
+    tables = {}
+    for track in profile.tracks:
+        if track.kind == TRACK_VIDEO and track is profile.video:
+            tables[track.index] = video_table(track, scan)
+        elif track.kind == TRACK_FIXED and track.index in scan.fixed_chunks:
+            tables[track.index] = fixed_table(track, scan.fixed_chunks[track.index])
+    return tables
+
+
+def patch_duration(payload, version_1_offset, version_0_offset, duration):
+    # Replace the duration field of an 'mvhd', 'tkhd' or 'mdhd' payload
+    payload = bytearray(payload)
+    if payload[0] == 1:
+        struct.pack_into('>Q', payload, version_1_offset, duration)
+    else:
+        struct.pack_into('>I', payload, version_0_offset, min(duration, 0xFFFFFFFF))
+    return bytes(payload)
+
+
+def data_reference_box(url=None):
+    # A 'dinf' whose data reference is the file itself or, for a sidecar index, the file at url
+    if url is None:
+        entry = make_full_box(b'url ', 0, 1, b'')
+    else:
+        entry = make_full_box(b'url ', 0, 0, url.encode('utf-8') + b'\x00')
+    return make_box(b'dinf', make_full_box(b'dref', 0, 0, struct.pack('>I', 1) + entry))
+
+
+def rebuild_container(data, box, rewrite):
+    # Rebuild a container box, replacing each child with rewrite(child), which returns the
+    # bytes of the new child or None to leave it out
+    children = []
+    for child in child_boxes(data, box):
+        rebuilt = rewrite(child)
+        if rebuilt is not None:
+            children.append(rebuilt)
+    return make_box(box.type, b''.join(children))
+
+
+def raw_box(data, box):
+    data.seek(box.offset)
+    return data.read(box.size)
+
+
+def build_moov(profile, scan, offset_delta=0, data_url=None):
+    # Build a 'moov' for the samples found by the scan, with the reference 'moov' as a template:
+    # its sample descriptions, handlers and metadata are kept while the sample tables, the
+    # durations and the edit lists are rebuilt. offset_delta moves the chunk offsets when the
+    # media data is written at another position; data_url makes a sidecar index whose samples
+    # stay in another file
+    tables = build_tables(profile, scan)
+    movie_timescale = profile.movie_timescale
+    movie_durations = {
+        index: table.duration * movie_timescale // max(table.track.timescale, 1)
+        for index, table in tables.items()
+    }
+
+    data = io.BytesIO(profile.moov)
+    moov = index_boxes(data, 0, len(profile.moov))[0]
+    trak_index = 0
+
+    def rewrite_stbl(child, table):
+        if child.type == b'stsd':
+            return raw_box(data, child) + table.box(offset_delta)
+        return None
+
+    def rewrite_minf(child, table):
+        if child.type == b'dinf':
+            return data_reference_box(data_url)
+        if child.type == b'stbl':
+            stsd = next(box for box in child_boxes(data, child) if box.type == b'stsd')
+            return make_box(b'stbl', rewrite_stbl(stsd, table))
+        return raw_box(data, child)
+
+    def rewrite_mdia(child, table):
+        if child.type == b'mdhd':
+            return make_box(b'mdhd', patch_duration(read_box_payload(data, child), 24, 16, table.duration))
+        if child.type == b'minf':
+            return rebuild_container(data, child, lambda box: rewrite_minf(box, table))
+        return raw_box(data, child)
+
+    def rewrite_trak(child, table, movie_duration):
+        if child.type == b'tkhd':
+            tkhd = make_box(b'tkhd', patch_duration(read_box_payload(data, child), 28, 20, movie_duration))
+            if not table.media_time:
+                return tkhd
+            # Start the presentation at the first displayed frame
+            elst = struct.pack('>IIIhh', 1, movie_duration, table.media_time, 1, 0)
+            return tkhd + make_box(b'edts', make_full_box(b'elst', 0, 0, elst))
+        if child.type in DROPPED_TRACK_BOXES:
+            return None
+        if child.type == b'mdia':
+            return rebuild_container(data, child, lambda box: rewrite_mdia(box, table))
+        return raw_box(data, child)
+
+    def rewrite_moov(child):
+        nonlocal trak_index
+        if child.type == b'mvhd':
+            duration = max(movie_durations.values(), default=0)
+            return make_box(b'mvhd', patch_duration(read_box_payload(data, child), 24, 16, duration))
+        if child.type == b'trak':
+            index = trak_index
+            trak_index += 1
+            if index not in tables:
+                return None
+            return rebuild_container(data, child, lambda box: rewrite_trak(box, tables[index], movie_durations[index]))
+        if child.type in DROPPED_MOVIE_BOXES:
+            return None
+        return raw_box(data, child)
+
+    return rebuild_container(data, moov, rewrite_moov)
+
+
+# A rebuilt 'moov' is written either to a repaired copy or to a sidecar index. Nothing appends
+# it to the corrupt file: the in-place repair of videorepair only rewrites the 'mdat' header of
+# a file whose 'moov' survived, so a file without one always gets a new file
+
+
+def write_repaired_copy(profile, scan, media_path, output_path, progress=None):
+    # Write a playable file: the reference 'ftyp', the media data copied from the corrupt file
+    # by the kernel and a rebuilt 'moov'. Nothing is decoded or remuxed
+    length = scan.end - scan.start
+    payload_start = len(profile.ftyp) + 16
+    moov = build_moov(profile, scan, offset_delta=payload_start - scan.start)
+
+    with open(media_path, 'rb') as source, open(output_path, 'wb') as destination:
+        destination.write(profile.ftyp)
+        destination.write(struct.pack('>I4sQ', 1, b'mdat', 16 + length))
+        copied = copy_file_range_to(source, destination, scan.start, length, progress=progress)
+        if copied != length:
+            raise Exception(f"Copied {copied} of {length} bytes of media data from {media_path}")
+        destination.write(moov)
+    return output_path
+
+
+def sidecar_location(media_path, output_path):
+    # The location of the corrupt file written in a sidecar index: a URL relative to the index
+    # when the corrupt file is in its folder or in a folder above it, as with the default
+    # Repaired folder, so the files can be moved together; else an absolute file URI
+    media_path = os.path.abspath(media_path)
+    output_directory = os.path.dirname(os.path.abspath(output_path))
+    media_directory = os.path.dirname(media_path)
+    try:
+        if os.path.commonpath([media_directory, output_directory]) == media_directory:
+            return quote(os.path.relpath(media_path, output_directory).replace(os.sep, '/'))
+    except ValueError:
+        # On different drives
+        pass
+    return Path(media_path).as_uri()
+
+
+def write_sidecar_index(profile, scan, media_path, output_path):
+    # Write a small movie file holding only the 'ftyp' and a 'moov' whose data reference points
+    # at the corrupt file, which is left untouched
+    moov = build_moov(profile, scan, data_url=sidecar_location(media_path, output_path))
+    with open(output_path, 'wb') as f:
+        f.write(profile.ftyp)
+        f.write(moov)
+    return output_path
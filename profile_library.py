@@ -0,0 +1,225 @@
+import json
+import mmap
+import os
+from collections import Counter
+from analysis_cache import fast_file_hash
+from avc import NAL_IDR_SLICE, NAL_SPS, VCL_NAL_TYPES, is_valid_nal_header
+from isobmff import find_media_data_start
+from mdat_scanner import MAX_NAL_SIZE, NalCandidateFinder, is_nal_chain
+from reference_profile import TRACK_FIXED, TRACK_UNSUPPORTED, read_reference_profile
+
+# Default location of the library, can be overridden with the VIDEO_REPAIR_PROFILES environment variable
+DEFAULT_LIBRARY_DIRECTORY = os.path.join(os.path.expanduser("~"), ".local", "share", "video-repair-tool", "profiles")
+
+INDEX_FILE = "index.json"
+
+# Bytes of media data read from a file to fingerprint it
+FINGERPRINT_SAMPLE_SIZE = 1024 * 1024
+
+# Number of NAL units that must follow each other where a run of video data starts
+FINGERPRINT_NAL_DEPTH = 3
+
+# Number of gap sizes kept in a fingerprint, most common first
+FINGERPRINT_GAPS = 4
+
+# Points given for each feature of a fingerprint shared with a profile, and the score a
+# profile needs to be used. A matching in-band SPS is enough on its own
+MATCH_WEIGHTS = {'sps': 4, 'access_unit': 2, 'gaps': 2, 'brand': 1}
+MIN_MATCH_SCORE = 4
+
+
+def major_brand(data):
+    # The major brand of the 'ftyp' box at the start of data, or None
+    if len(data) >= 12 and data[4:8] == b'ftyp':
+        return data[8:12].decode('latin-1')
+    return None
+
+
+def media_data_fingerprint(data, start, end, length_size):
+    # Describe how a camera lays out its media data from a sample of it: the NAL unit types of
+    # the first keyframe up to its first slice, the first SPS written in the stream and the
+    # sizes of the gaps between runs of NAL units, where the chunks of the other tracks sit
+    end = min(end, start + FINGERPRINT_SAMPLE_SIZE)
+    finder = NalCandidateFinder(length_size, check_next_nal=False)
+
+    def next_run(position):
+        return next((candidate for candidate in finder.find(data, position, end)
+                     if is_nal_chain(data, candidate, end, length_size, FINGERPRINT_NAL_DEPTH)), None)
+
+    access_unit = None
+    types = []
+    sps = None
+    gaps = Counter()
+    position = next_run(start)
+    while position is not None:
+        # Walk the run of NAL units
+        while True:
+            header_position = position + length_size
+            if header_position >= end:
+                break
+            length = int.from_bytes(data[position:header_position], 'big')
+            if not 0 < length <= MAX_NAL_SIZE or header_position + length > end or not is_valid_nal_header(data[header_position]):
+                break
+            nal_type = data[header_position] & 0x1F
+            if sps is None and nal_type == NAL_SPS:
+                sps = bytes(data[header_position:header_position + length])
+            if access_unit is None:
+                types.append(nal_type)
+                if nal_type == NAL_IDR_SLICE:
+                    access_unit = types
+                elif nal_type in VCL_NAL_TYPES:
+                    types = []
+            position = header_position + length
+
+        run_end = position
+        position = next_run(run_end)
+        if position is not None:
+            gaps[position - run_end] += 1
+
+    return {
+        'access_unit': access_unit,
+        'sps': sps.hex() if sps is not None else None,
+        'gaps': [size for size, _ in gaps.most_common(FINGERPRINT_GAPS)],
+    }
+
+
+def fingerprint_file(path, length_sizes=(4,)):
+    # Fingerprint the media data of a file for each NAL length size, reading its first bytes
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = len(data)
+            start = find_media_data_start(data, end) or 0
+            fingerprints = {length_size: media_data_fingerprint(data, start, end, length_size) for length_size in length_sizes}
+            return major_brand(data[:12]), fingerprints
+
+
+def match_score(entry, brand, fingerprint):
+    # Points earned by a library entry for the features it shares with a file's fingerprint
+    score = 0
+    if fingerprint['sps'] is not None and fingerprint['sps'] in entry['sps']:
+        score += MATCH_WEIGHTS['sps']
+    if fingerprint['access_unit'] is not None and fingerprint['access_unit'] == entry['fingerprint']['access_unit']:
+        score += MATCH_WEIGHTS['access_unit']
+    if fingerprint['gaps'] and fingerprint['gaps'][0] in entry['fingerprint']['gaps']:
+        score += MATCH_WEIGHTS['gaps']
+    if brand is not None and brand == entry['brand']:
+        score += MATCH_WEIGHTS['brand']
+    return score
+
+
+class ProfileLibrary:
+    # Reference profiles of the cameras and recording modes seen so far, each with its codec
+    # parameters, the 'ftyp' and 'moov' of its reference file as templates and a fingerprint
+    # of its media data. Corrupt files are matched to a profile from a sample of their bytes,
+    # so a batch mixing cameras needs no reference file at all
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = os.environ.get("VIDEO_REPAIR_PROFILES", DEFAULT_LIBRARY_DIRECTORY)
+        self.directory = directory
+        self.path = os.path.join(directory, INDEX_FILE)
+        try:
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+        # Entries by SPS, so a file whose stream repeats its SPS is matched with one lookup
+        self.entries_by_sps = {}
+        for entry in self.entries.values():
+            for sps in entry['sps']:
+                self.entries_by_sps.setdefault(sps, []).append(entry)
+
+    def header_path(self, key):
+        return os.path.join(self.directory, key + ".mp4")
+
+    def add(self, reference_path, name=None):
+        # Add the profile of a healthy reference file, or return the entry it already has
+        key = fast_file_hash(reference_path)
+        if key in self.entries:
+            return self.entries[key]
+
+        profile = read_reference_profile(reference_path)
+        video = profile.video
+        if video is None or not profile.framerate:
+            raise ValueError(f"The reference file {reference_path} has no H.264 video track.")
+        brand, fingerprints = fingerprint_file(reference_path, (video.nal_length_size,))
+        fingerprint = fingerprints[video.nal_length_size]
+
+        entry = {
+            'key': key,
+            'name': name or os.path.splitext(os.path.basename(reference_path))[0],
+            'source': os.path.abspath(reference_path),
+            'brand': brand,
+            'framerate': profile.framerate,
+            'nal_length_size': video.nal_length_size,
+            'sps': sorted({sps.hex() for sps in video.sps} | ({fingerprint['sps']} if fingerprint['sps'] else set())),
+            'fingerprint': fingerprint,
+            # What was learned from the reference media data, which the templates do not hold
+            'tracks': [
+                {'index': track.index, 'bytes_per_sample': track.bytes_per_sample, 'chunk_sizes': track.chunk_sizes}
+                for track in profile.fixed_tracks
+            ],
+        }
+
+        # The templates are a movie file without media data
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = self.header_path(key) + ".tmp"
+        with open(temporary_path, 'wb') as f:
+            f.write(profile.ftyp)
+            f.write(profile.moov)
+        os.replace(temporary_path, self.header_path(key))
+
+        self.entries[key] = entry
+        for sps in entry['sps']:
+            self.entries_by_sps.setdefault(sps, []).append(entry)
+        self._save()
+        return entry
+
+    def remove(self, key):
+        entry = self.entries.pop(key)
+        for sps in entry['sps']:
+            self.entries_by_sps[sps].remove(entry)
+        try:
+            os.remove(self.header_path(key))
+        except OSError:
+            pass
+        self._save()
+        return entry
+
+    def load_profile(self, entry):
+        # Rebuild the reference profile from the templates and the learned chunk layouts
+        profile = read_reference_profile(self.header_path(entry['key']))
+        for learned in entry['tracks']:
+            track = profile.tracks[learned['index']]
+            track.bytes_per_sample = learned['bytes_per_sample']
+            track.chunk_sizes = learned['chunk_sizes']
+            track.kind = TRACK_FIXED if track.bytes_per_sample else TRACK_UNSUPPORTED
+        return profile
+
+    def match(self, path):
+        # Return the entry that best matches the file and its score, or (None, 0)
+        if not self.entries:
+            return None, 0
+        length_sizes = sorted({entry['nal_length_size'] for entry in self.entries.values()})
+        brand, fingerprints = fingerprint_file(path, length_sizes)
+
+        best_entry, best_score = None, 0
+        for length_size, fingerprint in fingerprints.items():
+            candidates = self.entries_by_sps.get(fingerprint['sps']) or self.entries.values()
+            for entry in candidates:
+                if entry['nal_length_size'] != length_size:
+                    continue
+                score = match_score(entry, brand, fingerprint)
+                if score > best_score:
+                    best_entry, best_score = entry, score
+
+        if best_score < MIN_MATCH_SCORE:
+            return None, best_score
+        return best_entry, best_score
+
+    def _save(self):
+        # Write to a temporary file and move it in place so a crash never leaves half an index
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(temporary_path, self.path)
@@ -0,0 +1,65 @@
+import threading
+import time
+
+# Minimum number of seconds between two progress reports
+PROGRESS_INTERVAL = 0.5
+
+
+def format_size(byte_count):
+    for unit in ("B", "KB", "MB", "GB"):
+        if byte_count < 1024:
+            return f"{byte_count:.1f} {unit}"
+        byte_count /= 1024
+    return f"{byte_count:.1f} TB"
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {seconds % 3600 // 60:02d}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressTracker:
+    # Counts the bytes processed across a batch and calls callback(percent, message) with the
+    # throughput and the estimated time left. Workers may call it from any thread and as often
+    # as they like: reports are throttled to one per interval.
+    def __init__(self, total_bytes, callback, interval=PROGRESS_INTERVAL):
+        self.total_bytes = max(total_bytes, 1)
+        self.callback = callback
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.done_bytes = 0
+        self.start_time = time.monotonic()
+        self.last_report_time = 0.0
+
+    def __call__(self, byte_count):
+        with self.lock:
+            self.done_bytes += byte_count
+            now = time.monotonic()
+            if now - self.last_report_time < self.interval and self.done_bytes < self.total_bytes:
+                return
+            self.last_report_time = now
+            done_bytes = self.done_bytes
+
+        self._report(done_bytes, now)
+
+    def finish(self):
+        # Report the final state regardless of the throttling
+        with self.lock:
+            done_bytes = self.done_bytes
+        self._report(done_bytes, time.monotonic())
+
+    def _report(self, done_bytes, now):
+        done_bytes = min(done_bytes, self.total_bytes)
+        elapsed = max(now - self.start_time, 1e-6)
+        rate = done_bytes / elapsed
+        percent = int(done_bytes * 100 / self.total_bytes)
+
+        message = f"{format_size(done_bytes)} of {format_size(self.total_bytes)}, {format_size(rate)}/s"
+        if 0 < done_bytes < self.total_bytes:
+            message += f", ETA {format_duration((self.total_bytes - done_bytes) / rate)}"
+
+        self.callback(percent, message)
@@ -1,6 +1,8 @@
 import os
 import subprocess
 from pathlib import Path
+from recover_mp4 import recover_mp4_options
+from reference_profile import read_reference_profile
 
 def run_command(command):
     try:
@@ -23,6 +25,11 @@ def process_files(corrupted_folder, repaired_folder, temp_folder, reference_file
         print("Error: audio.hdr or video.hdr not found after analysis. Exiting.")
         return
     
+    # Read the frame rate and the camera brand from the reference instead of assuming a Sony camera at 29.97 fps
+    profile = read_reference_profile(reference_file)
+    framerate = profile.framerate
+    sony_option = "".join(f" {option}" for option in recover_mp4_options(reference_file))
+
     # Step 2: Process corrupted MP4 files
     corrupted_files = [f for f in os.listdir(corrupted_folder) if f.endswith('.MP4')]
     
@@ -34,12 +41,12 @@ def process_files(corrupted_folder, repaired_folder, temp_folder, reference_file
 
         # Run recover_mp4 for each corrupted file
         print(f"Processing corrupted file: {file}")
-        recover_command = f"{recover_mp4_path} {corrupted_mp4_path} {h264_path} {wav_path} --sony"
+        recover_command = f"{recover_mp4_path} {corrupted_mp4_path} {h264_path} {wav_path}{sony_option}"
         run_command(recover_command)
 
         # Step 3: Use ffmpeg to merge the .h264 and .wav files into a repaired MP4
         output_mp4_path = os.path.join(repaired_folder, file)
-        ffmpeg_command = f"{ffmpeg_path} -r 30000/1001 -i {h264_path} -i {wav_path} -c:v copy -c:a copy {output_mp4_path}"
+        ffmpeg_command = f"{ffmpeg_path} -r {framerate} -i {h264_path} -i {wav_path} -c:v copy -c:a copy {output_mp4_path}"
         run_command(ffmpeg_command)
 
         print(f"Repaired file saved as: {output_mp4_path}")
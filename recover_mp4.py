@@ -1,15 +1,187 @@
+import errno
+import mmap
 import os
+import shutil
+import signal
+import struct
 import subprocess
+import tempfile
+import threading
+import time
+from collections import deque
 from pathlib import Path
 import re
+from analysis_cache import AnalysisCache, HEADER_FILES, fast_file_hash
+from batch import ConsoleLog, FileSkipped, default_worker_count, mirrored_folder, order_largest_first, run_batch, run_pipeline
+from integrity import add_duplicate_results, find_duplicates, log_duplicates, verify_results
+from isobmff import find_media_data_start, locate_moov
+from manifest import JobManifest, STAGE_ANALYZED, STAGE_EXTRACTED, STAGE_MUXED
+from mdat_scanner import scan_media_data, write_annex_b, write_track_chunks
+from metrics import add_bytes, add_command_usage, job_path, measure_stage, wants_command_usage
+from mp4_writer import write_repaired_copy, write_sidecar_index
+from progress import ProgressTracker
+from reference_profile import read_reference_profile
+from scheduler import run_scheduled
+from triage import STRATEGY_HEADER, VIDEO_PATTERNS, matches_patterns, triage_files
+from profile_library import major_brand
+from videorepair import repair_single_video
 
-def run_command(command):
+# File name patterns of the corrupted files processed by default, in any case
+DEFAULT_PATTERNS = VIDEO_PATTERNS
+
+# Lines printed by ffmpeg -progress
+FFMPEG_PROGRESS_LINE = re.compile(r"^\w+=\S*$")
+
+# Number of output lines of a command kept for error reports
+OUTPUT_TAIL_LINES = 1000
+
+# How the streams are extracted from the corrupted files: with recover_mp4, or by the built-in
+# scanner that pipes them to ffmpeg without temp files
+EXTRACTOR_RECOVER_MP4 = "recover_mp4"
+EXTRACTOR_NATIVE = "native"
+
+# How the built-in extractor writes the repaired files: remuxed by ffmpeg, copied with a
+# rebuilt 'moov', or as a small sidecar index whose samples stay in the corrupted file
+MUXER_FFMPEG = "ffmpeg"
+MUXER_COPY = "copy"
+MUXER_SIDECAR = "sidecar"
+
+# Major brand of the recordings of Sony cameras
+SONY_BRAND = "XAVC"
+
+class CommandError(Exception):
+    # A command failed, timed out or could not be started; output_tail holds its last lines
+    def __init__(self, message, output_tail=""):
+        super().__init__(message)
+        self.output_tail = output_tail
+
+def kill_command(process):
+    # Kill the command and, on POSIX, the processes it started so none keeps the output pipe open
+    if os.name == 'posix':
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    else:
+        process.kill()
+
+def feed_pipe(feeder, pipe):
+    # Call feeder(write) to stream data into the pipe of a command, then close it so the
+    # command sees the end of its input. A command that exits early just stops the feeding
+    try:
+        feeder(pipe.write)
+    except (BrokenPipeError, ValueError):
+        pass
+    except OSError as e:
+        if e.errno != errno.EINVAL:
+            raise
+    finally:
+        try:
+            pipe.close()
+        except OSError:
+            pass
+
+def run_command(args, cwd=None, on_output=None, timeout=None, idle_timeout=None, stdin_feeder=None, pass_fds=()):
+    # Run the command given as a list of arguments, without a shell, and return the last
+    # OUTPUT_TAIL_LINES lines of its output. on_output(line) is called for each line as it is
+    # printed. The command is killed when it runs longer than timeout seconds or prints
+    # nothing for idle_timeout seconds, which is how a hung recover_mp4 shows up.
+    # stdin_feeder(write) streams the standard input of the command from a thread. The file
+    # descriptors in pass_fds are inherited by the command and closed here once it started.
     try:
-        result = subprocess.run(command, check=True, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-        return result.stdout + result.stderr
-    except subprocess.CalledProcessError as e:
-        print(f"Command '{command}' failed with error: {e}")
-        return ""
+        process = subprocess.Popen(
+            args, stdin=subprocess.PIPE if stdin_feeder is not None else None,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace', cwd=cwd,
+            start_new_session=(os.name == 'posix'), pass_fds=pass_fds,
+        )
+    except OSError as e:
+        raise CommandError(f"Command '{args[0]}' could not be started: {e}")
+    finally:
+        for fd in pass_fds:
+            os.close(fd)
+
+    feeder_thread = None
+    if stdin_feeder is not None:
+        # The text mode stdin wraps a binary pipe, write the bytes to that
+        feeder_thread = threading.Thread(target=feed_pipe, args=(stdin_feeder, process.stdin.buffer), daemon=True)
+        feeder_thread.start()
+
+    output_tail = deque(maxlen=OUTPUT_TAIL_LINES)
+    start_time = last_output_time = time.monotonic()
+    finished = threading.Event()
+    killed_reason = []
+
+    def watchdog():
+        while not finished.wait(1.0):
+            now = time.monotonic()
+            if timeout is not None and now - start_time > timeout:
+                killed_reason.append(f"timed out after {timeout}s")
+            elif idle_timeout is not None and now - last_output_time > idle_timeout:
+                killed_reason.append(f"printed nothing for {idle_timeout}s")
+            else:
+                continue
+            kill_command(process)
+            break
+
+    if timeout is not None or idle_timeout is not None:
+        threading.Thread(target=watchdog, daemon=True).start()
+
+    try:
+        for line in process.stdout:
+            last_output_time = time.monotonic()
+            output_tail.append(line)
+            if on_output is not None:
+                on_output(line.rstrip("\r\n"))
+        if wants_command_usage() and hasattr(os, 'waitid'):
+            # Wait for the command without reaping it, so its CPU time and I/O can still be read
+            os.waitid(os.P_PID, process.pid, os.WEXITED | os.WNOWAIT)
+            add_command_usage(process.pid)
+        returncode = process.wait()
+    finally:
+        finished.set()
+        if process.poll() is None:
+            kill_command(process)
+            process.wait()
+        process.stdout.close()
+        if feeder_thread is not None:
+            feeder_thread.join()
+
+    output = "".join(output_tail)
+    if killed_reason:
+        raise CommandError(f"Command '{os.path.basename(args[0])}' was killed: it {killed_reason[0]}", output)
+    if returncode != 0:
+        raise CommandError(f"Command '{os.path.basename(args[0])}' failed with exit code {returncode}", output)
+    return output
+
+class FfmpegOutput:
+    # Handles the output lines of an ffmpeg run started with -progress pipe:1: the log goes to
+    # log_signal and the bytes written, up to expected_size, are counted in progress
+    def __init__(self, expected_size, log_signal, progress=None):
+        self.expected_size = expected_size
+        self.log_signal = log_signal
+        self.progress = progress
+        self.reported_size = 0
+
+    def __call__(self, line):
+        # With -progress, ffmpeg prints its progress as key=value lines on stdout and its log on stderr
+        if not FFMPEG_PROGRESS_LINE.match(line):
+            self.log_signal.emit(line)
+            return
+        # 'total_size' is the number of bytes written so far
+        if self.progress is not None and line.startswith("total_size="):
+            try:
+                total_size = min(int(line.split("=", 1)[1]), self.expected_size)
+            except ValueError:
+                return
+            if total_size > self.reported_size:
+                self.progress(total_size - self.reported_size)
+                self.reported_size = total_size
+
+    def finish(self):
+        # Count the rest of the file, whether ffmpeg succeeded or not
+        if self.progress is not None:
+            self.progress(self.expected_size - self.reported_size)
+            self.reported_size = self.expected_size
 
 def extract_framerate_and_filenames(output):
     # Regex to extract the framerate and the filenames for the .h264 and .wav
@@ -29,48 +201,464 @@ def extract_framerate_and_filenames(output):
 
     return framerate, h264_file, wav_file
 
-def process_files(corrupted_folder, repaired_folder, temp_folder, reference_file, recover_mp4_path, ffmpeg_path):
+def resolve_tool_path(tool_path):
+    # Make the tool path absolute so it still works when the command runs in another directory
+    if os.path.exists(tool_path):
+        return os.path.abspath(tool_path)
+    return shutil.which(tool_path) or tool_path
+
+def recover_mp4_options(reference_file):
+    # recover_mp4 needs --sony for the XAVC recordings of Sony cameras and nothing otherwise
+    with open(reference_file, 'rb') as f:
+        return ["--sony"] if major_brand(f.read(12)) == SONY_BRAND else []
+
+def analyze_reference(reference_file, recover_mp4_path, log_signal, cache=None, timeout=None):
+    # Return the analysis of the reference file (framerate, stream templates and the directory
+    # holding its audio.hdr and video.hdr), from the cache when the same reference was
+    # analyzed before. The analysis runs in a private directory so concurrent jobs never
+    # overwrite each other's .hdr files
+    if cache is None:
+        cache = AnalysisCache()
+
+    reference_hash = fast_file_hash(reference_file)
+    analysis = cache.get(reference_hash)
+    if analysis is not None:
+        log_signal.emit(f"Using cached analysis of reference file: {reference_file}")
+        return analysis
+
+    log_signal.emit(f"Analyzing reference file: {reference_file}")
+    with tempfile.TemporaryDirectory(prefix="recover_mp4-") as analysis_directory:
+        analyze_command = [recover_mp4_path, os.path.abspath(reference_file), "--analyze"]
+        try:
+            analyze_output = run_command(analyze_command, cwd=analysis_directory, on_output=log_signal.emit, timeout=timeout)
+        except CommandError as e:
+            log_signal.emit(f"Error: {str(e)}")
+            return None
+
+        # Extract the framerate and .h264/.wav filenames from the analysis output
+        framerate, h264_file_template, wav_file_template = extract_framerate_and_filenames(analyze_output)
+
+        if not framerate or not h264_file_template or not wav_file_template:
+            log_signal.emit("Error: Missing framerate or file templates. Exiting.")
+            return None
+
+        # Ensure audio.hdr and video.hdr files are created
+        if not all(Path(analysis_directory, name).exists() for name in HEADER_FILES):
+            log_signal.emit("Error: audio.hdr or video.hdr not found after analysis. Exiting.")
+            return None
+
+        analysis = {
+            'framerate': framerate,
+            'h264_file_template': h264_file_template,
+            'wav_file_template': wav_file_template,
+            'options': recover_mp4_options(reference_file),
+        }
+        return cache.put(reference_hash, analysis, analysis_directory)
+
+def extract_single_file(args, log_signal, progress=None, timeout=None, idle_timeout=None):
+    corrupted_mp4_path, temp_folder, recover_mp4_path, analysis, manifest = args
+    header_directory = analysis['directory']
+    reference_hash = analysis['reference_hash']
+
+    file = os.path.basename(corrupted_mp4_path)
+    base_name = Path(file).stem  # e.g., C0071
+    h264_path = os.path.join(temp_folder, f"{base_name}.h264")
+    wav_path = os.path.join(temp_folder, f"{base_name}.wav")
+
+    # Resume from the .h264 and .wav files extracted by a previous run
+    stage, _ = manifest.stage(corrupted_mp4_path, reference_hash)
+    if stage == STAGE_EXTRACTED and os.path.exists(h264_path) and os.path.exists(wav_path):
+        log_signal.emit(f"Resuming {file} from its extracted streams")
+        if progress is not None:
+            progress(os.path.getsize(corrupted_mp4_path))
+        return corrupted_mp4_path, base_name, h264_path, wav_path
+    manifest.record(corrupted_mp4_path, STAGE_ANALYZED, reference_hash)
+
+    # Run recover_mp4 for each corrupted file, dynamically generating the .h264 and .wav files.
+    # It runs in the directory holding the reference audio.hdr and video.hdr
+    log_signal.emit(f"Processing corrupted file: {file}")
+    recover_command = [recover_mp4_path, corrupted_mp4_path, h264_path, wav_path] + analysis.get('options', ["--sony"])
+    run_command(recover_command, cwd=header_directory, on_output=log_signal.emit, timeout=timeout, idle_timeout=idle_timeout)
+
+    if not os.path.exists(h264_path):
+        raise Exception(f"recover_mp4 did not extract the video stream of {file}")
+    manifest.record(corrupted_mp4_path, STAGE_EXTRACTED, reference_hash, h264=h264_path, wav=wav_path)
+
+    # recover_mp4 does not report its progress, count the file once it is extracted
+    if progress is not None:
+        progress(os.path.getsize(corrupted_mp4_path))
+
+    return corrupted_mp4_path, base_name, h264_path, wav_path
+
+def mux_single_file(args, log_signal, progress=None, timeout=None, idle_timeout=None):
+    (corrupted_mp4_path, base_name, h264_path, wav_path), repaired_folder, framerate, ffmpeg_path, manifest, reference_hash = args
+
+    # The muxed file is about the size of the corrupted one, count ffmpeg's output up to that size
+    ffmpeg_output = FfmpegOutput(os.path.getsize(corrupted_mp4_path), log_signal, progress)
+
+    # Step 3: Use ffmpeg to merge the .h264 and .wav files into a repaired MP4
+    output_mp4_path = os.path.join(repaired_folder, f"{base_name}.MP4")
+    ffmpeg_command = [
+        ffmpeg_path, "-y", "-nostats", "-progress", "pipe:1", "-r", framerate,
+        "-i", h264_path, "-i", wav_path, "-c:v", "copy", "-c:a", "copy", output_mp4_path,
+    ]
+    try:
+        run_command(ffmpeg_command, on_output=ffmpeg_output, timeout=timeout, idle_timeout=idle_timeout)
+    finally:
+        ffmpeg_output.finish()
+
+    if not os.path.exists(output_mp4_path):
+        raise Exception(f"ffmpeg did not write {output_mp4_path}")
+    manifest.record(corrupted_mp4_path, STAGE_MUXED, reference_hash, repaired=output_mp4_path)
+
+    log_signal.emit(f"Repaired file saved as: {output_mp4_path}")
+    return output_mp4_path
+
+def scan_single_file(args, log_signal, progress=None):
+    corrupted_mp4_path, profile = args
+
+    # Find the video frames and audio chunks in the media data ourselves, using the codec
+    # parameters of the reference file instead of its recover_mp4 analysis
+    file = os.path.basename(corrupted_mp4_path)
+    log_signal.emit(f"Scanning corrupted file: {file}")
+    with open(corrupted_mp4_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            end = len(data)
+            start = find_media_data_start(data, end) or 0
+            # A 'moov' left after the media data by the camera is not part of the streams
+            moov = locate_moov(data, end)
+            media_end = moov.offset if moov is not None and moov.offset > start else end
+            scan = scan_media_data(data, start, media_end, profile, progress)
+            # Pages read through the map are not counted by the system calls
+            add_bytes(read=media_end - start)
+
+    if not scan.sample_count:
+        raise Exception(f"No H.264 video matching the reference file was found in {file}")
+    log_signal.emit(f"Found {scan.sample_count} video frames in {file}")
+    if scan.skipped_bytes:
+        log_signal.emit(f"Skipped {scan.skipped_bytes} damaged bytes in {file}")
+
+    # The scan stage counts the bytes it scanned, the mux stage counts the rest of the file
+    if progress is not None:
+        progress(os.path.getsize(corrupted_mp4_path) - (media_end - start))
+
+    return corrupted_mp4_path, scan
+
+def mux_native_file(args, log_signal, progress=None, timeout=None, idle_timeout=None):
+    (corrupted_mp4_path, scan), repaired_folder, temp_folder, profile, ffmpeg_path, manifest, reference_hash = args
+
+    file = os.path.basename(corrupted_mp4_path)
+    base_name = Path(file).stem
+    output_mp4_path = os.path.join(repaired_folder, f"{base_name}.MP4")
+    ffmpeg_output = FfmpegOutput(os.path.getsize(corrupted_mp4_path), log_signal, progress)
+
+    audio = profile.audio
+    if audio is None and any(track.handler == b'soun' for track in profile.tracks):
+        log_signal.emit(f"Warning: the audio of {file} is not PCM and cannot be extracted, only its video is repaired.")
+    audio_chunks = scan.fixed_chunks.get(audio.index) if audio is not None else None
+
+    # The streams go to ffmpeg through pipes, straight from the corrupted file: the video as an
+    # Annex-B stream on its standard input and the PCM audio on a second pipe
+    audio_thread = None
+    audio_path = None
+    pass_fds = ()
+    with open(corrupted_mp4_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            ffmpeg_command = [
+                ffmpeg_path, "-y", "-nostats", "-progress", "pipe:1",
+                "-fflags", "+genpts", "-f", "h264", "-r", profile.framerate, "-i", "pipe:0",
+            ]
+            if audio_chunks is not None:
+                audio_format = ["-f", audio.pcm_format, "-ar", str(audio.sample_rate), "-ac", str(audio.channels)]
+                if os.name == 'posix':
+                    read_fd, write_fd = os.pipe()
+                    audio_pipe = os.fdopen(write_fd, 'wb')
+                    audio_thread = threading.Thread(
+                        target=feed_pipe, args=(lambda write: write_track_chunks(data, audio_chunks, write), audio_pipe), daemon=True,
+                    )
+                    audio_thread.start()
+                    ffmpeg_command += audio_format + ["-i", f"pipe:{read_fd}"]
+                    pass_fds = (read_fd,)
+                else:
+                    # Windows cannot hand a second pipe to ffmpeg, the audio goes through the temp folder
+                    audio_path = os.path.join(temp_folder, f"{base_name}.pcm")
+                    with open(audio_path, 'wb') as audio_file:
+                        write_track_chunks(data, audio_chunks, audio_file.write)
+                    ffmpeg_command += audio_format + ["-i", audio_path]
+                ffmpeg_command += ["-map", "0:v", "-map", "1:a"]
+            ffmpeg_command += ["-c:v", "copy", "-c:a", "copy", output_mp4_path]
+
+            log_signal.emit(f"Muxing {file}")
+            try:
+                run_command(
+                    ffmpeg_command, on_output=ffmpeg_output, timeout=timeout, idle_timeout=idle_timeout,
+                    stdin_feeder=lambda write: write_annex_b(data, scan, profile.video, write), pass_fds=pass_fds,
+                )
+            finally:
+                ffmpeg_output.finish()
+                if audio_thread is not None:
+                    audio_thread.join()
+                if audio_path is not None and os.path.exists(audio_path):
+                    os.remove(audio_path)
+
+    if not os.path.exists(output_mp4_path):
+        raise Exception(f"ffmpeg did not write {output_mp4_path}")
+    manifest.record(corrupted_mp4_path, STAGE_MUXED, reference_hash, repaired=output_mp4_path)
+
+    log_signal.emit(f"Repaired file saved as: {output_mp4_path}")
+    return output_mp4_path
+
+def write_native_file(args, log_signal, progress=None):
+    (corrupted_mp4_path, scan), repaired_folder, profile, muxer, manifest, reference_hash = args
+
+    # Write the sample tables of the frames and chunks found by the scan into a new 'moov':
+    # no stream is decoded or remuxed
+    file = os.path.basename(corrupted_mp4_path)
+    base_name = Path(file).stem
+    for track in profile.tracks:
+        if track is not profile.video and track.index not in scan.fixed_chunks:
+            log_signal.emit(f"Warning: the '{track.codec.decode('latin-1')}' track of {file} cannot be indexed and is left out.")
+
+    file_size = os.path.getsize(corrupted_mp4_path)
+    if muxer == MUXER_SIDECAR:
+        output_mp4_path = os.path.join(repaired_folder, f"{base_name}.index.MP4")
+        write_sidecar_index(profile, scan, corrupted_mp4_path, output_mp4_path)
+        if progress is not None:
+            progress(file_size)
+        log_signal.emit(f"Index of {file} saved as: {output_mp4_path}")
+    else:
+        output_mp4_path = os.path.join(repaired_folder, f"{base_name}.MP4")
+        write_repaired_copy(profile, scan, corrupted_mp4_path, output_mp4_path, progress)
+        if progress is not None:
+            progress(file_size - (scan.end - scan.start))
+        log_signal.emit(f"Repaired file saved as: {output_mp4_path}")
+
+    manifest.record(corrupted_mp4_path, STAGE_MUXED, reference_hash, repaired=output_mp4_path)
+    return output_mp4_path
+
+def load_reference(reference_file, extractor, recover_mp4_path, log_signal, cache=None, timeout=None):
+    # Return what the extractor needs from a reference file: the recover_mp4 analysis, or the
+    # reference profile read from its 'moov' for the built-in extractor. None on failure
+    if extractor != EXTRACTOR_NATIVE:
+        return analyze_reference(reference_file, recover_mp4_path, log_signal, cache, timeout)
+
+    try:
+        profile = read_reference_profile(reference_file)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        log_signal.emit(f"Error: Could not read the reference file {reference_file}: {e}")
+        return None
+    if profile.video is None or not profile.framerate:
+        log_signal.emit("Error: The reference file has no H.264 video track.")
+        return None
+    return {'profile': profile, 'framerate': profile.framerate, 'reference_hash': fast_file_hash(reference_file)}
+
+def match_references(corrupted_files, library, extractor, recover_mp4_path, log_signal, cache=None, timeout=None):
+    # Match every file to a profile of the library from a sample of its media data and return
+    # the references by file, and the files matching no usable profile as failed results
+    if cache is None:
+        cache = AnalysisCache()
+
+    references = {}
+    failures = []
+    loaded = {}
+    for path in corrupted_files:
+        file = os.path.basename(path)
+        try:
+            entry, score = library.match(path)
+        except (OSError, ValueError) as e:
+            log_signal.emit(f"Error: Could not read {file}: {e}")
+            failures.append((path, None, e))
+            continue
+        if entry is None:
+            log_signal.emit(f"Error: No reference profile matches {file}.")
+            failures.append((path, None, Exception(f"No reference profile matches {file}")))
+            continue
+
+        key = entry['key']
+        if key not in loaded:
+            # The built-in extractor only needs the stored templates, recover_mp4 needs the
+            # reference file itself unless its analysis is cached
+            if extractor == EXTRACTOR_NATIVE:
+                try:
+                    profile = library.load_profile(entry)
+                    loaded[key] = {'profile': profile, 'framerate': profile.framerate, 'reference_hash': key}
+                except (OSError, ValueError, IndexError, struct.error) as e:
+                    log_signal.emit(f"Error: Could not load reference profile {entry['name']}: {e}")
+                    loaded[key] = None
+            else:
+                analysis = cache.get(key)
+                if analysis is None and os.path.exists(entry['source']):
+                    analysis = analyze_reference(entry['source'], recover_mp4_path, log_signal, cache, timeout)
+                elif analysis is None:
+                    log_signal.emit(f"Error: The reference file {entry['source']} of profile {entry['name']} is missing.")
+                loaded[key] = analysis
+        if loaded[key] is None:
+            failures.append((path, None, Exception(f"The reference profile {entry['name']} matching {file} could not be loaded")))
+            continue
+
+        log_signal.emit(f"Matched {file} to reference profile {entry['name']} (score {score}).")
+        references[path] = loaded[key]
+    return references, failures
+
+def process_files(corrupted_folder, repaired_folder, temp_folder, reference_file, recover_mp4_path, ffmpeg_path, log_signal=None, workers=None, cache=None, progress_callback=None, command_timeout=None, idle_timeout=None, patterns=DEFAULT_PATTERNS, extractor=EXTRACTOR_RECOVER_MP4, muxer=MUXER_FFMPEG, triage=True, library=None, dedupe=True, verify=True, scheduler=None, files=None):
+    if log_signal is None:
+        log_signal = ConsoleLog()
+
+    # The recovery runs in the analysis directory, so every path must be absolute
+    corrupted_folder = os.path.abspath(corrupted_folder)
+    repaired_folder = os.path.abspath(repaired_folder)
+    temp_folder = os.path.abspath(temp_folder)
+    recover_mp4_path = resolve_tool_path(recover_mp4_path)
+    ffmpeg_path = resolve_tool_path(ffmpeg_path)
+
+    # Only the built-in extractor knows where the samples are, which writing a 'moov' needs
+    if muxer != MUXER_FFMPEG:
+        extractor = EXTRACTOR_NATIVE
+
     # Create Repaired and Temp directories if they don't exist
     os.makedirs(repaired_folder, exist_ok=True)
     os.makedirs(temp_folder, exist_ok=True)
 
-    # Step 1: Analyze the reference MP4 file
-    print(f"Analyzing reference file: {reference_file}")
-    analyze_command = f"{recover_mp4_path} {reference_file} --analyze"
-    analyze_output = run_command(analyze_command)
-
-    # Extract the framerate and .h264/.wav filenames from the analysis output
-    framerate, h264_file_template, wav_file_template = extract_framerate_and_filenames(analyze_output)
-
-    if not framerate or not h264_file_template or not wav_file_template:
-        print("Error: Missing framerate or file templates. Exiting.")
-        return
-
-    # Ensure audio.hdr and video.hdr files are created
-    if not (Path("audio.hdr").exists() and Path("video.hdr").exists()):
-        print("Error: audio.hdr or video.hdr not found after analysis. Exiting.")
-        return
-
-    # Step 2: Process corrupted MP4 files
-    corrupted_files = [f for f in os.listdir(corrupted_folder) if f.endswith('.MP4')]
-    
-    for file in corrupted_files:
-        base_name = Path(file).stem  # e.g., C0071
-        corrupted_mp4_path = os.path.join(corrupted_folder, file)
-        h264_path = os.path.join(temp_folder, f"{base_name}.h264")
-        wav_path = os.path.join(temp_folder, f"{base_name}.wav")
-
-        # Run recover_mp4 for each corrupted file, dynamically generating the .h264 and .wav files
-        print(f"Processing corrupted file: {file}")
-        recover_command = f"{recover_mp4_path} {corrupted_mp4_path} {h264_path} {wav_path} --sony"
-        run_command(recover_command)
-
-        # Step 3: Use ffmpeg to merge the .h264 and .wav files into a repaired MP4
-        output_mp4_path = os.path.join(repaired_folder, f"{base_name}.MP4")
-        ffmpeg_command = f"{ffmpeg_path} -r {framerate} -i {h264_path} -i {wav_path} -c:v copy -c:a copy {output_mp4_path}"
-        run_command(ffmpeg_command)
+    # Step 1: Analyze the reference MP4 file, or reuse its cached analysis, or match every file
+    # to a reference of the profile library when no reference file is given
+    if library is not None and not reference_file:
+        reference = None
+    else:
+        with measure_stage("analyze", reference_file):
+            reference = load_reference(reference_file, extractor, recover_mp4_path, log_signal, cache, command_timeout)
+        if reference is None:
+            return
+
+    # The files of the folder, or those given by a watch of the folder
+    if files is None:
+        corrupted_files = [os.path.join(corrupted_folder, f) for f in os.listdir(corrupted_folder) if matches_patterns(f, patterns)]
+    else:
+        corrupted_files = list(files)
+
+    # Repair each clip once when the folder holds several copies of it
+    duplicates = {}
+    if dedupe:
+        corrupted_files, duplicates = find_duplicates(corrupted_files)
+        log_duplicates(duplicates, log_signal)
+
+    # Triage the files from a few blocks of each: healthy and unrecoverable files are skipped,
+    # and a file whose 'moov' survived only needs its 'mdat' header rebuilt, not a full recovery.
+    # Skipped files get a result with the reason
+    header_damaged_files = []
+    skipped = []
+    if triage:
+        recoverable_files = []
+        for result in triage_files(corrupted_files):
+            if result.strategy == STRATEGY_HEADER:
+                header_damaged_files.append(result.path)
+            elif result.strategy is not None:
+                recoverable_files.append(result.path)
+            else:
+                log_signal.emit(f"Skipping {os.path.basename(result.path)}, {result.status}: {result.reason}")
+                skipped.append((result.path, None, FileSkipped(f"{result.status}: {result.reason}")))
+        corrupted_files = recoverable_files
+
+    unmatched = []
+    if reference is None:
+        references, unmatched = match_references(corrupted_files, library, extractor, recover_mp4_path, log_signal, cache, command_timeout)
+    else:
+        references = dict.fromkeys(corrupted_files, reference)
+
+    # Skip the files already repaired by a previous run with the same reference. Rebuilding a
+    # header does not depend on the reference
+    manifest = JobManifest(repaired_folder)
+
+    def is_repaired(path, reference_hash):
+        stage, outputs = manifest.stage(path, reference_hash)
+        if stage == STAGE_MUXED and os.path.exists(outputs.get('repaired', '')):
+            log_signal.emit(f"Skipping {os.path.basename(path)}, already repaired.")
+            skipped.append((path, outputs['repaired'], FileSkipped("already repaired")))
+            return True
+        return False
+
+    header_damaged_files = [path for path in header_damaged_files if not is_repaired(path, None)]
+    corrupted_files = [
+        path for path in corrupted_files
+        if path in references and not is_repaired(path, references[path]['reference_hash'])
+    ]
+
+    # Step 2: Process corrupted MP4 files in parallel, largest files first. Extraction and muxing
+    # are separate pipeline stages so ffmpeg muxes one file while recover_mp4 extracts the next.
+    # The work happens in the subprocesses, so threads are enough to overlap them
+    # Progress counts every file twice, once for each stage, and the header repairs once
+    progress = None
+    if progress_callback is not None:
+        total_size = 2 * sum(os.path.getsize(f) for f in corrupted_files) + sum(os.path.getsize(f) for f in header_damaged_files)
+        progress = ProgressTracker(total_size, progress_callback)
+
+    def record_header_repair(job, repaired_file_path, error):
+        if repaired_file_path is not None:
+            manifest.record(job[0], STAGE_MUXED, repaired=repaired_file_path)
+
+    # Files found in subfolders, by a recursive watch, go to the same subfolders of the
+    # repaired and temp folders so files of the same name do not overwrite each other
+    def in_temp_folder(path):
+        return mirrored_folder(path, corrupted_folder, temp_folder)
+
+    def in_repaired_folder(path):
+        return mirrored_folder(path, corrupted_folder, repaired_folder)
+
+    # The header repairs keep the extension of their file, as the muxed files have one
+    def repair_header(job, log, progress=None):
+        return repair_single_video(job, log, progress, keep_extension=True)
+
+    header_jobs = [(path, reference_file, in_repaired_folder(path), False) for path in order_largest_first(header_damaged_files)]
+    if scheduler is None:
+        header_results = run_batch(repair_header, header_jobs, log_signal, workers, on_result=record_header_repair, progress=progress, stage="header")
+    else:
+        header_stages = [("header", lambda job, log: repair_header(job, log, progress), job_path, lambda job: job[2])]
+        header_results, _ = run_scheduled(header_stages, header_jobs, log_signal, scheduler, on_result=record_header_repair)
+
+    # Each stage looks up the reference of its file. A command running longer than
+    # command_timeout, or silent for idle_timeout seconds, is killed. Stages also name the
+    # paths they read and write, for the device scheduler
+    def profile_of(path):
+        return references[path]['profile']
+
+    def hash_of(path):
+        return references[path]['reference_hash']
+
+    def corrupted_file(path):
+        return path
+
+    if extractor == EXTRACTOR_NATIVE and muxer != MUXER_FFMPEG:
+        stages = [
+            ("scan", lambda path, log: scan_single_file((path, profile_of(path)), log, progress), corrupted_file, None),
+            ("write", lambda scan, log: write_native_file((scan, in_repaired_folder(scan[0]), profile_of(scan[0]), muxer, manifest, hash_of(scan[0])), log, progress), corrupted_file, in_repaired_folder),
+        ]
+    elif extractor == EXTRACTOR_NATIVE:
+        stages = [
+            ("scan", lambda path, log: scan_single_file((path, profile_of(path)), log, progress), corrupted_file, None),
+            ("mux", lambda scan, log: mux_native_file((scan, in_repaired_folder(scan[0]), in_temp_folder(scan[0]), profile_of(scan[0]), ffmpeg_path, manifest, hash_of(scan[0])), log, progress, command_timeout, idle_timeout), corrupted_file, in_repaired_folder),
+        ]
+    else:
+        stages = [
+            ("extract", lambda path, log: extract_single_file((path, in_temp_folder(path), recover_mp4_path, references[path], manifest), log, progress, command_timeout, idle_timeout), corrupted_file, in_temp_folder),
+            ("mux", lambda streams, log: mux_single_file((streams, in_repaired_folder(streams[0]), references[streams[0]]['framerate'], ffmpeg_path, manifest, hash_of(streams[0])), log, progress, command_timeout, idle_timeout), in_temp_folder, in_repaired_folder),
+        ]
+    if scheduler is None:
+        results, timer = run_pipeline([(name, func) for name, func, _, _ in stages], order_largest_first(corrupted_files), log_signal, workers)
+    else:
+        results, timer = run_scheduled(stages, order_largest_first(corrupted_files), log_signal, scheduler)
+    results += [(job[0], result, error) for job, result, error in header_results] + unmatched + skipped
+    if progress is not None:
+        progress.finish()
+
+    # Check that every repaired file is a well formed movie, hashing it on the way
+    if verify:
+        results = verify_results(results, log_signal, workers)
+    add_duplicate_results(results, duplicates)
+
+    # Report where the time went so the slowest stage can be identified
+    for line in timer.report():
+        log_signal.emit(line)
 
-        print(f"Repaired file saved as: {output_mp4_path}")
+    return results
 
 if __name__ == "__main__":
     # Prompt for folder paths
@@ -78,9 +666,11 @@ if __name__ == "__main__":
     repaired_folder = os.path.join(Path(corrupted_folder).parent, "Repaired")
     temp_folder = os.path.join(Path(corrupted_folder).parent, "Temp")
     reference_file = input("Enter the path to the reference MP4 file: ")
+    workers = input(f"Enter the number of parallel workers [{default_worker_count()}]: ")
+    native = input("Use the built-in extractor instead of recover_mp4? [y/N]: ")
 
     # Paths to the tools (adjust these paths if needed)
     recover_mp4_path = "recover_mp4.exe"
     ffmpeg_path = "ffmpeg.exe"
 
-    process_files(corrupted_folder, repaired_folder, temp_folder, reference_file, recover_mp4_path, ffmpeg_path)
+    process_files(corrupted_folder, repaired_folder, temp_folder, reference_file, recover_mp4_path, ffmpeg_path, workers=int(workers) if workers else None, extractor=EXTRACTOR_NATIVE if native.lower().startswith("y") else EXTRACTOR_RECOVER_MP4)
@@ -0,0 +1,256 @@
+import io
+import os
+import struct
+import sys
+from array import array
+from collections import Counter
+from fractions import Fraction
+from avc import SequenceParameters, parse_avcc
+from isobmff import child_boxes, find_child, find_children, index_boxes, read_box_payload
+
+# Sample entries of the video tracks whose samples can be found in headerless media data
+AVC_CODECS = {b'avc1'}
+
+# ffmpeg raw audio formats of the PCM sample entries, by codec and bits per sample
+PCM_FORMATS = {
+    (b'raw ', 8): 'u8',
+    (b'twos', 8): 's8',
+    (b'twos', 16): 's16be',
+    (b'sowt', 8): 's8',
+    (b'sowt', 16): 's16le',
+    (b'in24', 24): 's24be',
+    (b'in32', 32): 's32be',
+    (b'fl32', 32): 'f32be',
+    (b'fl64', 64): 'f64be',
+}
+
+# Kinds of tracks
+TRACK_VIDEO = "video"  # H.264 samples found by walking NAL units
+TRACK_FIXED = "fixed"  # Samples of a constant size (PCM audio, timed metadata) stored in chunks
+TRACK_UNSUPPORTED = "unsupported"  # Variable size samples that cannot be delimited (AAC audio)
+
+
+class TrackProfile:
+    # What a reference track tells us about the same track in a corrupt recording
+    def __init__(self, index, handler, codec):
+        self.index = index  # Position of the 'trak' in the reference 'moov'
+        self.handler = handler
+        self.codec = codec
+        self.kind = TRACK_UNSUPPORTED
+        self.timescale = 0
+        self.sample_duration = 0
+        self.has_ctts = False
+
+        # Video tracks
+        self.nal_length_size = 4
+        self.sps = []
+        self.pps = []
+        self.sequence = None
+
+        # Tracks with constant size samples
+        self.stsz_sample_size = 0  # Sample size field written in 'stsz'
+        self.bytes_per_sample = 0  # Bytes taken in the media data by one 'stsz' sample
+        self.chunk_sizes = []  # Chunk sizes in bytes, most common first
+        self.pcm_format = None
+        self.sample_rate = 0
+        self.channels = 0
+
+
+class ReferenceProfile:
+    # Codec parameters, timing and box templates taken from a healthy reference recording
+    def __init__(self, path, ftyp, moov, movie_timescale, tracks):
+        self.path = path
+        self.ftyp = ftyp
+        self.moov = moov
+        self.movie_timescale = movie_timescale
+        self.tracks = tracks
+
+    @property
+    def video(self):
+        return next((track for track in self.tracks if track.kind == TRACK_VIDEO), None)
+
+    @property
+    def audio(self):
+        return next((track for track in self.tracks if track.kind == TRACK_FIXED and track.pcm_format), None)
+
+    @property
+    def fixed_tracks(self):
+        return [track for track in self.tracks if track.kind == TRACK_FIXED]
+
+    @property
+    def framerate(self):
+        # Frame rate as ffmpeg expects it, for example '30000/1001'
+        video = self.video
+        if video is None or not video.sample_duration:
+            return None
+        rate = Fraction(video.timescale, video.sample_duration)
+        return str(rate.numerator) if rate.denominator == 1 else f"{rate.numerator}/{rate.denominator}"
+
+
+def read_full_box_entries(payload, entry_format, fields=1, count_offset=4):
+    # Return the table of a full box made of an entry count and big-endian entries of
+    # `fields` values each as a flat array
+    count = struct.unpack_from('>I', payload, count_offset)[0]
+    entries = array(entry_format)
+    entries.frombytes(payload[count_offset + 4:count_offset + 4 + count * fields * entries.itemsize])
+    if sys.byteorder == 'little':
+        entries.byteswap()
+    return entries
+
+
+def most_common(values, default=0):
+    counts = Counter(values)
+    return counts.most_common(1)[0][0] if counts else default
+
+
+def parse_sound_description(entry):
+    # Return (bits per sample, channels, sample rate, format flags) of a QuickTime/ISO audio
+    # sample entry; only version 2 entries ('lpcm') carry format flags
+    version = struct.unpack_from('>H', entry, 16)[0]
+    if version == 2:
+        sample_rate, channels = struct.unpack_from('>dI', entry, 40)
+        bits, flags = struct.unpack_from('>II', entry, 56)
+        return bits, channels, int(sample_rate), flags
+    channels, bits = struct.unpack_from('>HH', entry, 24)
+    sample_rate = struct.unpack_from('>I', entry, 32)[0] >> 16
+    return bits, channels, sample_rate, None
+
+
+def pcm_format(codec, bits, flags):
+    if codec == b'lpcm' and flags is not None:
+        # kAudioFormatFlagIsFloat = 1, kAudioFormatFlagIsBigEndian = 2
+        kind = 'f' if flags & 1 else 's'
+        endian = 'be' if flags & 2 else 'le'
+        return f"{kind}{bits}{endian}" if bits > 8 else f"{kind}8"
+    return PCM_FORMATS.get((codec, bits))
+
+
+def read_reference_profile(path):
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        file_size = f.tell()
+        top_level = index_boxes(f, 0, file_size)
+        ftyp = next((box for box in top_level if box.type == b'ftyp'), None)
+        moov = next((box for box in top_level if box.type == b'moov'), None)
+        if moov is None:
+            raise ValueError(f"The reference file {path} has no 'moov' box.")
+        media_data = [(box.payload_offset, box.end) for box in top_level if box.type == b'mdat']
+
+        f.seek(moov.offset)
+        moov_data = f.read(moov.size)
+        ftyp_data = b''
+        if ftyp is not None:
+            f.seek(ftyp.offset)
+            ftyp_data = f.read(ftyp.size)
+
+    # Parse the 'moov' from memory, re-based at offset 0
+    data = io.BytesIO(moov_data)
+    moov = index_boxes(data, 0, len(moov_data))[0]
+    mvhd = read_box_payload(data, find_child(data, moov, b'mvhd'))
+    movie_timescale = struct.unpack_from('>I', mvhd, 20 if mvhd[0] == 1 else 12)[0]
+
+    tracks = []
+    chunk_layouts = []
+    chunk_owners = []
+    for index, trak in enumerate(find_children(data, moov, b'trak')):
+        track, chunk_offsets, samples_per_chunk = read_track_profile(data, trak, index)
+        tracks.append(track)
+        chunk_layouts.append(samples_per_chunk)
+        for chunk_index, offset in enumerate(chunk_offsets):
+            chunk_owners.append((offset, index, chunk_index))
+
+    # The size of a chunk in the media data runs up to the next chunk of any track
+    chunk_owners.sort()
+    chunk_lengths = [[0] * len(samples_per_chunk) for samples_per_chunk in chunk_layouts]
+    for position, (offset, index, chunk_index) in enumerate(chunk_owners):
+        end = next((data_end for data_start, data_end in media_data if data_start <= offset < data_end), offset)
+        if position + 1 < len(chunk_owners):
+            end = min(end, chunk_owners[position + 1][0])
+        chunk_lengths[index][chunk_index] = end - offset
+
+    for track in tracks:
+        if track.kind == TRACK_FIXED:
+            learn_chunk_layout(track, chunk_lengths[track.index], chunk_layouts[track.index])
+
+    return ReferenceProfile(path, ftyp_data, moov_data, movie_timescale, tracks)
+
+
+def read_track_profile(data, trak, index):
+    handler = read_box_payload(data, find_child(data, trak, b'mdia', b'hdlr'))[8:12]
+    mdhd = read_box_payload(data, find_child(data, trak, b'mdia', b'mdhd'))
+    stbl = find_child(data, trak, b'mdia', b'minf', b'stbl')
+
+    stsd = find_child(data, stbl, b'stsd')
+    entry_box = child_boxes(data, stsd, skip=8)[0]
+    data.seek(entry_box.offset)
+    entry = data.read(entry_box.size)
+
+    track = TrackProfile(index, handler, entry_box.type)
+    track.timescale = struct.unpack_from('>I', mdhd, 20 if mdhd[0] == 1 else 12)[0]
+
+    # The most common sample duration
+    stts = read_full_box_entries(read_box_payload(data, find_child(data, stbl, b'stts')), 'I', fields=2)
+    durations = Counter()
+    for i in range(0, len(stts), 2):
+        durations[stts[i + 1]] += stts[i]
+    track.sample_duration = most_common(durations)
+    track.has_ctts = find_child(data, stbl, b'ctts') is not None
+
+    stco = find_child(data, stbl, b'stco')
+    if stco is not None:
+        chunk_offsets = read_full_box_entries(read_box_payload(data, stco), 'I')
+    else:
+        chunk_offsets = read_full_box_entries(read_box_payload(data, find_child(data, stbl, b'co64')), 'Q')
+    stsc = read_full_box_entries(read_box_payload(data, find_child(data, stbl, b'stsc')), 'I', fields=3)
+    samples_per_chunk = expand_samples_per_chunk(stsc, len(chunk_offsets))
+
+    stsz = read_box_payload(data, find_child(data, stbl, b'stsz'))
+    track.stsz_sample_size = struct.unpack_from('>I', stsz, 4)[0]
+
+    if handler == b'vide' and track.codec in AVC_CODECS:
+        # The avcC box follows the 78 bytes of the VisualSampleEntry fields
+        entry_data = io.BytesIO(entry)
+        avcc = next((box for box in index_boxes(entry_data, 8 + 78, len(entry)) if box.type == b'avcC'), None)
+        if avcc is not None:
+            track.nal_length_size, track.sps, track.pps = parse_avcc(read_box_payload(entry_data, avcc))
+            try:
+                track.sequence = SequenceParameters(track.sps[0])
+            except (IndexError, ValueError):
+                track.sequence = None
+            track.kind = TRACK_VIDEO
+    elif track.stsz_sample_size:
+        track.kind = TRACK_FIXED
+        if handler == b'soun':
+            bits, track.channels, track.sample_rate, flags = parse_sound_description(entry)
+            track.pcm_format = pcm_format(track.codec, bits, flags)
+
+    return track, chunk_offsets, samples_per_chunk
+
+
+def expand_samples_per_chunk(stsc, chunk_count):
+    # Return the number of samples in each chunk from the (first_chunk, samples_per_chunk,
+    # sample_description_index) runs of 'stsc'
+    samples_per_chunk = array('I')
+    for i in range(0, len(stsc), 3):
+        first_chunk, count = stsc[i], stsc[i + 1]
+        next_first_chunk = stsc[i + 3] if i + 3 < len(stsc) else chunk_count + 1
+        samples_per_chunk.extend([count] * max(next_first_chunk - first_chunk, 0))
+    return samples_per_chunk
+
+
+def learn_chunk_layout(track, chunk_lengths, samples_per_chunk):
+    # Learn how many media data bytes one sample takes and the usual chunk sizes
+    ratios = [
+        length // count for length, count in zip(chunk_lengths, samples_per_chunk)
+        if count and length % count == 0
+    ]
+    track.bytes_per_sample = most_common(ratios)
+    if not track.bytes_per_sample:
+        track.kind = TRACK_UNSUPPORTED
+        return
+    # Sizes of the whole chunks, most common first
+    sizes = Counter(
+        length for length, count in zip(chunk_lengths, samples_per_chunk)
+        if count and length == count * track.bytes_per_sample
+    )
+    track.chunk_sizes = [size for size, _ in sizes.most_common()]
@@ -0,0 +1,178 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from batch import StageTimer, default_worker_count
+from metrics import job_path, measure_stage
+
+# Jobs that read or write the same device share a limit on how many run at once, which
+# follows the throughput measured on that device: it grows while running one more job makes
+# the device faster and shrinks when it makes it slower, so a spinning disk or a card reader
+# ends up with one job at a time and an NVMe drive with as many as it can serve
+
+# Shortest time over which the throughput of a device is measured before its limit changes
+ADAPT_INTERVAL = 2.0
+
+# Relative change of throughput that counts as faster or slower
+THROUGHPUT_CHANGE = 0.1
+
+
+def device_of(path):
+    # The device holding path, or the path itself when it does not exist yet
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return path
+
+
+class DeviceLimit:
+    # The number of jobs running on a device and how many may run, adapted from the bytes the
+    # finished jobs moved
+    def __init__(self, device, name, max_limit, initial_limit=1):
+        self.device = device
+        self.name = name
+        self.max_limit = max_limit
+        self.limit = min(initial_limit, max_limit)
+        self.active = 0
+        self.condition = None
+        self.direction = 1
+        self.previous_throughput = None
+        self.window_start = time.monotonic()
+        self.window_bytes = 0
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self, byte_count):
+        async with self.condition:
+            self.active -= 1
+            changed = self.completed(byte_count)
+            self.condition.notify_all()
+        return changed
+
+    def completed(self, byte_count):
+        # Count the bytes of a finished job; once a window is long enough, compare its
+        # throughput with the previous one and move the limit. Returns whether it moved
+        self.window_bytes += byte_count
+        now = time.monotonic()
+        elapsed = now - self.window_start
+        if elapsed < ADAPT_INTERVAL:
+            return False
+        throughput = self.window_bytes / elapsed
+        self.window_start = now
+        self.window_bytes = 0
+
+        previous, self.previous_throughput = self.previous_throughput, throughput
+        if previous is None:
+            step = self.direction
+        elif throughput > previous * (1 + THROUGHPUT_CHANGE):
+            # The last step helped, take another one
+            step = self.direction
+        else:
+            # Slower, or no faster: go back, fewer jobs are as fast and thrash less
+            self.direction = -self.direction
+            step = self.direction
+
+        limit = min(max(self.limit + step, 1), self.max_limit)
+        if limit == self.limit:
+            # At a bound, the next step goes the other way
+            self.direction = -self.direction
+            return False
+        self.limit = limit
+        return True
+
+
+class DeviceScheduler:
+    # Runs the stages of the jobs of a batch from an event loop, each in a thread once the
+    # devices it reads and writes have room for it. The limits are kept from one batch to the
+    # next, so a scheduler reused by the GUI starts where the last batch left off
+    def __init__(self, max_limit=None, initial_limit=1, log_signal=None):
+        self.max_limit = max(max_limit or default_worker_count(), 1)
+        self.initial_limit = initial_limit
+        self.log_signal = log_signal
+        self.limits = {}
+
+    def limit_of(self, path):
+        device = device_of(path)
+        limit = self.limits.get(device)
+        if limit is None:
+            name = os.path.abspath(path if os.path.isdir(path) else os.path.dirname(path))
+            limit = self.limits[device] = DeviceLimit(device, name, self.max_limit, self.initial_limit)
+        if limit.condition is None:
+            limit.condition = asyncio.Condition()
+        return limit
+
+    async def run(self, func, args, source=None, destination=None, byte_count=0, executor=None):
+        # Run func(*args) in a thread while holding a slot on the source and destination
+        # devices. The slots are taken in a fixed order so two jobs never wait on each other
+        limits = {id(limit): limit for limit in (self.limit_of(path) for path in (source, destination) if path is not None)}
+        limits = sorted(limits.values(), key=lambda limit: str(limit.device))
+        for limit in limits:
+            await limit.acquire()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+        finally:
+            for limit in reversed(limits):
+                if await limit.release(byte_count) and self.log_signal is not None:
+                    throughput = limit.previous_throughput / 1e6
+                    self.log_signal.emit(f"Device of {limit.name}: {limit.limit} jobs at a time ({throughput:.1f} MB/s)")
+
+    def reset_loop(self):
+        # Conditions belong to the event loop that created them
+        for limit in self.limits.values():
+            limit.condition = None
+
+
+def run_scheduled(stages, jobs, log_signal, scheduler=None, on_result=None):
+    # Run every job through stages, a list of (name, func, source, destination) where
+    # func(item, log_signal) returns the item passed to the next stage and source(job) and
+    # destination(job) return the paths it reads and writes; either may be None. Jobs move
+    # from stage to stage on their own, so one job can be muxed while the next is extracted
+    # when the devices allow it. A failing job is logged and dropped, the others keep running.
+    # on_result(job, result, error) is called as each job completes.
+    # Returns a list of (job, result, error) in completion order and the StageTimer
+    if scheduler is None:
+        scheduler = DeviceScheduler(log_signal=log_signal)
+    timer = StageTimer()
+    results = []
+
+    def call_stage(name, func, job, item):
+        start = time.perf_counter()
+        try:
+            with measure_stage(name, job):
+                return func(item, log_signal)
+        finally:
+            timer.add(name, busy=time.perf_counter() - start, count=1)
+
+    async def run_job(job, executor):
+        item = job
+        try:
+            byte_count = os.path.getsize(job_path(job))
+        except OSError:
+            byte_count = 0
+        for name, func, source, destination in stages:
+            try:
+                item = await scheduler.run(
+                    call_stage, (name, func, job, item), source and source(job), destination and destination(job), byte_count, executor,
+                )
+            except Exception as e:
+                log_signal.emit(f"Error: {str(e)}")
+                result = (job, None, e)
+                break
+        else:
+            result = (job, item, None)
+        results.append(result)
+        if on_result is not None:
+            on_result(*result)
+
+    async def run_jobs():
+        scheduler.reset_loop()
+        # Enough threads for every device to reach its limit
+        with ThreadPoolExecutor(max_workers=2 * scheduler.max_limit) as executor:
+            await asyncio.gather(*(run_job(job, executor) for job in jobs))
+
+    if jobs:
+        asyncio.run(run_jobs())
+    return results, timer
@@ -0,0 +1,169 @@
+import os
+import shutil
+import struct
+import pytest
+import corpus
+from batch import LogCollector
+from carve import CARVE_HEADER, CARVE_INTACT, CARVE_SCAN, carve_image
+from integrity import find_duplicates
+from isobmff import child_boxes, find_child, find_children, index_boxes, read_box_payload
+from manifest import MANIFEST_FILE, STAGE_MUXED, STAGE_REPAIRED, JobManifest
+from mp4_writer import write_repaired_copy, write_sidecar_index
+from recover_mp4 import scan_single_file
+from reference_profile import read_reference_profile
+from triage import TRIAGE_HEADER_DAMAGED, TRIAGE_HEALTHY, TRIAGE_TRUNCATED, triage_file
+from videorepair import journal_path, repair_single_video, undo_in_place_repair
+
+# Behavioral checks of the repair paths on the synthetic recordings of the corpus, whose
+# layout is known: 'ftyp', an 'mdat' with a 64-bit size, then the 'moov'
+
+# Small frames keep the recordings at a few megabytes
+FRAME_SIZE = 64 * 1024
+RECORDING_SIZE = 2 * 1024 * 1024
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def record(path, size=RECORDING_SIZE):
+    # A healthy recording and its bytes
+    recording = corpus.generate_recording(str(path), size, FRAME_SIZE)
+    return recording, read_file(recording['path'])
+
+
+def damaged_copy(recording, path, mode):
+    shutil.copy(recording['path'], str(path))
+    return corpus.damage_recording(dict(recording, path=str(path)), mode)
+
+
+def sample_tables(path):
+    # The payloads of the boxes of the sample table of each track, by box type
+    with open(path, 'rb') as f:
+        moov = next(box for box in index_boxes(f) if box.type == b'moov')
+        tables = []
+        for trak in find_children(f, moov, b'trak'):
+            stbl = find_child(f, trak, b'mdia', b'minf', b'stbl')
+            tables.append({box.type: read_box_payload(f, box) for box in child_boxes(f, stbl)})
+    return tables
+
+
+def test_header_repair_restores_the_original_bytes(tmp_path):
+    recording, original = record(tmp_path / "C0001.MOV")
+    damaged = damaged_copy(recording, tmp_path / "damaged.MOV", corpus.DAMAGE_ZEROED_HEADER)
+    with open(damaged['path'], 'ab') as f:
+        f.write(b'\xff' * 1000)
+    output_directory = tmp_path / "Repaired"
+    output_directory.mkdir()
+
+    repaired_path = repair_single_video((damaged['path'], None, str(output_directory), False), LogCollector())
+
+    # A 64-bit 'mdat' header up to the 'moov' replaces the zeroed headers, the trailing bytes are dropped
+    repaired = read_file(repaired_path)
+    assert repaired[:16] == struct.pack('>I4sQ', 1, b'mdat', recording['moov_offset'])
+    assert len(repaired) == len(original)
+    assert repaired[recording['media_start']:] == original[recording['media_start']:]
+
+
+def test_undo_in_place_repair_restores_the_original_file(tmp_path):
+    recording, _ = record(tmp_path / "C0001.MOV")
+    damaged = damaged_copy(recording, tmp_path / "damaged.MOV", corpus.DAMAGE_ZEROED_HEADER)
+    with open(damaged['path'], 'ab') as f:
+        f.write(b'\xff' * 1000)
+    before = read_file(damaged['path'])
+    mtime_ns = os.stat(damaged['path']).st_mtime_ns
+
+    repair_single_video((damaged['path'], None, str(tmp_path), True), LogCollector())
+    assert read_file(damaged['path']) != before
+    assert os.path.exists(journal_path(damaged['path']))
+
+    undo_in_place_repair(damaged['path'], LogCollector())
+    assert read_file(damaged['path']) == before
+    assert os.stat(damaged['path']).st_mtime_ns == mtime_ns
+    assert not os.path.exists(journal_path(damaged['path']))
+
+
+@pytest.mark.parametrize("write", [write_repaired_copy, write_sidecar_index])
+def test_native_rebuild_matches_the_original_sample_tables(tmp_path, write):
+    reference, _ = record(tmp_path / "reference.MOV", RECORDING_SIZE // 2)
+    recording, _ = record(tmp_path / "C0001.MOV")
+    damaged = damaged_copy(recording, tmp_path / "damaged.MOV", corpus.DAMAGE_MISSING_MOOV)
+    profile = read_reference_profile(reference['path'])
+
+    _, scan = scan_single_file((damaged['path'], profile), LogCollector())
+    output_path = str(tmp_path / "rebuilt.MOV")
+    write(profile, scan, damaged['path'], output_path)
+
+    # The copy keeps the media data at its offset and the sidecar points into the damaged
+    # file, so even the chunk offsets match
+    assert sample_tables(output_path) == sample_tables(recording['path'])
+
+
+@pytest.mark.parametrize("mode, status", [
+    (corpus.DAMAGE_NONE, TRIAGE_HEALTHY),
+    (corpus.DAMAGE_ZEROED_HEADER, TRIAGE_HEADER_DAMAGED),
+    (corpus.DAMAGE_TRUNCATED, TRIAGE_TRUNCATED),
+    (corpus.DAMAGE_MISSING_MOOV, TRIAGE_TRUNCATED),
+])
+def test_triage_classifies_each_damage(tmp_path, mode, status):
+    recording, _ = record(tmp_path / "C0001.MOV")
+    damaged = corpus.damage_recording(recording, mode)
+    assert triage_file(damaged['path']).status == status
+
+
+def test_carve_round_trip(tmp_path):
+    # An image holding an intact clip, a clip whose 'ftyp' and 'mdat' header were wiped and a
+    # clip whose 'moov' was never written, between unused blocks
+    reference, _ = record(tmp_path / "reference.MOV", RECORDING_SIZE // 2)
+    intact, intact_bytes = record(tmp_path / "intact.MOV")
+    wiped, wiped_bytes = record(tmp_path / "wiped.MOV", RECORDING_SIZE + 3 * FRAME_SIZE)
+    unfinished, _ = record(tmp_path / "unfinished.MOV", RECORDING_SIZE + 6 * FRAME_SIZE)
+    unfinished_bytes = read_file(unfinished['path'])[:unfinished['moov_offset']]
+
+    image_path = str(tmp_path / "card.img")
+    offsets = []
+    with open(image_path, 'wb') as image:
+        for data in (intact_bytes, bytes(wiped['media_start']) + wiped_bytes[wiped['media_start']:], unfinished_bytes):
+            image.write(bytes(8192))
+            offsets.append(image.tell())
+            image.write(data)
+        image.write(bytes(8192))
+
+    output_directory = str(tmp_path / "carved")
+    results = carve_image(image_path, output_directory, LogCollector(), reference['path'], workers=1)
+
+    assert [(clip.start, clip.strategy, error) for clip, _, error in results] == [
+        (offsets[0], CARVE_INTACT, None), (offsets[1], CARVE_HEADER, None), (offsets[2], CARVE_SCAN, None),
+    ]
+    (_, intact_output, _), (_, wiped_output, _), (_, unfinished_output, _) = results
+    assert read_file(intact_output) == intact_bytes
+    carved = read_file(wiped_output)
+    assert carved[:16] == struct.pack('>I4sQ', 1, b'mdat', wiped['moov_offset'])
+    assert carved[wiped['media_start']:] == wiped_bytes[wiped['media_start']:]
+    assert sample_tables(unfinished_output) == sample_tables(unfinished['path'])
+
+
+def test_manifest_keeps_the_last_record_and_compacts(tmp_path):
+    recording, _ = record(tmp_path / "C0001.MOV")
+    manifest = JobManifest(str(tmp_path))
+    manifest.record(recording['path'], STAGE_REPAIRED, repaired="first")
+    manifest.record(recording['path'], STAGE_MUXED, repaired="second")
+    manifest_path = tmp_path / MANIFEST_FILE
+    with open(manifest_path, 'a') as f:
+        f.write('{"size": 1, "mtime')
+
+    manifest = JobManifest(str(tmp_path))
+    assert manifest.stage(recording['path']) == (STAGE_MUXED, {'repaired': "second"})
+    assert len(manifest_path.read_text().splitlines()) == 1
+
+
+def test_duplicates_are_repaired_once(tmp_path):
+    recording, _ = record(tmp_path / "C0001.MOV")
+    copy_path = str(tmp_path / "copy.MOV")
+    shutil.copy(recording['path'], copy_path)
+    other, _ = record(tmp_path / "C0002.MOV", RECORDING_SIZE + 3 * FRAME_SIZE)
+
+    files, duplicates = find_duplicates([recording['path'], copy_path, other['path']])
+    assert files == [recording['path'], other['path']]
+    assert duplicates == {copy_path: recording['path']}
@@ -0,0 +1,166 @@
+import fnmatch
+import mmap
+import os
+import struct
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from batch import default_worker_count
+from isobmff import find_media_data_start, is_valid_container, locate_moov, walk_boxes
+from mdat_scanner import NalCandidateFinder, is_nal_chain
+
+# What a quick look at a file says about it
+TRIAGE_HEALTHY = "healthy"  # Complete box structure, nothing to repair
+TRIAGE_HEADER_DAMAGED = "header-damaged"  # Valid 'moov', damaged 'mdat' header or trailing bytes
+TRIAGE_TRUNCATED = "truncated"  # Intact start but no 'moov': the recording was cut short
+TRIAGE_NEEDS_STREAM_RECOVERY = "needs-stream-recovery"  # No usable boxes, but video data
+TRIAGE_UNRECOVERABLE = "unrecoverable"  # Empty, zero-filled or not video at all
+
+# Repair that fixes each kind of file for the least I/O; None means the file is skipped
+STRATEGY_HEADER = "header"  # Rewrite the 'mdat' header and drop the trailing bytes
+STRATEGY_RECOVER = "recover"  # Extract the streams with a reference file and rebuild the file
+TRIAGE_STRATEGIES = {
+    TRIAGE_HEALTHY: None,
+    TRIAGE_HEADER_DAMAGED: STRATEGY_HEADER,
+    TRIAGE_TRUNCATED: STRATEGY_RECOVER,
+    TRIAGE_NEEDS_STREAM_RECOVERY: STRATEGY_RECOVER,
+    TRIAGE_UNRECOVERABLE: None,
+}
+
+# Bytes read at the start of a file to look for video data, and at its end to look for a 'moov'
+TRIAGE_HEAD_SIZE = 64 * 1024
+TRIAGE_TAIL_SIZE = 256 * 1024
+
+# When the tail holds pieces of a 'moov' but not its start, the search goes back this far
+TRIAGE_MOOV_SEARCH_SIZE = 64 * 1024 * 1024
+
+# Number of NAL units that must follow each other for the data to pass for H.264 video
+TRIAGE_NAL_DEPTH = 3
+
+# Names of the files the repairs look at by default; cameras and copy tools differ in case
+VIDEO_PATTERNS = ("*.mp4", "*.mov")
+
+# Boxes found near the end of a 'moov' at the end of a file
+MOOV_TAIL_MARKERS = (b'stco', b'co64', b'stsz', b'udta')
+
+
+class TriageResult(namedtuple('TriageResult', ['path', 'size', 'status', 'reason'])):
+    # The class of a file and why it was given
+
+    @property
+    def strategy(self):
+        return TRIAGE_STRATEGIES[self.status]
+
+
+def find_tail_moov(data, size):
+    # Look for a valid 'moov' near the end of the file, where cameras write it, reading as
+    # little as possible: a longer search only happens when the tail looks like part of a 'moov'
+    tail_start = max(size - TRIAGE_TAIL_SIZE, 0)
+    moov = locate_moov(data, size, start=tail_start)
+    if moov is not None or tail_start == 0:
+        return moov
+    if all(data.find(marker, tail_start, size) == -1 for marker in MOOV_TAIL_MARKERS):
+        return None
+    return locate_moov(data, size, start=max(size - TRIAGE_MOOV_SEARCH_SIZE, 0))
+
+
+def looks_like_video(data, head, size):
+    # Whether the head of the file holds H.264 access units, wherever the media data starts.
+    # Cameras write 4 byte NAL lengths; the chain of NAL units may continue past the head
+    return any(is_nal_chain(data, candidate, size, 4, TRIAGE_NAL_DEPTH) for candidate in NalCandidateFinder(4).find(head, 0, len(head)))
+
+
+def declared_mdat_end(data, offset, size):
+    # Where the 'mdat' box at offset says it ends, or None when there is none or its size
+    # leaves it open to the end of the file
+    if size - offset < 16 or data[offset + 4:offset + 8] != b'mdat':
+        return None
+    declared_size = struct.unpack_from('>I', data, offset)[0]
+    if declared_size == 1:
+        declared_size = struct.unpack_from('>Q', data, offset + 8)[0]
+    return offset + declared_size if declared_size else None
+
+
+def triage_file(path):
+    try:
+        size = os.path.getsize(path)
+        if size == 0:
+            return TriageResult(path, size, TRIAGE_UNRECOVERABLE, "The file is empty.")
+
+        with open(path, 'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # Walk the top level boxes from the start; a healthy file is fully covered
+                boxes = []
+                try:
+                    for box in walk_boxes(data, 0, size):
+                        boxes.append(box)
+                    walked = True
+                except ValueError:
+                    walked = False
+
+                moov = next((box for box in boxes if box.type == b'moov'), None)
+                has_mdat = any(box.type == b'mdat' for box in boxes)
+                if moov is not None and not is_valid_container(data, moov):
+                    moov = None
+                if walked and moov is not None and has_mdat:
+                    return TriageResult(path, size, TRIAGE_HEALTHY, "The box structure is complete.")
+
+                if moov is None:
+                    moov = find_tail_moov(data, size)
+                if moov is not None:
+                    if not boxes:
+                        reason = "The first box header is damaged, a valid 'moov' follows the media data."
+                    elif moov.end < size:
+                        reason = f"{size - moov.end} bytes follow the 'moov' box."
+                    else:
+                        reason = "The 'mdat' header does not match the file."
+                    return TriageResult(path, size, TRIAGE_HEADER_DAMAGED, reason)
+
+                if find_media_data_start(data, size) is not None:
+                    # The walk stops at an 'mdat' that runs past the end of a file cut short
+                    mdat_end = declared_mdat_end(data, boxes[-1].end if boxes else 0, size)
+                    if mdat_end is not None and mdat_end > size:
+                        reason = f"The 'moov' box is missing and the 'mdat' box runs {mdat_end - size} bytes past the end of the file."
+                    else:
+                        reason = "The 'moov' box is missing."
+                    return TriageResult(path, size, TRIAGE_TRUNCATED, reason)
+
+                # Only read whole blocks once the boxes gave nothing
+                head = data[:TRIAGE_HEAD_SIZE]
+                if not head.strip(b'\x00') and not data[max(size - TRIAGE_TAIL_SIZE, 0):].strip(b'\x00'):
+                    return TriageResult(path, size, TRIAGE_UNRECOVERABLE, "The file is filled with zeros.")
+                if looks_like_video(data, head, size):
+                    return TriageResult(path, size, TRIAGE_NEEDS_STREAM_RECOVERY, "No usable boxes, but the data holds H.264 video.")
+                return TriageResult(path, size, TRIAGE_UNRECOVERABLE, "Neither boxes nor video data were found.")
+
+    except (OSError, ValueError) as e:
+        return TriageResult(path, 0, TRIAGE_UNRECOVERABLE, f"The file could not be read: {e}")
+
+
+def matches_patterns(name, patterns):
+    # Whether the file name matches one of the glob patterns, ignoring case; None matches all
+    return patterns is None or any(fnmatch.fnmatchcase(name.lower(), pattern.lower()) for pattern in patterns)
+
+
+def list_files(folder, patterns=None, recursive=False):
+    # Return the regular files of the folder, and of its subfolders when recursive, whose name
+    # matches one of the patterns in any case
+    files = []
+    directories = [folder]
+    while directories:
+        with os.scandir(directories.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        directories.append(entry.path)
+                elif entry.is_file() and matches_patterns(entry.name, patterns):
+                    files.append(entry.path)
+    return sorted(files)
+
+
+def triage_files(paths, workers=None):
+    # Triage the files with a pool of threads: the work is a few small reads per file
+    paths = list(paths)
+    if not paths:
+        return []
+    with ThreadPoolExecutor(max_workers=workers or 4 * default_worker_count()) as executor:
+        return list(executor.map(triage_file, paths))
@@ -0,0 +1,328 @@
+import argparse
+import json
+import os
+import sys
+from batch import ConsoleLog, FileSkipped
+from watch import DEFAULT_WATCH_INTERVAL
+
+# This entry point must never import PyQt6 so it starts fast on headless servers and in containers
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Repair corrupted MOV/MP4 files without a GUI. Prints one JSON result per file on stdout; logs go to stderr.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("folder", help="Folder holding the corrupted files")
+    common.add_argument("-o", "--output", help="Folder for the repaired files (default: <folder>/Repaired)")
+    common.add_argument("-w", "--workers", type=int, help="Number of files repaired in parallel, at most per device with the device scheduler (default: number of CPUs)")
+    common.add_argument("--scheduler", choices=("devices", "threads"), default="devices", help="Run as many files at once as each source and destination device keeps up with, measured as the batch runs, or always --workers (default: %(default)s)")
+    common.add_argument("-i", "--include", action="append", metavar="PATTERN", help="Only repair the files whose name matches this glob pattern (repeatable)")
+    common.add_argument("--no-triage", dest="triage", action="store_false", help="Repair every file instead of first skipping the healthy ones and those the repair cannot fix")
+    common.add_argument("--no-dedupe", dest="dedupe", action="store_false", help="Repair every copy of a clip instead of repairing it once and reusing the result for its copies")
+    common.add_argument("--no-verify", dest="verify", action="store_false", help="Do not hash the repaired files and check their 'moov' box")
+    common.add_argument("--metrics", metavar="FILE", help="Write the time, bytes read and written and command CPU time of each stage of each file to FILE: a Prometheus text file when it ends in .prom, JSON lines otherwise")
+    common.add_argument("--profile", nargs="?", const="", metavar="FILE", help="Run the batch under cProfile and save the statistics to FILE, or print the slowest functions to stderr")
+    common.add_argument("--watch", action="store_true", help="Keep watching the folder and its subfolders, and repair each new file once its size stops changing; stop with Ctrl+C")
+    common.add_argument("--interval", type=float, default=DEFAULT_WATCH_INTERVAL, help="Seconds between two scans of the watched folder (default: %(default)s)")
+    common.add_argument("--settle", type=float, help="Seconds a watched file must keep the same size and time before it is repaired (default: --interval)")
+
+    header = subparsers.add_parser("header", parents=[common], help="Rebuild the 'mdat' header of each file and drop its trailing bytes")
+    header.add_argument("-r", "--reference", default="", help="Reference MOV/MP4 file (not needed by this repair)")
+    header.add_argument("--in-place", action="store_true", help="Patch the corrupted files instead of writing repaired copies; the replaced bytes are kept in a journal next to each file for 'undo'")
+
+    triage = subparsers.add_parser("triage", help="Classify the files from their first and last blocks without repairing them")
+    triage.add_argument("folder", help="Folder holding the files to classify")
+    triage.add_argument("-i", "--include", action="append", metavar="PATTERN", help="Only classify the files whose name matches this glob pattern (repeatable)")
+    triage.add_argument("-R", "--recursive", action="store_true", help="Also classify the files in the subfolders")
+    triage.add_argument("-w", "--workers", type=int, help="Number of files read in parallel (default: four per CPU)")
+
+    profiles = subparsers.add_parser("profiles", help="Manage the library of reference profiles used when 'recover' has no --reference")
+    profiles.add_argument("--library", help="Folder of the library (default: $VIDEO_REPAIR_PROFILES or ~/.local/share/video-repair-tool/profiles)")
+    profiles_commands = profiles.add_subparsers(dest="profiles_command", required=True)
+    profiles_add = profiles_commands.add_parser("add", help="Add the profiles of healthy reference files")
+    profiles_add.add_argument("paths", nargs="+", help="Healthy MOV/MP4 files, one per camera and recording mode")
+    profiles_add.add_argument("--name", help="Name of the profile (default: the file name)")
+    profiles_commands.add_parser("list", help="List the profiles")
+    profiles_remove = profiles_commands.add_parser("remove", help="Remove profiles")
+    profiles_remove.add_argument("keys", nargs="+", help="Keys of the profiles, as listed")
+    profiles_match = profiles_commands.add_parser("match", help="Show the profile each file would be repaired with")
+    profiles_match.add_argument("paths", nargs="+", help="Corrupted files")
+
+    carve = subparsers.add_parser("carve", help="Find the MOV/MP4 clips in a disk or card image and repair each from its byte range of the image")
+    carve.add_argument("image", help="Disk or card image, or a block device")
+    carve.add_argument("-o", "--output", help="Folder for the carved files (default: <image name>-carved next to the image)")
+    carve.add_argument("-r", "--reference", help="Healthy MOV/MP4 file recorded with the same camera settings, to rebuild the clips whose 'moov' is lost")
+    carve.add_argument("-w", "--workers", type=int, help="Number of processes searching the image and of clips written in parallel (default: number of CPUs)")
+    carve.add_argument("--list", action="store_true", help="Only list the clips found, without writing them")
+    carve.add_argument("--no-verify", dest="verify", action="store_false", help="Do not hash the carved files and check their 'moov' box")
+
+    undo = subparsers.add_parser("undo", help="Restore files repaired with 'header --in-place' from their journals")
+    undo.add_argument("paths", nargs="+", help="Files repaired in place, or folders holding them")
+
+    recover = subparsers.add_parser("recover", parents=[common], help="Extract the streams with recover_mp4 and mux them again with ffmpeg")
+    recover.add_argument("-r", "--reference", help="Healthy MOV/MP4 file recorded with the same camera settings (default: match each file to a profile of the library)")
+    recover.add_argument("--library", help="Folder of the reference profile library (default: $VIDEO_REPAIR_PROFILES or ~/.local/share/video-repair-tool/profiles)")
+    recover.add_argument("--extractor", choices=("recover_mp4", "native"), default="recover_mp4", help="Extract the streams with recover_mp4, or with the built-in scanner that pipes them to ffmpeg without temp files (default: %(default)s)")
+    recover.add_argument("--temp", help="Folder for the extracted streams (default: <folder>/Temp)")
+    recover.add_argument("--recover-mp4", default="recover_mp4.exe", help="Path to recover_mp4 (default: %(default)s)")
+    recover.add_argument("--ffmpeg", default="ffmpeg", help="Path to ffmpeg (default: %(default)s)")
+    recover.add_argument("--muxer", choices=("ffmpeg", "copy", "sidecar"), default="ffmpeg", help="Remux with ffmpeg, copy the media data behind a rebuilt 'moov', or only write a sidecar index pointing at the corrupted file; copy and sidecar imply --extractor native. Few players follow the external data reference of a sidecar index: ffmpeg needs -enable_drefs 1 -use_absolute_path 1 and must run in the folder of the index (default: %(default)s)")
+    recover.add_argument("--timeout", type=float, help="Kill recover_mp4 or ffmpeg after this many seconds")
+    recover.add_argument("--idle-timeout", type=float, help="Kill recover_mp4 or ffmpeg when it prints nothing for this many seconds")
+
+    return parser.parse_args(argv)
+
+
+def undo_repairs(paths, log_signal):
+    from videorepair import JOURNAL_SUFFIX, undo_in_place_repair
+
+    # Folders stand for every file in them that has a journal
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(
+                os.path.join(path, f[:-len(JOURNAL_SUFFIX)]) for f in sorted(os.listdir(path)) if f.endswith(JOURNAL_SUFFIX)
+            )
+        else:
+            files.append(path)
+
+    results = []
+    for file_path in files:
+        try:
+            results.append((file_path, undo_in_place_repair(file_path, log_signal), None))
+        except Exception as e:
+            log_signal.emit(f"Error restoring {file_path}: {str(e)}")
+            results.append((file_path, None, e))
+    return results
+
+
+def print_triage(arguments, results_stream):
+    from triage import list_files, triage_files
+
+    # One JSON line per file with its class and the repair that would fix it
+    results = triage_files(list_files(arguments.folder, arguments.include, arguments.recursive), arguments.workers)
+    for result in results:
+        json.dump({"input": result.path, "status": result.status, "strategy": result.strategy, "reason": result.reason}, results_stream)
+        results_stream.write("\n")
+    results_stream.flush()
+    return 0
+
+
+def print_carve(arguments, results_stream):
+    from carve import carve_image, find_clips
+
+    # One JSON line per clip found in the image, by offset
+    log_signal = ConsoleLog()
+    if arguments.list:
+        results = [(clip, None, None) for clip in find_clips(arguments.image, log_signal, arguments.workers)]
+    else:
+        output_directory = arguments.output or os.path.splitext(arguments.image)[0] + "-carved"
+        results = carve_image(arguments.image, output_directory, log_signal, arguments.reference, arguments.workers, arguments.verify)
+    sys.stdout.flush()
+    if results is None:
+        print_batch_failure(results_stream)
+        return 2
+
+    failed = 0
+    for clip, output_path, error in results:
+        result = {"input": arguments.image, "offset": clip.start, "size": clip.size, "strategy": clip.strategy}
+        if arguments.list:
+            result["status"] = "found"
+        elif error is None and output_path is not None:
+            result.update(status="repaired", output=output_path)
+        else:
+            failed += 1
+            result.update(status="failed", error=str(error) if error else "See the log.")
+        json.dump(result, results_stream)
+        results_stream.write("\n")
+    results_stream.flush()
+    return 1 if failed else 0
+
+
+def print_profiles(arguments, results_stream):
+    from profile_library import ProfileLibrary
+
+    # One JSON line per profile or per file
+    library = ProfileLibrary(arguments.library)
+    failed = 0
+    lines = []
+    if arguments.profiles_command == "list":
+        lines = [
+            {"key": entry['key'], "name": entry['name'], "source": entry['source'], "brand": entry['brand'], "framerate": entry['framerate']}
+            for entry in library.entries.values()
+        ]
+    for path in getattr(arguments, 'paths', []):
+        try:
+            if arguments.profiles_command == "add":
+                entry = library.add(path, arguments.name)
+                lines.append({"input": path, "status": "added", "key": entry['key'], "name": entry['name']})
+            else:
+                entry, score = library.match(path)
+                lines.append({"input": path, "status": "matched" if entry else "unmatched", "key": entry and entry['key'], "name": entry and entry['name'], "score": score})
+        except (OSError, ValueError, IndexError) as e:
+            failed += 1
+            lines.append({"input": path, "status": "failed", "error": str(e)})
+    for key in getattr(arguments, 'keys', []):
+        if key in library.entries:
+            lines.append({"key": key, "status": "removed", "name": library.remove(key)['name']})
+        else:
+            failed += 1
+            lines.append({"key": key, "status": "failed", "error": "No such profile."})
+
+    for line in lines:
+        json.dump(line, results_stream)
+        results_stream.write("\n")
+    results_stream.flush()
+    return 1 if failed else 0
+
+
+def output_folders(arguments):
+    # The folders the repairs write to, which a watch of the corrupted folder must not scan
+    folders = [arguments.output or os.path.join(arguments.folder, "Repaired")]
+    if arguments.command == "recover":
+        folders.append(arguments.temp or os.path.join(arguments.folder, "Temp"))
+    return folders
+
+
+def run(arguments, log_signal, files=None):
+    if arguments.command == "undo":
+        return undo_repairs(arguments.paths, log_signal)
+
+    output_directory = output_folders(arguments)[0]
+    scheduler = None
+    if arguments.scheduler == "devices":
+        from scheduler import DeviceScheduler
+        scheduler = DeviceScheduler(arguments.workers, log_signal=log_signal)
+
+    if arguments.command == "header":
+        from videorepair import repair_files_in_directory
+
+        os.makedirs(output_directory, exist_ok=True)
+        results = repair_files_in_directory(
+            arguments.folder, arguments.reference, output_directory, log_signal,
+            workers=arguments.workers, patterns=arguments.include, in_place=arguments.in_place, triage=arguments.triage,
+            dedupe=arguments.dedupe, verify=arguments.verify, scheduler=scheduler, files=files,
+        )
+        # The jobs are (corrupt file, reference file, output directory, in place) tuples
+        return results and [(job[0], result, error) for job, result, error in results]
+
+    from profile_library import ProfileLibrary
+    from recover_mp4 import DEFAULT_PATTERNS, process_files
+
+    temp_folder = output_folders(arguments)[1]
+    return process_files(
+        arguments.folder, output_directory, temp_folder, arguments.reference, arguments.recover_mp4, arguments.ffmpeg,
+        log_signal, workers=arguments.workers, command_timeout=arguments.timeout, idle_timeout=arguments.idle_timeout,
+        patterns=arguments.include or DEFAULT_PATTERNS, extractor=arguments.extractor, muxer=arguments.muxer,
+        triage=arguments.triage, library=None if arguments.reference else ProfileLibrary(arguments.library),
+        dedupe=arguments.dedupe, verify=arguments.verify, scheduler=scheduler, files=files,
+    )
+
+
+def print_results(arguments, results, results_stream):
+    # One JSON line per file; returns the number of failures. Skipped files are not failures
+    failed = 0
+    for input_path, output_path, error in results:
+        if error is None and output_path is not None:
+            status = "restored" if arguments.command == "undo" else "repaired"
+            result = {"input": input_path, "status": status, "output": output_path}
+        elif isinstance(error, FileSkipped):
+            result = {"input": input_path, "status": "skipped", "reason": str(error)}
+            if output_path is not None:
+                result["output"] = output_path
+        else:
+            failed += 1
+            result = {"input": input_path, "status": "failed", "error": str(error) if error else "See the log."}
+        json.dump(result, results_stream)
+        results_stream.write("\n")
+    results_stream.flush()
+    return failed
+
+
+def print_batch_failure(results_stream):
+    json.dump({"status": "failed", "error": "The batch could not be started, see the log."}, results_stream)
+    results_stream.write("\n")
+    results_stream.flush()
+
+
+def watch(arguments, log_signal, results_stream):
+    from watch import watch_folder
+
+    # Repair the files of the folder tree as they are completed and print the results of each
+    # batch as it finishes. The index of the files seen is kept in the output folder
+    failed = 0
+
+    def repair(files):
+        nonlocal failed
+        results = run(arguments, log_signal, files)
+        sys.stdout.flush()
+        if results is None:
+            print_batch_failure(results_stream)
+            failed += len(files)
+        else:
+            failed += print_results(arguments, results, results_stream)
+
+    patterns = arguments.include
+    if patterns is None and arguments.command == "recover":
+        from recover_mp4 import DEFAULT_PATTERNS
+        patterns = DEFAULT_PATTERNS
+    try:
+        watch_folder(
+            arguments.folder, repair, log_signal, output_folders(arguments)[0], arguments.interval, arguments.settle,
+            patterns, exclude=output_folders(arguments),
+        )
+    except KeyboardInterrupt:
+        log_signal.emit("Stopped watching")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+
+    # Keep stdout for the JSON results: everything the repair code prints, including from
+    # worker processes, goes to stderr
+    results_stream = os.fdopen(os.dup(sys.stdout.fileno()), 'w')
+    sys.stdout.flush()
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+    if arguments.command == "triage":
+        return print_triage(arguments, results_stream)
+    if arguments.command == "profiles":
+        return print_profiles(arguments, results_stream)
+    if arguments.command == "carve":
+        return print_carve(arguments, results_stream)
+
+    log_signal = ConsoleLog()
+    if getattr(arguments, 'watch', False):
+        return watch(arguments, log_signal, results_stream)
+    metrics_path = getattr(arguments, 'metrics', None)
+    profile_path = getattr(arguments, 'profile', None)
+    if metrics_path is None and profile_path is None:
+        results = run(arguments, log_signal)
+    else:
+        from contextlib import nullcontext
+        from metrics import enable_metrics, profiled
+
+        recorder = enable_metrics() if metrics_path is not None else None
+        with profiled(profile_path) if profile_path is not None else nullcontext():
+            results = run(arguments, log_signal)
+        if recorder is not None:
+            for line in recorder.report():
+                log_signal.emit(line)
+            recorder.write(metrics_path)
+    sys.stdout.flush()
+
+    if results is None:
+        print_batch_failure(results_stream)
+        return 2
+
+    failed = print_results(arguments, results, results_stream)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+import json
+import os
+import mmap
+from batch import ConsoleLog, FileSkipped, mirrored_folder, order_largest_first, run_batch
+from integrity import add_duplicate_results, find_duplicates, log_duplicates, verify_results
+from isobmff import index_damaged_file, locate_moov
+from manifest import JobManifest, STAGE_REPAIRED
+from metrics import job_path
+from progress import ProgressTracker
+from scheduler import run_scheduled
+from triage import STRATEGY_HEADER, matches_patterns, triage_files
+
+# Size of the blocks used when copying the corrupt file body to the repaired file
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+# A file repaired in place keeps the bytes it lost in a journal next to it, named after it
+JOURNAL_SUFFIX = ".repair-journal"
+JOURNAL_MAGIC = b"VRTJ1\n"
+
+
+def find_last_moov_offset(corrupt_data):
+    try:
+        # Find the last structurally valid 'moov' box, searching backwards from the end
+        moov = locate_moov(corrupt_data)
+        if moov is None:
+            raise Exception("Cannot find 'moov' in the corrupt file.")
+
+        # Offset of the end of the 'moov' box type
+        last_moov_offset = moov.offset + 8
+
+        return last_moov_offset
+
+    except Exception as e:
+        print("Error:", str(e))
+        return None
+
+
+def copy_file_range_to(source_file, destination_file, offset, length, chunk_size=COPY_CHUNK_SIZE, progress=None):
+    # Copy `length` bytes starting at `offset` of source_file to the current position of destination_file,
+    # calling progress(byte_count) after each chunk
+    destination_file.flush()
+    remaining = length
+
+    # Let the kernel move the data when possible so it never passes through Python
+    if hasattr(os, 'sendfile'):
+        try:
+            source_fd = source_file.fileno()
+            destination_fd = destination_file.fileno()
+            while remaining > 0:
+                sent = os.sendfile(destination_fd, source_fd, offset, min(remaining, chunk_size))
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+                if progress is not None:
+                    progress(sent)
+            destination_file.seek(0, os.SEEK_END)
+            return length - remaining
+        except OSError:
+            # sendfile is not supported between these files, fall back to a chunked copy
+            destination_file.seek(0, os.SEEK_END)
+
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    source_file.seek(offset)
+    while remaining > 0:
+        read = source_file.readinto(view[:min(remaining, chunk_size)])
+        if not read:
+            break
+        destination_file.write(view[:read])
+        remaining -= read
+        if progress is not None:
+            progress(read)
+
+    return length - remaining
+
+
+def calculate_length_to_moov(corrupt_data, last_moov_offset):
+    try:
+        # Calculate the length from the last 'moov' to offset 8 from the start of the file
+        length_to_offset_8 = last_moov_offset - 8
+
+        print("Length from last 'moov' to offset 8 (in dec):", length_to_offset_8)
+        return length_to_offset_8
+
+    except Exception as e:
+        print("Error:", str(e))
+        return None
+
+
+def journal_path(file_path):
+    return file_path + JOURNAL_SUFFIX
+
+
+def write_at(f, offset, data):
+    # Write data at offset without moving the file position where pwrite exists
+    if hasattr(os, 'pwrite'):
+        written = 0
+        while written < len(data):
+            written += os.pwrite(f.fileno(), data[written:], offset + written)
+    else:
+        f.seek(offset)
+        f.write(data)
+        f.flush()
+
+
+def repair_in_place(corrupt_file, mdat_header, data_end, corrupt_size):
+    # Patch the 'mdat' header and cut the trailing bytes of the open corrupt file. The
+    # replaced header and the tail are first saved to a journal and flushed to disk, so the
+    # original file can always be restored with undo_in_place_repair
+    corrupt_file_path = corrupt_file.name
+    stat = os.fstat(corrupt_file.fileno())
+    journal = {
+        'size': corrupt_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'atime_ns': stat.st_atime_ns,
+        'header_length': len(mdat_header),
+        'tail_offset': data_end,
+    }
+
+    corrupt_file.seek(0)
+    original_header = corrupt_file.read(len(mdat_header))
+    temporary_path = journal_path(corrupt_file_path) + ".tmp"
+    with open(temporary_path, 'wb') as journal_file:
+        journal_file.write(JOURNAL_MAGIC)
+        journal_file.write(json.dumps(journal).encode('utf-8') + b"\n")
+        journal_file.write(original_header)
+        copy_file_range_to(corrupt_file, journal_file, data_end, corrupt_size - data_end)
+        journal_file.flush()
+        os.fsync(journal_file.fileno())
+    os.replace(temporary_path, journal_path(corrupt_file_path))
+
+    write_at(corrupt_file, 0, mdat_header)
+    corrupt_file.truncate(data_end)
+    corrupt_file.flush()
+    os.fsync(corrupt_file.fileno())
+
+
+def undo_in_place_repair(file_path, log_signal=None):
+    # Restore a file repaired in place from its journal, then remove the journal. Restoring is
+    # idempotent, so it also recovers a file whose repair was interrupted halfway
+    if log_signal is None:
+        log_signal = ConsoleLog()
+
+    with open(journal_path(file_path), 'rb') as journal_file:
+        if journal_file.readline() != JOURNAL_MAGIC:
+            raise Exception(f"{journal_path(file_path)} is not a repair journal.")
+        journal = json.loads(journal_file.readline())
+        original_header = journal_file.read(journal['header_length'])
+        tail_offset = journal['tail_offset']
+
+        with open(file_path, 'r+b') as repaired_file:
+            write_at(repaired_file, 0, original_header)
+            repaired_file.truncate(tail_offset)
+            repaired_file.seek(tail_offset)
+            copy_file_range_to(journal_file, repaired_file, journal_file.tell(), journal['size'] - tail_offset)
+            repaired_file.truncate(journal['size'])
+            repaired_file.flush()
+            os.fsync(repaired_file.fileno())
+
+    os.utime(file_path, ns=(journal['atime_ns'], journal['mtime_ns']))
+    os.remove(journal_path(file_path))
+    log_signal.emit(f"{os.path.basename(file_path)} restored from its journal.")
+    return file_path
+
+
+def repair_single_video(args, log_signal, progress=None, keep_extension=False):
+    # keep_extension keeps the extension of the corrupt file on the repaired copy, which is
+    # otherwise saved without one
+    corrupt_file_path, reference_file_path, output_directory, in_place = args
+    corrupt_size = 0
+    copied = 0
+
+    try:
+        # Get the base file name without extension
+        file_name, _ = os.path.splitext(os.path.basename(corrupt_file_path))
+        log_signal.emit(f"Processing {file_name}...")
+
+        if in_place and os.path.exists(journal_path(corrupt_file_path)):
+            raise Exception("The file was already repaired in place, undo that repair first.")
+
+        with open(corrupt_file_path, 'r+b' if in_place else 'rb') as corrupt_file:
+            corrupt_size = os.fstat(corrupt_file.fileno()).st_size
+            if corrupt_size == 0:
+                raise Exception("The corrupt file is empty.")
+
+            # Map the corrupt file instead of reading it so only the pages we touch are loaded
+            with mmap.mmap(corrupt_file.fileno(), 0, access=mmap.ACCESS_READ) as corrupt_data:
+                # Index the boxes by their size fields: the media data up to the last valid 'moov',
+                # the boxes following it and the end of the valid data before any trailing junk
+                boxes, data_end = index_damaged_file(corrupt_data)
+                moov = boxes[1]
+
+                # Calculate the length from the last 'moov' to offset 8 from the start of the file
+                length_to_offset_8 = calculate_length_to_moov(corrupt_data, moov.offset + 8)
+                if length_to_offset_8 is None:
+                    return
+
+            # Build the new 'mdat' header
+            length_to_moov_bytes = length_to_offset_8.to_bytes(8, byteorder='big')
+            mdat_header = b'\x00\x00\x00\x01mdat' + length_to_moov_bytes
+
+            # Drop the bytes following the last valid box
+            log_signal.emit(f"Removing {corrupt_size - data_end} trailing bytes from {file_name}.")
+
+            if in_place:
+                # Only the header and the tail change, leave the rest of the file where it is
+                repair_in_place(corrupt_file, mdat_header, data_end, corrupt_size)
+                log_signal.emit(f"{file_name} repaired in place, the original bytes are kept in {journal_path(corrupt_file_path)}.")
+                return corrupt_file_path
+
+            # Create the repaired file name with the same extension as the original file
+            repaired_file_name = os.path.basename(corrupt_file_path) if keep_extension else file_name + ".mov"
+
+            # Save the repaired file to the output directory with the same name, streaming the body
+            # from the corrupt file so memory use does not depend on the file size
+            repaired_file_path = os.path.join(output_directory, repaired_file_name)
+            with open(repaired_file_path, 'wb') as repaired_file:
+                repaired_file.write(mdat_header)
+                copied = copy_file_range_to(corrupt_file, repaired_file, len(mdat_header), data_end - len(mdat_header), progress=progress)
+
+        print("File repaired and saved as:", repaired_file_path)
+
+        # Remove the extension from the saved file if there is one
+        base_name, _ = os.path.splitext(repaired_file_path)
+        if keep_extension:
+            new_repaired_file_path = repaired_file_path
+        elif os.path.exists(repaired_file_path):
+            new_repaired_file_path = base_name
+            os.rename(repaired_file_path, new_repaired_file_path)
+            print("File renamed to:", new_repaired_file_path)
+
+        log_signal.emit(f"{file_name} repaired.")
+        return new_repaired_file_path
+
+    except Exception as e:
+        print("Error:", str(e))
+        log_signal.emit(f"Error repairing {corrupt_file_path}: {str(e)}")
+        return None
+
+    finally:
+        # Count the bytes that were not copied (the header, the trailing bytes or the whole
+        # file when it could not be repaired) so the batch progress still reaches 100%
+        if progress is not None:
+            progress(max(corrupt_size - copied, 0))
+
+
+def repair_files_in_directory(corrupted_folder_path, reference_file_path, output_directory, log_signal=None, workers=None, progress_callback=None, patterns=None, in_place=False, triage=True, dedupe=True, verify=True, scheduler=None, files=None):
+    if log_signal is None:
+        log_signal = ConsoleLog()
+
+    try:
+        # List all files in the corrupted folder, or those matching one of the patterns in any
+        # case, unless a watch of the folder gives the files
+        if files is None:
+            corrupted_files = [
+                os.path.join(corrupted_folder_path, f) for f in os.listdir(corrupted_folder_path)
+                if os.path.isfile(os.path.join(corrupted_folder_path, f)) and not f.endswith(JOURNAL_SUFFIX)
+                and matches_patterns(f, patterns)
+            ]
+        else:
+            corrupted_files = list(files)
+
+        # Repair each clip once when the folder holds several copies of it. In place, every
+        # copy is its own output and is repaired
+        duplicates = {}
+        if dedupe and not in_place:
+            corrupted_files, duplicates = find_duplicates(corrupted_files)
+            log_duplicates(duplicates, log_signal)
+
+        # Skip the files already repaired by a previous run. Skipped files get a result with
+        # the reason, whose job has the same form as those of the repairs
+        manifest = JobManifest(output_directory)
+        pending_files = []
+        skipped = []
+        for corrupt_file_path in corrupted_files:
+            stage, outputs = manifest.stage(corrupt_file_path)
+            repaired_file_path = outputs.get('repaired', '')
+            # A file repaired in place is its own output, a repaired copy is another file
+            same_mode = os.path.abspath(repaired_file_path) == os.path.abspath(corrupt_file_path)
+            if stage == STAGE_REPAIRED and os.path.exists(repaired_file_path) and same_mode == in_place:
+                log_signal.emit(f"Skipping {os.path.basename(corrupt_file_path)}, already repaired.")
+                job = (corrupt_file_path, reference_file_path, output_directory, in_place)
+                skipped.append((job, repaired_file_path, FileSkipped("already repaired")))
+            else:
+                pending_files.append(corrupt_file_path)
+
+        # Only repair the files whose header is damaged: triage reads a few blocks of each file
+        # and skips the healthy ones and those this repair cannot fix before anything is copied
+        if triage:
+            header_damaged_files = []
+            for result in triage_files(pending_files):
+                if result.strategy == STRATEGY_HEADER:
+                    header_damaged_files.append(result.path)
+                else:
+                    log_signal.emit(f"Skipping {os.path.basename(result.path)}, {result.status}: {result.reason}")
+                    job = (result.path, reference_file_path, output_directory, in_place)
+                    skipped.append((job, None, FileSkipped(f"{result.status}: {result.reason}")))
+            pending_files = header_damaged_files
+
+        def record_result(job, repaired_file_path, error):
+            if repaired_file_path is not None:
+                manifest.record(job[0], STAGE_REPAIRED, repaired=repaired_file_path)
+
+        # Report the progress of the batch in bytes copied
+        progress = None
+        if progress_callback is not None:
+            progress = ProgressTracker(sum(os.path.getsize(f) for f in pending_files), progress_callback)
+
+        # Repair the video files with a pool of processes, largest files first. In place, the
+        # corrupt files themselves are patched and output_directory only holds the manifest.
+        # Files found in subfolders, by a recursive watch, go to the same subfolders of it
+        jobs = [
+            (corrupt_file_path, reference_file_path, output_directory if in_place else mirrored_folder(corrupt_file_path, corrupted_folder_path, output_directory), in_place)
+            for corrupt_file_path in order_largest_first(pending_files)
+        ]
+        if scheduler is None:
+            results = run_batch(repair_single_video, jobs, log_signal, workers, use_processes=True, on_result=record_result, progress=progress, stage="header")
+        else:
+            # The device scheduler runs as many repairs at once as the disks keep up with
+            stages = [("header", lambda job, log: repair_single_video(job, log, progress), job_path, lambda job: job[0] if in_place else job[2])]
+            results, _ = run_scheduled(stages, jobs, log_signal, scheduler, on_result=record_result)
+        if progress is not None:
+            progress.finish()
+
+        # Check that every repaired file is a well formed movie, hashing it on the way
+        if verify:
+            results = verify_results(results, log_signal, workers)
+        return add_duplicate_results(results + skipped, duplicates)
+
+    except Exception as e:
+        print("Error:", str(e))
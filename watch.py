@@ -0,0 +1,168 @@
+import json
+import os
+import threading
+import time
+from triage import VIDEO_PATTERNS, matches_patterns
+
+# Index of the files a watch has seen, kept in the output folder so a restarted watch does not
+# repair them again
+WATCH_INDEX_FILE = "watch-index.json"
+
+# Seconds between two scans of the watched folder
+DEFAULT_WATCH_INTERVAL = 10.0
+
+# A directory is listed again when its mtime changed, or when it was last listed less than this
+# many seconds after its mtime: exFAT and FAT, used by camera cards, store times in 2 second steps
+MTIME_RESOLUTION = 2.0
+
+
+class WatchIndex:
+    # The files seen under the watched folder, by path, with the size and mtime they had when
+    # last seen, since when they have not changed and whether they were handed to the repair,
+    # and the directories listed, with their mtime and subdirectories
+    def __init__(self, directory):
+        self.path = os.path.join(directory, WATCH_INDEX_FILE)
+        try:
+            with open(self.path, 'r') as f:
+                index = json.load(f)
+            self.files = index['files']
+            self.directories = index['directories']
+        except (OSError, ValueError, KeyError):
+            self.files = {}
+            self.directories = {}
+
+    def update_file(self, path, size, mtime_ns, now):
+        # Record what a scan saw of a file and return its entry
+        entry = self.files.get(path)
+        if entry is None or entry['size'] != size or entry['mtime_ns'] != mtime_ns:
+            # New, or still being written: it is stable from now on if nothing changes
+            entry = self.files[path] = {'size': size, 'mtime_ns': mtime_ns, 'since': now, 'handled': False}
+        return entry
+
+    def mark_handled(self, paths):
+        # Record the files as they are after the repair, which patches them when in place, so
+        # they are not taken for new ones at the next scan
+        for path in paths:
+            entry = self.files.get(path)
+            if entry is None:
+                continue
+            try:
+                stat = os.stat(path)
+                entry['size'], entry['mtime_ns'] = stat.st_size, stat.st_mtime_ns
+            except OSError:
+                pass
+            entry['handled'] = True
+
+    def save(self):
+        # Write to a temporary file and move it in place so a crash never leaves half an index
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, 'w') as f:
+            json.dump({'files': self.files, 'directories': self.directories}, f)
+        os.replace(temporary_path, self.path)
+
+
+class FolderWatcher:
+    # Scans a directory tree for video files and returns those whose size and mtime have not
+    # changed for settle_seconds and were not handled yet. Directories whose mtime did not
+    # change since they were listed are not listed again, only the files still settling are
+    # looked at again
+    def __init__(self, folder, index, patterns=None, settle_seconds=DEFAULT_WATCH_INTERVAL, exclude=()):
+        self.folder = os.path.abspath(folder)
+        self.index = index
+        self.patterns = patterns or VIDEO_PATTERNS
+        self.settle_seconds = settle_seconds
+        self.exclude = {os.path.abspath(path) for path in exclude}
+
+    def list_directory(self, directory, now, seen_files):
+        # List a directory: record its files and return its subdirectories
+        subdirectories = []
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in self.exclude:
+                        subdirectories.append(entry.path)
+                elif entry.is_file() and matches_patterns(entry.name, self.patterns):
+                    stat = entry.stat()
+                    self.index.update_file(entry.path, stat.st_size, stat.st_mtime_ns, now)
+                    seen_files.add(entry.path)
+        return subdirectories
+
+    def scan(self):
+        now = time.time()
+        listed = set()
+        seen_files = set()
+        directories = [self.folder]
+        seen_directories = set()
+        while directories:
+            directory = directories.pop()
+            seen_directories.add(directory)
+            try:
+                mtime_ns = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            known = self.index.directories.get(directory)
+            if known is not None and known['mtime_ns'] == mtime_ns and known['listed_at'] - mtime_ns / 1e9 > MTIME_RESOLUTION:
+                directories.extend(known['subdirectories'])
+                continue
+            try:
+                subdirectories = self.list_directory(directory, now, seen_files)
+            except OSError:
+                continue
+            listed.add(directory)
+            self.index.directories[directory] = {'mtime_ns': mtime_ns, 'listed_at': now, 'subdirectories': subdirectories}
+            directories.extend(subdirectories)
+
+        # Forget the directories that are gone
+        for directory in list(self.index.directories):
+            if directory not in seen_directories:
+                del self.index.directories[directory]
+
+        # Files growing in a directory that was not listed again do not change its mtime, look
+        # at them one by one; files missing from a listed directory are gone
+        ready = []
+        for path, entry in list(self.index.files.items()):
+            directory = os.path.dirname(path)
+            if directory not in seen_directories:
+                del self.index.files[path]
+                continue
+            if directory in listed:
+                if path not in seen_files:
+                    del self.index.files[path]
+                    continue
+            elif not entry['handled']:
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    del self.index.files[path]
+                    continue
+                entry = self.index.update_file(path, stat.st_size, stat.st_mtime_ns, now)
+            if entry['handled']:
+                continue
+            if now - entry['since'] >= self.settle_seconds:
+                ready.append(path)
+        return sorted(ready)
+
+
+def watch_folder(folder, repair, log_signal, index_directory, interval=DEFAULT_WATCH_INTERVAL, settle_seconds=None,
+                 patterns=None, exclude=(), stop_event=None):
+    # Scan the folder tree every interval seconds and call repair(paths) with the files that
+    # stopped changing, until stop_event is set. Each file is handed to repair once
+    if stop_event is None:
+        stop_event = threading.Event()
+    if settle_seconds is None:
+        settle_seconds = interval
+    index = WatchIndex(index_directory)
+    watcher = FolderWatcher(folder, index, patterns, settle_seconds, tuple(exclude) + (index_directory,))
+
+    log_signal.emit(f"Watching {os.path.abspath(folder)} for new files every {interval:g}s")
+    while not stop_event.is_set():
+        ready = watcher.scan()
+        if ready:
+            log_signal.emit(f"{len(ready)} new files are complete, repairing them")
+            try:
+                repair(ready)
+            finally:
+                index.mark_handled(ready)
+        index.save()
+        stop_event.wait(interval)